@@ -0,0 +1,50 @@
+'''
+ Deferred imports, so that importing analysis_utils modules doesn't pay
+ for ROOT (or numpy) unless they are actually used:
+
+     from analysis_utils._lazy import lazy_import
+     r = lazy_import('ROOT')
+
+     def f(tree):
+         return r.TChain(...)   # ROOT is imported here, on first use
+'''
+
+import sys
+
+class LazyModule(object):
+
+    def __init__(self, name, setup=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            __import__(self._name)
+            module = sys.modules[self._name]
+            if self._setup is not None:
+                self._setup(module)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        if self.__dict__['_module'] is None:
+            return '<lazy module %s (not loaded)>' % self._name
+        return repr(self.__dict__['_module'])
+
+def _setup_root(module):
+    # don't let ROOT parse (and choke on) the command line of scripts
+    module.PyConfig.IgnoreCommandLineOptions = True
+
+''' Return a proxy for the named module, which is imported on first use '''
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name, _setup_root if name == 'ROOT' else None)
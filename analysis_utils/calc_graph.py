@@ -0,0 +1,261 @@
+'''
+ Records the dependency graph of AnalysisVariation calculables.
+
+ While a CalculableGraph is attached to a set of variations (see
+ AnalysisVariation.set_observer), every access to a calculable or to a
+ source branch is recorded as an edge from the calculable currently being
+ computed (if any). Edges are of three kinds:
+   calculable -- a _get_xxx() method read another calculable
+   fallback   -- a calculable was deferred (CalculationFallback), or read
+                 a calculable of another variation
+   branch     -- a calculable read a branch of the source tree
+
+ For each node, the graph also keeps the number of evaluations, fallback
+ deferrals, cache hits and the total (inclusive) wall time spent
+ computing it, so you can see which calculables dominate the cost, as
+ well as the number of times it called defer()/defer_if()/defer_unless()
+ (whether or not it could actually defer).
+
+ Nodes are keyed by (id of the variation, attribute), so variations need
+ not have distinct names; names() maps the ids back to the names.
+
+ Typically, the graph is recorded by the driver during a short warm-up:
+   graph = CalculableGraph()
+   run(input_tree, nominal, variations, calculable_graph=graph, warmup=1000)
+   graph.print_report()
+'''
+
+import time
+
+''' Node key used for branches of the source tree '''
+SOURCE = '<source>'
+
+class CalculableGraph(object):
+
+    def __init__(self):
+        # (id of the variation, attribute) -> stats dict
+        self.nodes = {}
+        # id of the variation -> variation name
+        self.names = {}
+        # (consumer node, input node) -> edge kind
+        self.edges = {}
+        # stack of [node, start time] for calculables being computed
+        self._stack = []
+
+    def _node(self, key):
+        try:
+            return self.nodes[key]
+        except KeyError:
+            stats = {'computed': 0, 'deferred': 0, 'shared': 0, 'hits': 0, 'defer_points': 0, 'time': 0.}
+            self.nodes[key] = stats
+            return stats
+
+    def _add_edge(self, key, kind):
+        if self._stack:
+            consumer = self._stack[-1][0]
+            if not (consumer, key) in self.edges:
+                self.edges[(consumer, key)] = kind
+
+    def _dep_kind(self, key):
+        if self._stack and self._stack[-1][0][0] != key[0]:
+            return 'fallback'
+        return 'calculable'
+
+    def _key(self, v, attr):
+        self.names[id(v)] = v._name
+        return (id(v), attr)
+
+    ''' Printable name of a node, e.g. `nominal.all_jets` '''
+    def label(self, node):
+        return '%s.%s' % (self.names.get(node[0], node[0]), node[1])
+
+    ##############################################
+    ## Observer interface (see AnalysisVariation) ##
+    ##############################################
+
+    def read_source(self, v, attr):
+        key = (SOURCE, attr)
+        self._node(key)
+        self._add_edge(key, 'branch')
+
+    def cache_hit(self, v, attr):
+        key = self._key(v, attr)
+        self._node(key)['hits'] += 1
+        self._add_edge(key, self._dep_kind(key))
+
+    def defer_point(self, v):
+        if self._stack:
+            self.nodes[self._stack[-1][0]]['defer_points'] += 1
+
+    def begin(self, v, attr):
+        key = self._key(v, attr)
+        self._node(key)
+        self._add_edge(key, self._dep_kind(key))
+        self._stack.append((key, time.time()))
+
+    def end(self, v, attr, status):
+        key, tstart = self._stack.pop()
+        stats = self.nodes[key]
+        stats['time'] += time.time() - tstart
+        if status in stats:
+            stats[status] += 1
+
+    #############
+    ## Queries ##
+    #############
+
+    ''' Direct inputs of the given node, as a list of (node, kind) '''
+    def dependencies(self, node):
+        return [(dep, kind) for (consumer, dep), kind in self.edges.items() if consumer == node]
+
+    ''' Nodes which directly read the given node '''
+    def dependents(self, node):
+        return [consumer for (consumer, dep) in self.edges if dep == node]
+
+    ''' All source branches read (directly or indirectly) by the given node '''
+    def branches(self, node):
+        seen = set()
+        todo = [node]
+        found = set()
+        while todo:
+            n = todo.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            for dep, kind in self.dependencies(n):
+                if kind == 'branch':
+                    found.add(dep[1])
+                else:
+                    todo.append(dep)
+        return sorted(found)
+
+    ''' Calculables recorded for the given variation '''
+    def calculables(self, v):
+        return [attr for (vid, attr) in self.nodes if vid == id(v)]
+
+    ''' Order the calculable nodes such that inputs come before their consumers '''
+    def topological_order(self):
+        order = []
+        visited = set()
+        def visit(n):
+            if n in visited:
+                return
+            visited.add(n)
+            for dep, kind in self.dependencies(n):
+                if kind != 'branch':
+                    visit(dep)
+            order.append(n)
+        for n in sorted(self.nodes):
+            if n[0] != SOURCE:
+                visit(n)
+        return order
+
+    def print_report(self, limit=None):
+        calcs = [(k, s) for k, s in self.nodes.items() if k[0] != SOURCE]
+        if len(calcs) == 0:
+            print "(no records)"
+            return
+
+        calcs.sort(key=lambda x: x[1]['time'], reverse=True)
+        if limit:
+            calcs = calcs[:limit]
+        names = [self.label(k) for k, s in calcs]
+        name_width = max(map(len, names))
+        print "%s  %10s %8s %8s %8s %8s" % (' ' * name_width, 'time [s]', 'computed', 'deferred', 'shared', 'hits')
+        for name, (k, s) in zip(names, calcs):
+            padding = name_width - len(name)
+            print "%s:%s %10.4f %8d %8d %8d %8d" % (name, ' ' * padding, s['time'], s['computed'],
+                                                     s['deferred'], s['shared'], s['hits'])
+
+    ''' Return the graph in graphviz (dot) format '''
+    def to_dot(self):
+        styles = {'calculable': 'solid', 'fallback': 'dashed', 'branch': 'dotted'}
+        lines = ['digraph calculables {']
+        for consumer, dep, kind in sorted((self.label(c), self.label(d), k) for (c, d), k in self.edges.items()):
+            lines.append('  "%s" -> "%s" [style=%s];' % (consumer, dep, styles[kind]))
+        lines.append('}')
+        return '\n'.join(lines)
+
+    '''
+     Calculables of the given variations (all of the same class) which may
+     be shared across their configurations: those the class lists in its
+     _config_independent, provided that, according to the recorded graph,
+     they never called defer()/defer_if()/defer_unless() (in any of the
+     variations; the nominal one never actually defers, but still reaches
+     the call), never read another variation's calculables, and only read
+     source branches and other such calculables.
+    '''
+    def config_independent(self, variations):
+        ids = set(id(v) for v in variations)
+        attrs = set(attr for (vid, attr) in self.nodes if vid in ids)
+        independent = set(variations[0]._config_independent) & attrs
+        inputs = dict((attr, set()) for attr in attrs)
+        for (vid, attr), stats in self.nodes.items():
+            if vid in ids and (stats['defer_points'] or stats['deferred']):
+                independent.discard(attr)
+        for (consumer, dep), kind in self.edges.items():
+            if consumer[0] not in ids:
+                continue
+            if kind == 'fallback':
+                independent.discard(consumer[1])
+            elif kind == 'calculable':
+                inputs[consumer[1]].add(dep[1])
+
+        # anything reading a calculable which can't be shared can't be either
+        changed = True
+        while changed:
+            changed = False
+            for attr in list(independent):
+                if not inputs[attr] <= independent:
+                    independent.discard(attr)
+                    changed = True
+        return independent
+
+    '''
+     Let variations share their calculables:
+      - within each group of variations with the same class and
+        configuration (i.e. the same keyword arguments), the others take
+        the value of every calculable recorded for the leader (the nominal
+        variation, if it is in the group) from it, and
+      - across the groups of the same class, the calculables which the
+        class declares independent of the configuration (see
+        config_independent) are taken from the first variation of that
+        class.
+     Returns the list of groups.
+
+     NB: nothing is shared across configurations unless the class lists it
+     in _config_independent, since the graph can't tell whether a
+     calculable reads the variation's own settings (e.g. a systematic
+     shift).
+    '''
+    def share(self, variations):
+        groups = []
+        # NB: the nominal variation (no fallback) must lead its group, since
+        # the others may defer to it.
+        variations = sorted(variations, key=lambda v: v._fallback is not None)
+        for v in variations:
+            for g in groups:
+                leader = g[0]
+                if leader.__class__ is v.__class__ and leader._config == v._config:
+                    g.append(v)
+                    break
+            else:
+                groups.append([v])
+
+        for g in groups:
+            leader = g[0]
+            shared = set(self.calculables(leader))
+            for v in g[1:]:
+                v.share_calculables(leader, shared)
+
+        classes = []
+        for v in variations:
+            if not v.__class__ in classes:
+                classes.append(v.__class__)
+        for cls in classes:
+            members = [v for v in variations if v.__class__ is cls]
+            leader = members[0]
+            shared = self.config_independent(members) & set(self.calculables(leader))
+            for v in members[1:]:
+                v.share_calculables(leader, shared)
+        return groups
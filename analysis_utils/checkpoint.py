@@ -0,0 +1,137 @@
+'''
+ Checkpointing for the variation_loop.run() driver, so that a preempted
+ job can resume where it left off:
+
+     outfile = r.TFile('output.root', 'update')   # NB: update, not recreate
+     variations = ...   # create the variations (and their output trees)
+     run(input_tree, nominal, variations, checkpoint_file='job.ckpt',
+         checkpoint_every=10000)
+     outfile.Write()
+
+ Every `checkpoint_every` entries (or `checkpoint_seconds` seconds), the
+ output trees of all variations (see AnalysisVariation.get_output_trees)
+ are flushed and auto-saved to their file, and the next entry to process,
+ the cutflows and the state of the random number generators are written
+ to the checkpoint file.
+
+ If the checkpoint file exists when the job (re)starts, the entries the
+ previous attempt already wrote are copied from the output file into the
+ fresh output trees, the cutflows and random state are restored, and the
+ loop continues from the checkpointed entry. The final output is then
+ the same as that of an uninterrupted run. The checkpoint file is removed
+ once the loop completes.
+'''
+
+import os
+import sys
+import time
+import random
+import cPickle as pickle
+
+''' The cutflows are saved by variation name, so the names must be unique '''
+def check_unique_names(variations):
+    seen = set()
+    for v in variations:
+        if v._name in seen:
+            raise ValueError("cannot checkpoint: more than one variation is named `%s`" % v._name)
+        seen.add(v._name)
+
+class Checkpointer(object):
+
+    def __init__(self, filename, every=None, seconds=None):
+        self.filename = filename
+        if every is None and seconds is None:
+            every = 10000
+        self.every = every
+        self.seconds = seconds
+        self._tlast = time.time()
+
+    ''' Return the saved state, or None if there is no checkpoint '''
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        f = open(self.filename, 'rb')
+        state = pickle.load(f)
+        f.close()
+        return state
+
+    ''' Whether a checkpoint should be taken before processing the i-th entry of the loop '''
+    def due(self, i):
+        if i == 0:
+            return False
+        if self.every and i % self.every == 0:
+            return True
+        # NB: only look at the clock every so often
+        if self.seconds and i % 100 == 0:
+            return time.time() - self._tlast >= self.seconds
+        return False
+
+    '''
+     Save a checkpoint; `entry` is the next entry of the input tree to be
+     processed, i.e. everything in [first_entry, entry) has been written out.
+    '''
+    def save(self, entry, first_entry, last_entry, variations):
+        check_unique_names(variations)
+        tree_entries = {}
+        for v in variations:
+            for t in v.get_output_trees():
+                if hasattr(t, 'flush'):
+                    # write out any buffered rows (see PyTree)
+                    t.flush()
+                t.AutoSave('SaveSelf')
+                tree_entries[t.GetName()] = t.GetEntries()
+
+        state = {'entry': entry,
+                 'first_entry': first_entry,
+                 'last_entry': last_entry,
+                 'cutflows': dict((v._name, v._cutflow) for v in variations),
+                 'tree_entries': tree_entries,
+                 'random': random.getstate()}
+        if 'numpy' in sys.modules:
+            state['numpy.random'] = sys.modules['numpy'].random.get_state()
+
+        # write atomically, so a crash never leaves a truncated checkpoint
+        tmp_name = '%s.tmp' % self.filename
+        f = open(tmp_name, 'wb')
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_name, self.filename)
+        self._tlast = time.time()
+
+    '''
+     Restore the cutflows and random state from a checkpoint, and copy the
+     output entries written before it into the variations' output trees.
+    '''
+    def restore(self, state, variations):
+        check_unique_names(variations)
+        missing = [v._name for v in variations if v._name not in state['cutflows']]
+        if missing:
+            raise ValueError("checkpoint has no cutflows for variation(s) %s" % ', '.join(missing))
+        for v in variations:
+            v._cutflow = state['cutflows'][v._name]
+            for t in v.get_output_trees():
+                name = t.GetName()
+                n_entries = state['tree_entries'].get(name, 0)
+                if n_entries == 0:
+                    continue
+                # NB: t itself is registered in the same directory
+                # under the same name, so read the saved tree from its key.
+                key = t.GetDirectory().GetKey(name)
+                if not key:
+                    raise RuntimeError("checkpointed tree `%s` not found in the output file" % name)
+                saved = key.ReadObj()
+                t.append_tree(saved, n_entries)
+                if hasattr(t, 'flush'):
+                    t.flush()
+                # replaces the saved tree in the file
+                t.AutoSave('SaveSelf')
+
+        random.setstate(state['random'])
+        if 'numpy.random' in state:
+            import numpy
+            numpy.random.set_state(state['numpy.random'])
+        self._tlast = time.time()
+
+    def finish(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
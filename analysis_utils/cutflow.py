@@ -1,14 +1,27 @@
 '''
  Raise this exception if you want to skip the event during
  the process() stage; e.g. if a cut has failed.
+
+ Alternatively, a process function may simply return False to skip
+ the event, which is cheaper than raising and catching an exception
+ (see Cutflow.passes_cut).
 '''
 
 
+import time
+from _lazy import lazy_import
+
+np = lazy_import('numpy')
+
+
 class SkipEvent(Exception):
 
     def __init__(self):
         pass
 
+# raised by cut_if(); a single instance saves constructing one per failed cut
+SKIP_EVENT = SkipEvent()
+
 
 class Cutflow:
 
@@ -16,15 +29,97 @@ class Cutflow:
         self.cut_names = []
         self.cut_counts = {}
 
+        # per-cut wall time; None unless enable_timing() was called.
+        self.cut_times = None
+        self._tlast = 0.
+
+    ''' Return a new, empty cutflow of the same kind '''
+    def empty(self):
+        return self.__class__()
+
     def cut_if(self, expr, cut_name):
+        if not self.passes_cut(expr, cut_name):
+            raise SKIP_EVENT
+
+    '''
+     Like cut_if(), but instead of raising SkipEvent when `expr` is true,
+     return False (and True otherwise), e.g.:
+         if not cutflow.passes_cut(n_muons < 2, '2muons'):
+             return False
+    '''
+    def passes_cut(self, expr, cut_name):
+        if self.cut_times is not None:
+            self.record_time(cut_name)
         if expr:
-            raise SkipEvent
-        else:
-            try:
-                self.cut_counts[cut_name] += 1
-            except KeyError:
-                self.cut_counts[cut_name] = 1
-                self.cut_names.append(cut_name)
+            return False
+        try:
+            self.cut_counts[cut_name] += 1
+        except KeyError:
+            self.cut_counts[cut_name] = 1
+            self.cut_names.append(cut_name)
+        return True
+
+    '''
+     Record `n` entries passing the named cut at once (e.g. for a batch
+     of entries). As with cut_if(), a cut is only registered once at
+     least one entry has passed it.
+    '''
+    def add_count(self, cut_name, n):
+        if n < 1:
+            return
+        try:
+            self.cut_counts[cut_name] += n
+        except KeyError:
+            self.cut_counts[cut_name] = n
+            self.cut_names.append(cut_name)
+
+    '''
+     Record the entries of a batch flagged by the boolean array `mask`
+     as passing the named cut (see AnalysisVariation.passes_cut).
+    '''
+    def add_batch(self, cut_name, mask):
+        self.add_count(cut_name, int(mask.sum()))
+
+    '''
+     Add the counts from another Cutflow to this one. Cuts which are
+     not yet known are appended in the order they appear in `other`,
+     so merging partial cutflows in entry order reproduces the cut
+     order of a single job.
+    '''
+    def merge(self, other):
+        for cut in other.cut_names:
+            self.add_count(cut, other.cut_counts[cut])
+
+    '''
+     Timing of cuts: the time spent in each cut is taken to be the time
+     since the previous cut (or since start_timer() was called), i.e. the
+     time it took to evaluate the cut expression.
+    '''
+    def enable_timing(self):
+        self.cut_times = {}
+
+    def start_timer(self):
+        self._tlast = time.time()
+
+    def record_time(self, cut_name):
+        tnow = time.time()
+        try:
+            self.cut_times[cut_name] += tnow - self._tlast
+        except KeyError:
+            self.cut_times[cut_name] = tnow - self._tlast
+        self._tlast = tnow
+
+    def print_timing(self):
+        if not self.cut_times:
+            print "(no cuts)"
+            return
+
+        # cuts which never passed are not in cut_names, but still cost time
+        names = self.cut_names + [c for c in self.cut_times if not c in self.cut_counts]
+        name_width = max(map(len, names))
+        for cut in names:
+            padding = name_width-len(cut)
+            print "%s:%s\t%.4f s" % (cut, " "*padding, self.cut_times.get(cut, 0.))
 
     def __repr__(self):
         if len(self.cut_names) == 0:
@@ -36,3 +131,255 @@ class Cutflow:
             padding = name_width-len(cut)
             rep_str += "%s:%s\t%d\n" % (cut, " "*padding, self.cut_counts[cut])
         return rep_str
+
+
+'''
+ A weighted cutflow, with the counts, sums of weights and sums of squared
+ weights of the cuts kept in numpy arrays (indexed in the order in which
+ the cuts were first passed). It can be used wherever a Cutflow is:
+ the drivers switch to it when given an event_weight (see
+ variation_loop.run), which sets `weight` (or `batch_weights` in batched
+ mode) before each entry is processed.
+
+ ArrayCutflows can be merged (also with plain Cutflows, whose entries
+ count with unit weight), and saved to / loaded from compact .npz files;
+ see save_cutflows(), load_cutflows() and merge_cutflows.py.
+'''
+class ArrayCutflow(Cutflow):
+
+    def __init__(self, capacity=16):
+        # NB: cut_counts is a property; don't call Cutflow.__init__
+        self.cut_names = []
+        self.cut_index = {}
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.sumw = np.zeros(capacity, dtype=np.float64)
+        self.sumw2 = np.zeros(capacity, dtype=np.float64)
+
+        # weight of the current entry, and of the entries of the current batch
+        self.weight = 1.
+        self.batch_weights = None
+
+        self.cut_times = None
+        self._tlast = 0.
+
+    @staticmethod
+    def from_cutflow(cutflow):
+        cf = ArrayCutflow()
+        cf.merge(cutflow)
+        cf.cut_times = cutflow.cut_times
+        return cf
+
+    ''' Return the index of the named cut, adding it if necessary '''
+    def index(self, cut_name):
+        try:
+            return self.cut_index[cut_name]
+        except KeyError:
+            i = len(self.cut_names)
+            if i == len(self.counts):
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+                self.sumw = np.concatenate([self.sumw, np.zeros_like(self.sumw)])
+                self.sumw2 = np.concatenate([self.sumw2, np.zeros_like(self.sumw2)])
+            self.cut_names.append(cut_name)
+            self.cut_index[cut_name] = i
+            return i
+
+    @property
+    def cut_counts(self):
+        return dict(zip(self.cut_names, self.counts.tolist()))
+
+    ''' (counts, sumw, sumw2) arrays over the cuts in cut_names '''
+    def arrays(self):
+        n = len(self.cut_names)
+        return self.counts[:n], self.sumw[:n], self.sumw2[:n]
+
+    def passes_cut(self, expr, cut_name):
+        if self.cut_times is not None:
+            self.record_time(cut_name)
+        if expr:
+            return False
+        i = self.index(cut_name)
+        w = self.weight
+        self.counts[i] += 1
+        self.sumw[i] += w
+        self.sumw2[i] += w * w
+        return True
+
+    def add_count(self, cut_name, n, sumw=None, sumw2=None):
+        if n < 1:
+            return
+        i = self.index(cut_name)
+        self.counts[i] += n
+        self.sumw[i] += n if sumw is None else sumw
+        self.sumw2[i] += n if sumw2 is None else sumw2
+
+    def add_batch(self, cut_name, mask):
+        n = int(mask.sum())
+        if self.batch_weights is None:
+            self.add_count(cut_name, n)
+        else:
+            w = self.batch_weights[mask]
+            self.add_count(cut_name, n, w.sum(), (w * w).sum())
+
+    def merge(self, other):
+        if not isinstance(other, ArrayCutflow):
+            # unweighted: every entry has unit weight
+            for cut in other.cut_names:
+                self.add_count(cut, other.cut_counts[cut])
+            return
+
+        n = len(other.cut_names)
+        if self.cut_names[:n] == other.cut_names:
+            # the common case: same cuts in the same order
+            idx = slice(0, n)
+        else:
+            idx = np.array([self.index(cut) for cut in other.cut_names], dtype=int)
+        counts, sumw, sumw2 = other.arrays()
+        self.counts[idx] += counts
+        self.sumw[idx] += sumw
+        self.sumw2[idx] += sumw2
+
+    def __repr__(self):
+        if len(self.cut_names) == 0:
+            return "(no cuts)"
+
+        rep_str = ""
+        name_width = max(map(len,self.cut_names))
+        counts, sumw, sumw2 = self.arrays()
+        for cut, n, w, w2 in zip(self.cut_names, counts, sumw, sumw2):
+            padding = name_width-len(cut)
+            rep_str += "%s:%s\t%d\t%g +/- %g\n" % (cut, " "*padding, n, w, w2**0.5)
+        return rep_str
+
+
+'''
+ Cutflow of a family of N variations evaluated together (see
+ parametric.ParametricVariation): the counts, sums of weights and sums of
+ squared weights are arrays of shape (n_cuts, N), i.e. each cut has a
+ count vector with one entry per member. Cuts are filled from boolean
+ member masks, of shape (N,) for a single entry or (N, batch size) for a
+ batch, by add_batch(). member() returns the plain ArrayCutflow of a
+ single member.
+'''
+class FamilyCutflow(ArrayCutflow):
+
+    def __init__(self, n_members, capacity=16):
+        ArrayCutflow.__init__(self, 0)
+        self.n_members = n_members
+        self.counts = np.zeros((capacity, n_members), dtype=np.int64)
+        self.sumw = np.zeros((capacity, n_members), dtype=np.float64)
+        self.sumw2 = np.zeros((capacity, n_members), dtype=np.float64)
+
+    def empty(self):
+        return FamilyCutflow(self.n_members)
+
+    @property
+    def cut_counts(self):
+        return dict(zip(self.cut_names, self.counts.tolist()))
+
+    def passes_cut(self, expr, cut_name):
+        raise TypeError("FamilyCutflow is filled with member masks; use add_batch()")
+
+    def add_count(self, cut_name, n, sumw=None, sumw2=None):
+        n = np.asarray(n)
+        if not n.any():
+            return
+        i = self.index(cut_name)
+        self.counts[i] += n
+        self.sumw[i] += n if sumw is None else sumw
+        self.sumw2[i] += n if sumw2 is None else sumw2
+
+    def add_batch(self, cut_name, mask):
+        if mask.ndim == 1:
+            # a single entry, with weight self.weight
+            w = self.weight
+            self.add_count(cut_name, mask.astype(np.int64), mask * w, mask * (w * w))
+        elif self.batch_weights is None:
+            self.add_count(cut_name, mask.sum(axis=1))
+        else:
+            w = self.batch_weights
+            self.add_count(cut_name, mask.sum(axis=1), np.dot(mask, w), np.dot(mask, w * w))
+
+    def merge(self, other):
+        if not isinstance(other, FamilyCutflow) or other.n_members != self.n_members:
+            raise TypeError("can only merge cutflows of families of the same size")
+        ArrayCutflow.merge(self, other)
+
+    ''' Return the cutflow of member k, as an ArrayCutflow '''
+    def member(self, k):
+        cf = ArrayCutflow()
+        counts, sumw, sumw2 = self.arrays()
+        for i, cut in enumerate(self.cut_names):
+            # NB: a variation on its own only registers the cuts it passed
+            cf.add_count(cut, counts[i, k], sumw[i, k], sumw2[i, k])
+        cf.cut_times = self.cut_times
+        return cf
+
+    def __repr__(self):
+        if len(self.cut_names) == 0:
+            return "(no cuts)"
+
+        rep_str = ""
+        name_width = max(map(len,self.cut_names))
+        counts = self.arrays()[0]
+        for cut, n in zip(self.cut_names, counts):
+            padding = name_width-len(cut)
+            rep_str += "%s:%s\t%s\n" % (cut, " "*padding, ' '.join('%d' % c for c in n))
+        return rep_str
+
+
+'''
+ Save a dict of {name: cutflow} (e.g. one per variation) to a .npz file.
+ Plain Cutflows are saved with unit weights. A FamilyCutflow has to be
+ split into its members first (see ParametricVariation.get_cutflows, as
+ used by variation_loop.save_variation_cutflows).
+'''
+def save_cutflows(filename, cutflows):
+    data = {}
+    for name, cf in cutflows.items():
+        if isinstance(cf, FamilyCutflow):
+            raise TypeError("cannot save the family cutflow `%s`; save its members' "
+                            "cutflows instead (see FamilyCutflow.member)" % name)
+        if not isinstance(cf, ArrayCutflow):
+            cf = ArrayCutflow.from_cutflow(cf)
+        counts, sumw, sumw2 = cf.arrays()
+        data[name + '/names'] = np.array(cf.cut_names, dtype=str)
+        data[name + '/counts'] = counts
+        data[name + '/sumw'] = sumw
+        data[name + '/sumw2'] = sumw2
+    # NB: pass a file object, since savez() would append .npz to the name
+    f = open(filename, 'wb')
+    np.savez_compressed(f, **data)
+    f.close()
+
+''' Load a dict of {name: ArrayCutflow} saved with save_cutflows() '''
+def load_cutflows(filename):
+    data = np.load(filename)
+    cutflows = {}
+    for key in data.files:
+        if not key.endswith('/names'):
+            continue
+        name = key[:-len('/names')]
+        if data[name + '/counts'].ndim != 1:
+            raise ValueError("cutflow `%s` in %s is not a single cutflow (saved from a family?)" % (name, filename))
+        cf = ArrayCutflow(max(1, len(data[key])))
+        for cut in data[key].tolist():
+            cf.index(cut)
+        n = len(cf.cut_names)
+        cf.counts[:n] = data[name + '/counts']
+        cf.sumw[:n] = data[name + '/sumw']
+        cf.sumw2[:n] = data[name + '/sumw2']
+        cutflows[name] = cf
+    data.close()
+    return cutflows
+
+''' Merge several dicts of {name: cutflow} into one dict of ArrayCutflows '''
+def merge_cutflow_dicts(dicts):
+    merged = {}
+    for cutflows in dicts:
+        for name, cf in cutflows.items():
+            try:
+                merged[name].merge(cf)
+            except KeyError:
+                merged[name] = ArrayCutflow()
+                merged[name].merge(cf)
+    return merged
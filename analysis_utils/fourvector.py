@@ -0,0 +1,157 @@
+'''
+ Vectorized four-vectors, as a numpy-backed replacement for building
+ one TLorentzVector per object.
+
+ A FourVectorArray holds the (px, py, pz, E) components as arrays of
+ any (common) shape, e.g. all the jets in an event, or the leading
+ muon in each event of a batch. All the usual kinematic quantities are
+ available as arrays:
+
+     jets = FourVectorArray.from_ptetaphim(pt, eta, phi, m)
+     print jets.pt, jets.eta, jets.E
+
+     # all pairs of jets: (n, n) arrays
+     mjj = jets.pair_sums().m
+
+     # all-pairs delta R matrix between two sets of objects
+     dr = delta_r(electrons, jets)
+
+ delta_r() and remove_overlaps() only need objects with `eta` and `phi`
+ attributes, so they also work on DPDCollections and on plain lists of
+ DPDObjects.
+'''
+
+import numpy as np
+
+class FourVectorArray(object):
+
+    def __init__(self, px, py, pz, E):
+        self.px = np.asarray(px, dtype=float)
+        self.py = np.asarray(py, dtype=float)
+        self.pz = np.asarray(pz, dtype=float)
+        self.E = np.asarray(E, dtype=float)
+
+    @staticmethod
+    def from_ptetaphim(pt, eta, phi, m):
+        pt = np.asarray(pt, dtype=float)
+        px = pt * np.cos(phi)
+        py = pt * np.sin(phi)
+        pz = pt * np.sinh(eta)
+        E = np.sqrt(px**2 + py**2 + pz**2 + np.asarray(m, dtype=float)**2)
+        return FourVectorArray(px, py, pz, E)
+
+    @staticmethod
+    def from_ptetaphie(pt, eta, phi, E):
+        pt = np.asarray(pt, dtype=float)
+        return FourVectorArray(pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta), E)
+
+    ''' Concatenate several FourVectorArrays (1-d) into one '''
+    @staticmethod
+    def concatenate(vectors):
+        return FourVectorArray(*[np.concatenate([getattr(v, c) for v in vectors])
+                                 for c in ('px', 'py', 'pz', 'E')])
+
+    @property
+    def pt(self):
+        return np.hypot(self.px, self.py)
+
+    @property
+    def p(self):
+        return np.sqrt(self.px**2 + self.py**2 + self.pz**2)
+
+    @property
+    def eta(self):
+        # NB: like TLorentzVector, return a large value along the beam axis
+        pt = self.pt
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eta = np.arcsinh(self.pz / pt)
+        return np.where(pt > 0, eta, np.sign(self.pz) * 10e10)
+
+    @property
+    def phi(self):
+        return np.arctan2(self.py, self.px)
+
+    @property
+    def m2(self):
+        return self.E**2 - self.px**2 - self.py**2 - self.pz**2
+
+    @property
+    def m(self):
+        # same convention as TLorentzVector::M() for spacelike vectors
+        m2 = self.m2
+        return np.sign(m2) * np.sqrt(np.abs(m2))
+
+    def __len__(self):
+        return len(self.px)
+
+    def __getitem__(self, key):
+        return FourVectorArray(self.px[key], self.py[key], self.pz[key], self.E[key])
+
+    def __add__(self, other):
+        return FourVectorArray(self.px + other.px, self.py + other.py,
+                               self.pz + other.pz, self.E + other.E)
+
+    ''' Sum of the vectors along the given axis (e.g. the total four-momentum) '''
+    def sum(self, axis=0):
+        return FourVectorArray(self.px.sum(axis), self.py.sum(axis),
+                               self.pz.sum(axis), self.E.sum(axis))
+
+    '''
+     All pairwise sums between the vectors of this (1-d) array and `other`
+     (by default, this array itself), as an (n, m) array. The invariant
+     masses of all pairs are then simply pair_sums().m
+    '''
+    def pair_sums(self, other=None):
+        if other is None:
+            other = self
+        return FourVectorArray(*[np.add.outer(getattr(self, c), getattr(other, c))
+                                 for c in ('px', 'py', 'pz', 'E')])
+
+    def delta_r(self, other):
+        return delta_r(self, other)
+
+
+''' Wrap azimuthal angles into [-pi, pi) '''
+def wrap_phi(phi):
+    return (np.asarray(phi) + np.pi) % (2 * np.pi) - np.pi
+
+''' Difference of two azimuthal angles, wrapped into [-pi, pi) '''
+def delta_phi(phi1, phi2):
+    return wrap_phi(np.subtract(phi1, phi2))
+
+def _eta_phi(objects):
+    try:
+        return np.asarray(objects.eta, dtype=float), np.asarray(objects.phi, dtype=float)
+    except AttributeError:
+        # a list of objects
+        return (np.array([o.eta for o in objects], dtype=float),
+                np.array([o.phi for o in objects], dtype=float))
+
+'''
+ The (n, m) matrix of delta R = sqrt(deta^2 + dphi^2) between all
+ pairs of objects in `a` and `b`.
+'''
+def delta_r(a, b):
+    eta_a, phi_a = _eta_phi(a)
+    eta_b, phi_b = _eta_phi(b)
+    deta = np.subtract.outer(eta_a, eta_b)
+    dphi = wrap_phi(np.subtract.outer(phi_a, phi_b))
+    return np.sqrt(deta**2 + dphi**2)
+
+''' Boolean mask of the objects which are not within dr of any of `others` '''
+def overlap_mask(objects, others, dr):
+    if len(others) == 0:
+        return np.ones(len(objects), dtype=bool)
+    if len(objects) == 0:
+        return np.zeros(0, dtype=bool)
+    return (delta_r(objects, others) >= dr).all(axis=1)
+
+'''
+ Remove the objects which are within dr of any of `others`. Collections
+ and arrays are masked directly, lists are filtered into a new list.
+'''
+def remove_overlaps(objects, others, dr):
+    mask = overlap_mask(objects, others, dr)
+    if isinstance(objects, (list, tuple)):
+        return [o for o, keep in zip(objects, mask) if keep]
+    return objects[mask]
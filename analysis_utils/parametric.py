@@ -0,0 +1,156 @@
+'''
+ A family of parametric variations (e.g. a scan over the width of a
+ systematic smearing), evaluated as a single variation with a leading
+ "member" axis. Instead of N variations running the process function N
+ times per entry, the family runs it once, and its calculables compute
+ the values for all members at once, as arrays with one row per member:
+
+     class METScan(ParametricVariation):
+         def _get_met_smeared(self):
+             # shape (N,) per entry, or (N, batch size) in batched mode
+             return self.met_et + self.param('met_width') * ...
+
+     scan = METScan({'met_width': [5, 10, 20, 40]}, process_fn=cutflow,
+                    name='met scan')
+     run(input_tree, nominal, [scan])
+
+ Cuts are applied to per-member masks: cut expressions are boolean arrays
+ over the members (broadcast against the entries of the batch in batched
+ mode), and the family's FamilyCutflow keeps a count vector per cut.
+ cut_if()/passes_cut() only reject the entry once no member is left.
+
+ Calculables which don't depend on the parameters may still be deferred
+ to the nominal variation as usual; their values simply broadcast against
+ the per-member ones.
+
+ Output is still written per member: the drivers' accept_entry() and
+ accept_batch() calls are turned into accept_member(k) / reject_member(k)
+ for each member k, which subclasses override, e.g. to fill one output
+ tree per member (returned by get_output_trees()).
+'''
+
+from variation import AnalysisVariation
+from cutflow import FamilyCutflow
+from _lazy import lazy_import
+
+np = lazy_import('numpy')
+
+class ParametricVariation(AnalysisVariation):
+
+    '''
+     `params` is a dict of {parameter name: sequence of values}, with one
+     value per member; all sequences must have the same length. The
+     members are named `member_names` if given, otherwise after the
+     family's name and their parameter values.
+    '''
+    def __init__(self, params, source=None, process_fn=None, name='Variation', fallback=None, member_names=None, **kwargs):
+        AnalysisVariation.__init__(self, source, process_fn, name, fallback, **kwargs)
+
+        lengths = set(len(values) for values in params.values())
+        if len(lengths) != 1:
+            raise ValueError("the parameters of `%s` need the same (non-zero) number of values" % name)
+        self.n_members = lengths.pop()
+        self._params = dict((k, np.asarray(values)) for k, values in params.items())
+        self._config = sorted(self._config + [(k, tuple(values)) for k, values in params.items()])
+
+        if member_names is None:
+            member_names = ['%s %s' % (name, ','.join('%s=%s' % (k, self._params[k][i]) for k in sorted(params)))
+                            for i in xrange(self.n_members)]
+        if len(member_names) != self.n_members:
+            raise ValueError("expected %d member names for `%s`" % (self.n_members, name))
+        self.member_names = list(member_names)
+
+        # which members have survived all cuts so far; shape (N,) in
+        # event-at-a-time mode, and (N, batch size) in batched mode
+        self._member_mask = np.ones(self.n_members, dtype=bool)
+
+        self._cutflow = FamilyCutflow(self.n_members)
+
+    '''
+     The values of the named parameter, one per member, shaped to
+     broadcast against per-entry values: (N,) in event-at-a-time mode,
+     and (N, 1) in batched mode.
+    '''
+    def param(self, name):
+        values = self._params[name]
+        if self._mask is not None:
+            return values[:, np.newaxis]
+        return values
+
+    def get_member_mask(self):
+        return self._member_mask
+
+    def get_cutflows(self):
+        return dict((name, self._cutflow.member(k)) for k, name in enumerate(self.member_names))
+
+    def reset(self):
+        AnalysisVariation.reset(self)
+        if self._mask is None:
+            self._member_mask = np.ones(self.n_members, dtype=bool)
+
+    ''' In batched mode, the batch mask applies to every member '''
+    def set_mask(self, mask):
+        self._mask = mask
+        if mask is None:
+            self._member_mask = np.ones(self.n_members, dtype=bool)
+        else:
+            self._member_mask = np.repeat(mask[np.newaxis, :], self.n_members, axis=0)
+
+    ''' The entries of the batch which some member has passed '''
+    def get_mask(self):
+        if self._mask is None:
+            return None
+        return self._member_mask.any(axis=0)
+
+    '''
+     `expr` flags the members (and in batched mode, the entries) which
+     fail the cut; it is broadcast against the member mask, so it can be
+     a scalar, an array over the members, or in batched mode, an array
+     over the batch or over both.
+    '''
+    def passes_cut(self, expr, cutname):
+        if self._cutflow.cut_times is not None:
+            self._cutflow.record_time(cutname)
+        mask = self._member_mask
+        np.logical_and(mask, np.logical_not(expr), out=mask)
+        self._cutflow.add_batch(cutname, mask)
+        return bool(mask.any())
+
+    def accept_entry(self):
+        mask = self._member_mask
+        for k in xrange(self.n_members):
+            if mask[k]:
+                self.accept_member(k)
+            else:
+                self.reject_member(k)
+
+    def reject_entry(self):
+        for k in xrange(self.n_members):
+            self.reject_member(k)
+
+    def accept_batch(self, keep):
+        mask = self._member_mask
+        for i in keep.nonzero()[0]:
+            self.batch_entry = i
+            for k in xrange(self.n_members):
+                if mask[k, i]:
+                    self.accept_member(k)
+                else:
+                    self.reject_member(k)
+
+    '''
+     Called for each member k which passed the current entry (in batched
+     mode, self.batch_entry is its index in the batch). The per-member
+     values of the calculables are in row k of their arrays.
+    '''
+    def accept_member(self, k):
+        if not self._warn_once:
+            print "WARNING! Base class accept_member() invoked for variation `%s`!" % self._name
+            self._warn_once = True
+
+    '''
+     Called for each member k which did not pass the current entry, when
+     some other member (or variation) did.
+    '''
+    def reject_member(self, k):
+        pass
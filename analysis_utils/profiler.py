@@ -0,0 +1,123 @@
+'''
+ Opt-in profiling of AnalysisVariation calculables.
+
+ A CalculableProfiler is attached to variations as their observer (see
+ AnalysisVariation.set_observer), and records for every calculable of
+ every variation:
+   calls    -- number of times the calculable was actually computed
+   hits     -- number of times a cached value was returned
+   deferred -- number of times it deferred to the fallback (CalculationFallback)
+   shared   -- number of times the value was taken from an equivalent variation
+   total    -- cumulative wall time, including calculables it depends on
+   self     -- wall time excluding other calculables
+
+ The easiest way to use it is through the driver, which will also time
+ each cut of the cutflows and print a report at the end:
+   run(input_tree, nominal, variations, profile=True)
+
+ When no profiler is attached, the only overhead is a single attribute
+ check per calculable evaluation.
+'''
+
+import time
+
+class CalculableProfiler(object):
+
+    def __init__(self):
+        # (variation name, calculable) -> stats dict
+        self.stats = {}
+        # stack of [key, start time, time spent in children]
+        self._stack = []
+
+    def _stats(self, key):
+        try:
+            return self.stats[key]
+        except KeyError:
+            s = {'calls': 0, 'hits': 0, 'deferred': 0, 'shared': 0, 'failed': 0,
+                 'total': 0., 'self': 0.}
+            self.stats[key] = s
+            return s
+
+    ##############################################
+    ## Observer interface (see AnalysisVariation) ##
+    ##############################################
+
+    def read_source(self, v, attr):
+        pass
+
+    def defer_point(self, v):
+        pass
+
+    def cache_hit(self, v, attr):
+        self._stats((v._name, attr))['hits'] += 1
+
+    def begin(self, v, attr):
+        self._stack.append([(v._name, attr), time.time(), 0.])
+
+    def end(self, v, attr, status):
+        key, tstart, tchildren = self._stack.pop()
+        elapsed = time.time() - tstart
+        s = self._stats(key)
+        s['total'] += elapsed
+        s['self'] += elapsed - tchildren
+        if status == 'computed':
+            s['calls'] += 1
+        else:
+            s[status] += 1
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    ''' Print the statistics, sorted by self time. If a list of variations is
+        given, also print the time spent in each of their cuts. '''
+    def print_report(self, variations=[], limit=None):
+        items = sorted(self.stats.items(), key=lambda x: x[1]['self'], reverse=True)
+        if limit:
+            items = items[:limit]
+
+        if len(items) == 0:
+            print "(no records)"
+        else:
+            names = ['%s.%s' % k for k, s in items]
+            name_width = max(map(len, names))
+            print "%s  %8s %8s %8s %8s %10s %10s" % (' ' * name_width, 'calls', 'hits',
+                                                     'deferred', 'shared', 'total [s]', 'self [s]')
+            for name, (k, s) in zip(names, items):
+                padding = name_width - len(name)
+                print "%s:%s %8d %8d %8d %8d %10.4f %10.4f" % (name, ' ' * padding, s['calls'], s['hits'],
+                                                               s['deferred'], s['shared'], s['total'], s['self'])
+
+        for v in variations:
+            if v._cutflow.cut_times is None:
+                continue
+            print
+            print "==== Cut timing: %s ====" % v._name
+            v._cutflow.print_timing()
+
+'''
+ Forwards the observer interface to several observers, e.g. to record the
+ calculable graph and profile at the same time.
+'''
+class ObserverGroup(object):
+
+    def __init__(self, observers):
+        self.observers = observers
+
+    def read_source(self, v, attr):
+        for o in self.observers:
+            o.read_source(v, attr)
+
+    def cache_hit(self, v, attr):
+        for o in self.observers:
+            o.cache_hit(v, attr)
+
+    def defer_point(self, v):
+        for o in self.observers:
+            o.defer_point(v)
+
+    def begin(self, v, attr):
+        for o in self.observers:
+            o.begin(v, attr)
+
+    def end(self, v, attr, status):
+        for o in self.observers:
+            o.end(v, attr, status)
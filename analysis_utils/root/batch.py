@@ -0,0 +1,99 @@
+'''
+ Helpers to read chunks of entries from a TTree/TChain into
+ numpy arrays, for use with the batched (columnar) event loop
+ in analysis_utils.variation_loop.run_batched().
+
+ If root_numpy is available, it is used to read each branch in
+ bulk. Otherwise we fall back to a (slow) entry-by-entry loop,
+ which reads only the requested branch.
+
+ Scalar branches become 1-d arrays with one element per entry.
+ Vector branches become 1-d arrays of dtype=object, where each
+ element is itself a numpy array holding that entry's values.
+'''
+
+import time
+import numpy as np
+
+try:
+    import root_numpy
+except ImportError:
+    root_numpy = None
+
+
+def read_branch(tree, bname, start, stop):
+    if root_numpy is not None:
+        return root_numpy.tree2array(tree, branches=[bname],
+                                     start=start, stop=stop)[bname]
+
+    values = []
+    for i in xrange(start, stop):
+        # NB: for a TChain, LoadTree() may switch to a new file, so
+        # we have to look up the branch again for every entry.
+        local_entry = tree.LoadTree(i)
+        tree.GetBranch(bname).GetEntry(local_entry)
+        values.append(copy_value(getattr(tree, bname)))
+    return to_array(values)
+
+
+''' Copy a value returned by PyROOT. Scalars are returned as-is,
+    while vectors are copied into numpy arrays (the underlying
+    buffer is reused by ROOT for the next entry!) '''
+def copy_value(value):
+    if hasattr(value, 'size') and hasattr(value, 'push_back'):
+        return np.array(list(value))
+    return value
+
+
+''' Pack a list of per-entry values into a single array. Jagged
+    values are stored as an array of arrays. '''
+def to_array(values):
+    if len(values) > 0 and isinstance(values[0], np.ndarray):
+        arr = np.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            arr[i] = v
+        return arr
+    return np.array(values)
+
+
+'''
+ Drop-in replacement for the TTree `source` of an AnalysisVariation,
+ covering entries [start, stop). Branches are read lazily the first
+ time they are requested, and cached for the lifetime of the batch.
+ `columns` may hold branches which have already been read (e.g. by a
+ prefetch.Prefetcher), as a dict of {branch name: array}. read_time is
+ the time spent reading branches on demand.
+'''
+class BatchSource(object):
+
+    def __init__(self, tree, start, stop, columns=None):
+        self._tree = tree
+        self.start = start
+        self.stop = stop
+        self.read_time = 0.
+        if columns:
+            self.__dict__.update(columns)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def entry_numbers(self):
+        return np.arange(self.start, self.stop)
+
+    def get_tree(self):
+        return self._tree
+
+    ''' Names of the branches read (or given) so far '''
+    def branches_read(self):
+        return [b for b in self.__dict__ if not b in ('_tree', 'start', 'stop', 'read_time')]
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if not self._tree.GetBranch(attr):
+            raise AttributeError("No branch named '%s'" % attr)
+        t0 = time.time()
+        arr = read_branch(self._tree, attr, self.start, self.stop)
+        self.read_time += time.time() - t0
+        setattr(self, attr, arr)
+        return arr
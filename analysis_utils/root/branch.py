@@ -1,8 +1,14 @@
-import ROOT as r
 import re
+from analysis_utils._lazy import lazy_import
+
+r = lazy_import('ROOT')
 
 
 def match_branches_from_file(selection_files, tree):
+    return match_branches(load_selections(selection_files), tree)
+
+''' Read the selection lines from one or more selection files '''
+def load_selections(selection_files):
     # load regular expression from file
     if not type(selection_files) == list:
         selection_files = [selection_files]
@@ -10,27 +16,206 @@ def match_branches_from_file(selection_files, tree):
     selections = []
     for f in selection_files:
         selections.extend(open(f).readlines())
-    return match_branches(selections, tree)
+    return selections
 
+# characters which end the literal prefix of a regex
+_METACHARS = set('.^$*+?{}[]|()\\')
 
-def match_branches(selections, tree):
+# python 2's re module supports at most 100 groups per pattern
+_MAX_GROUPS = 99
+
+''' Split a regex into its literal prefix and the remainder. Escaped
+    punctuation (as produced by re.escape) counts as literal. '''
+def literal_prefix(pattern):
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i+1].isalnum():
+            prefix.append(pattern[i+1])
+            i += 2
+        elif c in _METACHARS:
+            break
+        else:
+            prefix.append(c)
+            i += 1
+    return ''.join(prefix), pattern[i:]
+
+'''
+ A branch selection compiled from selection lines (see load_selections).
+ Every non-comment line is a regex which is matched against the start
+ of the branch names; a line starting with ! excludes the branches it
+ matches. A branch is selected if it matches at least one include rule
+ (or if there are no include rules at all) and none of the exclude rules.
+
+ Instead of trying each regex in turn, rules which are plain literals
+ (e.g. "jet_" or "^el_pt$", as written by save_read_set) are looked up
+ in a prefix index, and all the other rules are merged into a few large
+ alternations. Results are memoized per tree schema, so matching many
+ files with the same branches is essentially free.
+
+     sel = BranchSelection.from_files('branches.txt')
+     sel.match(tree)        # list of selected branch names
+     sel.match_rules(tree)  # {branch name: include rule which selected it}
+'''
+class BranchSelection(object):
+
+    def __init__(self, selections):
+        if not type(selections) == list:
+            selections = [selections]
+
+        self.rules = []
+        self.excludes = []
+        for line in selections:
+            # ditch whitespace (regex should use $^ delims if necessary)
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue  # ditch blank lines and comments
+            if line.startswith('!'):
+                self.excludes.append(line[1:].strip())
+            else:
+                self.rules.append(line)
+
+        self._includes = _RuleSet(self.rules)
+        self._exclude_set = _RuleSet(self.excludes)
+        # tuple of branch names -> {branch name: rule}
+        self._memo = {}
+
+    @staticmethod
+    def from_files(selection_files):
+        return BranchSelection(load_selections(selection_files))
+
+    ''' The include rule selecting the named branch, or None if it is not
+        selected ('*' if selected without any include rules). '''
+    def rule_for(self, name):
+        if self._exclude_set.first_match(name) is not None:
+            return None
+        if len(self.rules) == 0:
+            return '*'
+        index = self._includes.first_match(name)
+        if index is None:
+            return None
+        return self.rules[index]
+
+    ''' {branch name: rule} for the selected branches of the tree (or of
+        a list of branch names) '''
+    def match_rules(self, tree):
+        names = branch_names(tree)
+        key = tuple(names)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        matched = {}
+        for name in names:
+            rule = self.rule_for(name)
+            if rule is not None:
+                matched[name] = rule
+        self._memo[key] = matched
+        return matched
+
+    ''' The selected branch names, in the order of the tree '''
+    def match(self, tree):
+        names = branch_names(tree)
+        matched = self.match_rules(names)
+        return [b for b in names if b in matched]
+
+
+''' An ordered list of regexes, which reports the index of the first one
+    matching a name '''
+class _RuleSet(object):
+
+    def __init__(self, patterns):
+        # literal rules: exact name -> index, and prefix -> index
+        self.exact = {}
+        self.prefixes = {}
+        # list of (regex, index); index is None for merged alternations,
+        # whose group names encode the index of each alternative.
+        self.regexs = []
+
+        alternation = []
+        for index, pattern in enumerate(patterns):
+            prefix, rest = literal_prefix(pattern[1:] if pattern.startswith('^') else pattern)
+            if rest == '':
+                self.prefixes.setdefault(prefix, index)
+                continue
+            if rest == '$':
+                self.exact.setdefault(prefix, index)
+                continue
+
+            regex = re.compile(pattern)
+            if regex.groups > 0 or pattern.startswith('(?'):
+                # may use backreferences or global flags; keep it separate
+                self.regexs.append((regex, index))
+                continue
+            alternation.append((pattern, index))
+            if len(alternation) == _MAX_GROUPS:
+                self._add_alternation(alternation)
+                alternation = []
+        if alternation:
+            self._add_alternation(alternation)
+
+        self.prefix_lengths = sorted(set(len(p) for p in self.prefixes))
+
+    def _add_alternation(self, alternation):
+        regex = re.compile('|'.join('(?P<r%d>%s)' % (index, pattern) for pattern, index in alternation))
+        self.regexs.append((regex, None))
+
+    def first_match(self, name):
+        best = self.exact.get(name)
+        for l in self.prefix_lengths:
+            if l > len(name):
+                break
+            index = self.prefixes.get(name[:l])
+            if index is not None and (best is None or index < best):
+                best = index
+        for regex, index in self.regexs:
+            if best is not None and index is not None and index > best:
+                continue
+            m = regex.match(name)
+            if m is None:
+                continue
+            if index is None:
+                # NB: alternatives are tried in order, so this is the
+                # first rule of the alternation which matches
+                index = int(m.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+        return best
+
+
+def branch_names(tree):
+    if type(tree) in (list, tuple):
+        return tree
+    return [b.GetName() for b in tree.GetListOfBranches()]
+
+# tuple of selection lines -> BranchSelection
+_compiled = {}
+
+''' Compile selection lines into a BranchSelection, e.g. to match the
+    same selection against many trees with match_compiled() '''
+def compile_selections(selections):
     if not type(selections) == list:
         selections = [selections]
+    key = tuple(selections)
+    try:
+        return _compiled[key]
+    except KeyError:
+        sel = BranchSelection(selections)
+        _compiled[key] = sel
+        return sel
+
 
-    regexs = []
-    for line in selections:
-        # ditch whitespace (regex should use $^ delims if necessary)
-        line = line.strip()
-        if line == '' or line.startswith('#'):
-            continue  # ditch blank lines and comments
-        regexs.append(re.compile(line))
+def match_branches(selections, tree):
+    return match_compiled(compile_selections(selections), tree)
 
-    all_branches = [b.GetName() for b in tree.GetListOfBranches()]
+def match_compiled(selection, tree):
+    return selection.match(tree)
 
-    # keep only branches that match at least one of the selection strings
-    matched_branches = filter(
-        lambda b: any((regex.match(b) is not None for regex in regexs)), all_branches)
-    return matched_branches
+''' Like match_branches(), but returns {branch name: rule} with the
+    include rule which selected each branch '''
+def match_branches_with_rules(selections, tree):
+    return compile_selections(selections).match_rules(tree)
 
 def set_branch_status_from_file(selection_files, tree, status):
     matched_branches = match_branches_from_file(selection_files, tree)
@@ -38,6 +223,155 @@ def set_branch_status_from_file(selection_files, tree, status):
         tree.SetBranchStatus(b, status)
 
 def set_branch_status(selections, tree, status):
-    matched_branches = match_branches(seleections, tree)
+    matched_branches = match_branches(selections, tree)
     for b in matched_branches:
         tree.SetBranchStatus(b, status)
+
+'''
+ Disable all branches of the tree except for `branches` (e.g. the read-set
+ recorded by profile_tree.AccessRecorder), and set up a TTreeCache of
+ cache_size bytes for them. Set cache_size=0 to skip the cache.
+'''
+def prune_branches(tree, branches, cache_size=30*1024*1024):
+    tree.SetBranchStatus('*', False)
+    for b in branches:
+        tree.SetBranchStatus(b, True)
+
+    if cache_size > 0:
+        tree.SetCacheSize(cache_size)
+        for b in branches:
+            tree.AddBranchToCache(b, True)
+        # we already know which branches will be read
+        tree.StopCacheLearningPhase()
+
+''' Save a list of branch names in the selection file format (one
+    anchored regex per line), so it can be used e.g. by filter_branches.py '''
+def save_read_set(filename, branches, comment=None):
+    f = open(filename, 'w')
+    if comment:
+        f.write('# %s\n' % comment)
+    for b in branches:
+        f.write('^%s$\n' % re.escape(b))
+    f.close()
+
+''' Load a read-set (or any selection file) and match it against the tree '''
+def load_read_set(filename, tree):
+    return match_branches_from_file(filename, tree)
+
+''' Number of baskets written for a branch, including its sub-branches '''
+def count_baskets(b):
+    return b.GetWriteBasket() + sum(count_baskets(sub) for sub in b.GetListOfBranches())
+
+'''
+ Per-branch storage cost of a tree (summed over all the trees of a
+ TChain), as a list of dicts with keys:
+   name, zip_bytes (compressed), tot_bytes (uncompressed), ratio, baskets
+'''
+def branch_storage(tree):
+    storage = {}
+    order = []
+    def add_tree(t):
+        for b in t.GetListOfBranches():
+            name = b.GetName()
+            s = storage.get(name)
+            if s is None:
+                s = {'name': name, 'zip_bytes': 0, 'tot_bytes': 0, 'baskets': 0}
+                storage[name] = s
+                order.append(name)
+            s['zip_bytes'] += b.GetZipBytes('*')
+            s['tot_bytes'] += b.GetTotBytes('*')
+            s['baskets'] += count_baskets(b)
+
+    if isinstance(tree, r.TChain):
+        # NB: the chain deletes its current tree when it loads the next
+        # file, so the sizes are summed before moving on
+        for i in xrange(tree.GetNtrees()):
+            tree.LoadTree(tree.GetTreeOffset()[i])
+            add_tree(tree.GetTree())
+    else:
+        add_tree(tree)
+
+    result = [storage[name] for name in order]
+    for s in result:
+        s['ratio'] = float(s['tot_bytes']) / s['zip_bytes'] if s['zip_bytes'] else 0.
+    return result
+
+''' The DPD prefix of a branch name, e.g. el_ for el_pt '''
+def dpd_prefix(name):
+    i = name.find('_')
+    if i < 0:
+        return name
+    return name[:i+1]
+
+''' The name of the DPD group of a branch, e.g. el_* for el_pt '''
+def dpd_group(name):
+    prefix = dpd_prefix(name)
+    if prefix == name:
+        return name
+    return prefix + '*'
+
+''' Sum the storage cost of the branches by DPD group (or any other key function) '''
+def group_storage(storage, key=dpd_group):
+    groups = {}
+    order = []
+    for s in storage:
+        k = key(s['name'])
+        g = groups.get(k)
+        if g is None:
+            g = {'name': k, 'zip_bytes': 0, 'tot_bytes': 0, 'baskets': 0, 'branches': 0}
+            groups[k] = g
+            order.append(k)
+        g['branches'] += 1
+        for field in ('zip_bytes', 'tot_bytes', 'baskets'):
+            if s.get(field) is None or g[field] is None:
+                g[field] = None
+            else:
+                g[field] += s[field]
+
+    result = [groups[k] for k in order]
+    for g in result:
+        g['ratio'] = float(g['tot_bytes']) / g['zip_bytes'] if g['zip_bytes'] else 0.
+    return result
+
+'''
+ Rank the branches by the compressed bytes stored per recorded use,
+ given an access list (branch name -> number of reads, as recorded by
+ profile_tree.ProfileChain or AccessRecorder). Branches which were never
+ read come first, ordered by their size, since they are the cheapest to
+ cut. Adds a `uses` and `bytes_per_use` key to each entry.
+'''
+def rank_by_cost(storage, access_list):
+    ranked = []
+    for s in storage:
+        s = dict(s)
+        s['uses'] = access_list.get(s['name'], 0)
+        s['bytes_per_use'] = float(s['zip_bytes']) / s['uses'] if s['uses'] else None
+        ranked.append(s)
+    # unused branches first (largest first), then by decreasing bytes per use
+    ranked.sort(key=lambda s: (s['uses'] > 0, -(s['bytes_per_use'] or s['zip_bytes'])))
+    return ranked
+
+def print_storage_report(storage, limit=None):
+    if len(storage) == 0:
+        print "(no records)"
+        return
+
+    if limit:
+        storage = storage[:limit]
+    has_uses = 'uses' in storage[0]
+    name_width = max(len(s['name']) for s in storage)
+    header = "%s  %12s %12s %6s %8s" % (' ' * name_width, 'zip [B]', 'tot [B]', 'ratio', 'baskets')
+    if has_uses:
+        header += " %10s %12s" % ('uses', 'B/use')
+    print header
+    for s in storage:
+        padding = name_width - len(s['name'])
+        baskets = '%8d' % s['baskets'] if s['baskets'] is not None else '%8s' % '-'
+        line = "%s:%s %12d %12d %6.2f %s" % (s['name'], ' ' * padding, s['zip_bytes'],
+                                             s['tot_bytes'], s['ratio'], baskets)
+        if has_uses:
+            if s['uses']:
+                line += " %10d %12.1f" % (s['uses'], s['bytes_per_use'])
+            else:
+                line += " %10d %12s" % (0, 'unused')
+        print line
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 
-import ROOT as r
+import numpy as np
+
+from analysis_utils._lazy import lazy_import
+from analysis_utils.fourvector import FourVectorArray
+
+# NB: ROOT is only needed for build_tlv()
+r = lazy_import('ROOT')
 
 '''
 DPDObject is a class that helps read/write objects from
@@ -65,6 +71,16 @@ class DPDObject:
         o._sharecache = self._sharecache
         return o
 
+    ''' Copy-on-write: return a copy of this object, which shares everything
+    but the given attributes with it, e.g. for a smeared variation of a
+    shared nominal object (see get_shared_objects):
+        smeared = mu.override(pt=mu.pt * 1.01)
+    '''
+    def override(self, **attrs):
+        o = self.__copy__()
+        o.__dict__.update(attrs)
+        return o
+
     def serialize(self):
         branches = [b.GetName()[len(self._prefix) + 1:] for b in self._tree.GetListOfBranches()
                     if b.GetName().startswith(self._prefix) and b.GetName() != '%s_n' % self._prefix]
@@ -74,16 +90,208 @@ class DPDObject:
         return dict(datasane)
 
 
+'''
+DPDCollection is a vectorized (structure-of-arrays) view of all the
+objects with a given prefix. Each requested <prefix>_<attr> branch is
+read from the tree only once, into a numpy array, which is shared by
+all collections derived from it. Attributes of a collection are arrays:
+
+    jets = DPDCollection(tree, 'jet')
+    hard_jets = jets[jets.pt > 45]
+    central_hard_jets = hard_jets[abs(hard_jets.eta) < 2.5]
+
+Collections can also be indexed, sliced, and iterated over like a list
+of DPDObjects; the elements are DPDObject-compatible views which read
+their attributes from the collection's arrays. The element view for a
+given object is the same for all derived collections, so attributes set
+on it (e.g. by build_tlv) are visible from all of them.
+
+override() returns a copy-on-write view, in which only the given
+attributes are replaced; all other columns are still shared:
+
+    smeared = jets.override(pt=jets.pt * 1.01)
+'''
+class DPDCollection(object):
+
+    def __init__(self, tree, prefix, index=None, shared=None, overrides=None):
+        self._tree = tree
+        self._prefix = prefix
+
+        # full-length columns which replace the shared ones in this
+        # collection (and those derived from it); see override()
+        if overrides is None:
+            overrides = {}
+        self._overrides = overrides
+
+        # NB: this is _shared_ by all collections derived from this one
+        # (by masking, slicing, etc). it holds the full-length columns,
+        # and the element views.
+        if shared is None:
+            shared = {'columns': {}, 'items': {}}
+        self._shared = shared
+
+        if index is None:
+            index = np.arange(getattr(tree, '%s_n' % prefix))
+        self._index = index
+
+    def get_tree(self):
+        return self._tree
+    def get_indices(self):
+        return self._index
+
+    ''' Return the full (unmasked) array for the given attribute '''
+    def column(self, attr):
+        try:
+            return self._overrides[attr]
+        except KeyError:
+            pass
+        columns = self._shared['columns']
+        try:
+            return columns[attr]
+        except KeyError:
+            values = np.array(list(getattr(self._tree, '%s_%s' % (self._prefix, attr))))
+            columns[attr] = values
+            return values
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        values = self.column(attr)[self._index]
+        setattr(self, attr, values)
+        return values
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.item(self._index[key])
+        # slice, boolean mask or array of positions
+        return DPDCollection(self._tree, self._prefix, self._index[key], self._shared, self._overrides)
+
+    def __iter__(self):
+        for idx in self._index:
+            yield self.item(idx)
+
+    ''' Return the element view for object number idx in the tree '''
+    def item(self, idx):
+        items = self._shared['items']
+        try:
+            return items[idx]
+        except KeyError:
+            obj = DPDCollectionItem(self, idx)
+            items[idx] = obj
+            return obj
+
+    ''' Build a FourVectorArray from the pt, eta, phi, m attributes (the
+        vectorized equivalent of build_tlv) '''
+    def four_vectors(self, mass=None):
+        if mass is None:
+            mass = self.m
+        return FourVectorArray.from_ptetaphim(self.pt, self.eta, self.phi, mass)
+
+    ''' Same as coll[mask], but the mask may be any sequence of booleans '''
+    def select(self, mask):
+        return self[np.asarray(mask, dtype=bool)]
+
+    ''' Copy-on-write: return a view of the same objects, with the given
+        attributes replaced by the given values (one per object in this
+        collection). Only the overridden columns are copied; the others,
+        and the tree reads behind them, are shared with this collection. '''
+    def override(self, **attrs):
+        overrides = dict(self._overrides)
+        for attr, values in attrs.items():
+            values = np.asarray(values)
+            column = self.column(attr)
+            column = column.astype(np.result_type(column, values))
+            column[self._index] = values
+            overrides[attr] = column
+        # NB: the element views cache their attributes, so they can't be shared
+        shared = {'columns': self._shared['columns'], 'items': {}}
+        return DPDCollection(self._tree, self._prefix, self._index, shared, overrides)
+
+
+''' Element view of a DPDCollection '''
+class DPDCollectionItem(DPDObject):
+
+    def __init__(self, collection, idx):
+        DPDObject.__init__(self, collection._tree, collection._prefix, int(idx))
+        self._collection = collection
+
+    def __getattr__(self, attr):
+        try:
+            return self._sharecache[attr]
+        except KeyError:
+            answer = self._collection.column(attr)[self.idx]
+            self._sharecache[attr] = answer
+            return answer
+
+    def __copy__(self):
+        o = DPDCollectionItem(self._collection, self.idx)
+        o._sharecache = self._sharecache
+        return o
+
+
+''' By default, fetch_objects() and get_objects() build lists of DPDObjects.
+    Call use_collections() to have them return DPDCollections instead. '''
+VECTORIZED = False
+
+def use_collections(enable=True):
+    global VECTORIZED
+    VECTORIZED = enable
+
 ''' conveneince methods to generate/load lists of D3PD objects based on
     their branch prefix '''
-def fetch_objects(tree, prefix):
+def fetch_objects(tree, prefix, vectorized=None):
+    if vectorized is None:
+        vectorized = VECTORIZED
+    if vectorized:
+        for obj in DPDCollection(tree, prefix):
+            yield obj
+        return
+
     for i in xrange(getattr(tree, '%s_n' % prefix)):
         obj = DPDObject(tree, prefix, i)
         yield obj
 
-''' Same as above, but load the whole generator into a list '''
-def get_objects(tree, prefix):
-    return list(fetch_objects(tree, prefix))
+''' Same as above, but load the whole generator into a list (or, if
+    vectorized, return a DPDCollection) '''
+def get_objects(tree, prefix, vectorized=None):
+    if vectorized is None:
+        vectorized = VECTORIZED
+    if vectorized:
+        return DPDCollection(tree, prefix)
+    return list(fetch_objects(tree, prefix, False))
+
+''' Per-event cache for get_shared_objects(): (id(tree), prefix, vectorized) -> (entry, objects) '''
+_shared_objects = {}
+
+''' Same as get_objects(), but the objects are only built once per entry
+    of the tree, and shared by all callers; e.g. the nominal muons are read
+    once, however many variations use them. The shared objects must not be
+    modified in place; variations which change them should use override()
+    to get copy-on-write versions instead:
+
+        muons = get_shared_objects(self._source, 'mu')
+        smeared = [mu.override(pt=mu.pt * (1 + normal(0, 0.01))) for mu in muons]
+
+    The tree needs to provide GetReadEntry() (as TTree/TChain do) to tell
+    when to rebuild the objects; otherwise, nothing is shared. '''
+def get_shared_objects(tree, prefix, vectorized=None):
+    if vectorized is None:
+        vectorized = VECTORIZED
+    try:
+        entry = tree.GetReadEntry()
+    except AttributeError:
+        return get_objects(tree, prefix, vectorized)
+
+    key = (id(tree), prefix, vectorized)
+    cached = _shared_objects.get(key)
+    if cached is not None and cached[0] == entry:
+        return cached[1]
+    objects = get_objects(tree, prefix, vectorized)
+    _shared_objects[key] = (entry, objects)
+    return objects
 
 ''' Build a TLorentzVector from the pt,eta,phi,m attributes
     of the given object, and bind it to the object's
@@ -112,3 +320,21 @@ class met_object:
         self.phi = phi
         self.x = et*cos(phi)
         self.y = et*sin(phi)
+
+''' Array equivalent of tlv_particle; build (arrays of) particle
+    kinematics from a FourVectorArray. '''
+class particle_array:
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.pt = vectors.pt
+        self.eta = vectors.eta
+        self.phi = vectors.phi
+        self.m = vectors.m
+
+''' Array equivalent of met_object, e.g. for a whole batch of events. '''
+class met_array:
+    def __init__(self, et, phi):
+        self.et = np.asarray(et, dtype=float)
+        self.phi = np.asarray(phi, dtype=float)
+        self.x = self.et*np.cos(self.phi)
+        self.y = self.et*np.sin(self.phi)
@@ -0,0 +1,264 @@
+'''
+ Multi-process driver for variational analyses. The entry range of the
+ input TTree/TChain is split into contiguous shards, and each shard is
+ processed by variation_loop.run() in a separate (forked) worker process.
+
+ Each worker re-opens the input files, redirects the output trees of all
+ variations (see AnalysisVariation.get_output_trees) to its own partial
+ output file, and sends its cutflows back to the parent. The parent then
+ merges the cutflows into the original variation objects, and combines
+ the partial outputs (in entry order) into a single file.
+
+ Usage is the same as for variation_loop.run(), except that the output
+ file is managed by the driver:
+   from analysis_utils.root.parallel_loop import run_parallel
+   run_parallel(input_tree, 'output.root', nominal=nominal,
+                variations=variations, n_workers=8)
+
+ Since shards are contiguous and merged in order, the output does not
+ depend on the number of workers, provided that the analysis itself is
+ deterministic (i.e. don't draw from the global numpy.random state).
+
+ The branch read-set (see the read_set_file, read_set_cache and
+ learn_branches options of variation_loop.run()) is looked up once, in the
+ parent. If it is known, every worker prunes the input to it. Otherwise
+ only the first worker learns it and saves it to the file and/or cache,
+ while the other workers read all the branches.
+'''
+
+import os
+import Queue
+import multiprocessing
+import traceback
+import ROOT as r
+
+import analysis_utils.variation_loop as variation_loop
+from pytree import PyTree
+
+''' Split n_entries into (at most) n_shards contiguous [first, last) ranges '''
+def shard_ranges(n_entries, n_shards):
+    n_shards = max(1, min(n_shards, n_entries))
+    bounds = [n_entries * k // n_shards for k in xrange(n_shards + 1)]
+    return zip(bounds[:-1], bounds[1:])
+
+''' Return (tree name, list of file names) needed to re-open the input '''
+def get_input_files(input_tree):
+    if isinstance(input_tree, r.TChain):
+        return input_tree.GetName(), [f.GetTitle() for f in input_tree.GetListOfFiles()]
+    return input_tree.GetName(), [input_tree.GetCurrentFile().GetName()]
+
+def run_parallel(input_tree, output_file, nominal=None, variations=[], n_workers=None, silent=False, **kwargs):
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    all_variations = variation_loop.prepare_variations(input_tree, nominal, variations)
+    if len(all_variations) == 0:
+        print "Warning! No variations to process. Aborting..."
+        return
+
+    n_entries = input_tree.GetEntries()
+    entry_limit = kwargs.get('entry_limit', 0)
+    if entry_limit > 0:
+        n_entries = min(n_entries, entry_limit)
+
+    tree_name, file_names = get_input_files(input_tree)
+    disabled = [b.GetName() for b in input_tree.GetListOfBranches()
+                if not input_tree.GetBranchStatus(b.GetName())]
+
+    # options passed on to variation_loop.run() in the workers. NB: the
+    # workers are forked, so these need not be picklable. Checkpointing
+    # is not supported here: the workers write to partial files. Neither
+    # is telemetry, whose sinks (files, servers) can't be shared by the workers.
+    run_kwargs = dict((k, v) for k, v in kwargs.items()
+                      if not k in ('entry_limit', 'first_entry', 'last_entry', 'keep_partial', 'cutflow_file',
+                                   'checkpoint_file', 'checkpoint_every', 'checkpoint_seconds', 'telemetry'))
+    if kwargs.get('event_weight', None) is not None:
+        variation_loop.use_weighted_cutflows(all_variations)
+
+    learn_kwargs = dict((k, run_kwargs.pop(k)) for k in ('read_set_file', 'read_set_cache', 'learn_branches')
+                        if k in run_kwargs)
+    read_set = find_read_set(input_tree, all_variations, learn_kwargs)
+    if read_set is not None:
+        run_kwargs['read_set'] = read_set
+        learn_kwargs = {}
+
+    ranges = shard_ranges(n_entries, n_workers)
+    partial_files = ['%s.part%d' % (output_file, k) for k in xrange(len(ranges))]
+
+    results = multiprocessing.Queue()
+    workers = []
+    for k, (first, last) in enumerate(ranges):
+        worker_kwargs = dict(run_kwargs, **learn_kwargs) if k == 0 else run_kwargs
+        p = multiprocessing.Process(target=run_worker,
+                                    args=(k, first, last, tree_name, file_names, disabled,
+                                          partial_files[k], nominal, variations, silent, results,
+                                          worker_kwargs))
+        p.start()
+        workers.append(p)
+
+    cutflows = [None] * len(ranges)
+    errors = []
+    try:
+        for k, error, worker_cutflows in collect_results(results, workers):
+            if error:
+                errors.append('worker %d failed:\n%s' % (k, error))
+            cutflows[k] = worker_cutflows
+    except RuntimeError:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        raise
+    finally:
+        for p in workers:
+            p.join()
+
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+
+    # merge the cutflows in shard order
+    for worker_cutflows in cutflows:
+        for v, cf in zip(all_variations, worker_cutflows):
+            v._cutflow.merge(cf)
+
+    merge_outputs(partial_files, output_file)
+
+    if kwargs.get('cutflow_file', None):
+        variation_loop.save_variation_cutflows(kwargs['cutflow_file'], all_variations)
+
+    if not kwargs.get('keep_partial', False):
+        for f in partial_files:
+            os.remove(f)
+
+''' Return the read-set from the read-set cache or file in `kwargs`, or
+    None if it still has to be learned. A read_set_cache=True option is
+    replaced by the default ReadSetCache. '''
+def find_read_set(input_tree, variations, kwargs):
+    from branch import load_read_set
+    from read_set_cache import ReadSetCache
+
+    read_set_cache = kwargs.get('read_set_cache', None)
+    if read_set_cache:
+        if read_set_cache is True:
+            read_set_cache = kwargs['read_set_cache'] = ReadSetCache()
+        branches = read_set_cache.lookup(read_set_cache.key(variations, input_tree))
+        if branches is not None:
+            return branches
+
+    read_set_file = kwargs.get('read_set_file', None)
+    if read_set_file and os.path.exists(read_set_file):
+        return load_read_set(read_set_file, input_tree)
+    return None
+
+'''
+ Yield the (index, error, cutflows) result of each worker. A worker which
+ dies without reporting (e.g. killed for running out of memory, or a
+ crash inside ROOT) raises a RuntimeError, rather than waiting forever.
+'''
+def collect_results(results, workers, poll_interval=1.):
+    pending = set(xrange(len(workers)))
+    while pending:
+        try:
+            item = results.get(timeout=poll_interval)
+        except Queue.Empty:
+            dead = [k for k in sorted(pending) if not workers[k].is_alive()]
+            if not dead:
+                continue
+            # NB: a worker may have reported just before exiting
+            try:
+                item = results.get(timeout=poll_interval)
+            except Queue.Empty:
+                raise RuntimeError('\n'.join('worker %d exited with code %s without reporting a result'
+                                              % (k, workers[k].exitcode) for k in dead))
+        pending.discard(item[0])
+        yield item
+
+def run_worker(index, first, last, tree_name, file_names, disabled, partial_file,
+               nominal, variations, silent, results, run_kwargs={}):
+    try:
+        chain = r.TChain(tree_name)
+        for f in file_names:
+            chain.Add(f)
+        for b in disabled:
+            chain.SetBranchStatus(b, False)
+
+        all_variations = variation_loop.prepare_variations(chain, nominal, variations)
+
+        out = r.TFile(partial_file, 'recreate')
+        for v in all_variations:
+            for t in v.get_output_trees():
+                t.SetDirectory(out)
+
+        # NB: start from empty cutflows, the parent merges them into its own
+        for v in all_variations:
+            v._cutflow = v._cutflow.empty()
+
+        variation_loop.run(chain, nominal, variations, silent=silent,
+                           first_entry=first, last_entry=last, **run_kwargs)
+
+        # NB: TFile.Write() doesn't flush the rows of buffered PyTrees
+        for v in all_variations:
+            for t in v.get_output_trees():
+                if isinstance(t, PyTree):
+                    t.flush()
+        out.Write()
+        out.Close()
+
+        # NB: timing is not sent back
+        for v in all_variations:
+            v._cutflow.cut_times = None
+        results.put((index, None, [v._cutflow for v in all_variations]))
+    except Exception:
+        results.put((index, traceback.format_exc(), None))
+
+'''
+ Combine the trees in the partial output files (in order) into one file.
+ If every partial file has the same branches (names and types),
+ TFileMerger is used. Otherwise (e.g. a PyTree branch was only created in
+ some of the shards), the entries are copied with PyTree.append_tree(),
+ which gives the same result as a single job would have.
+'''
+def merge_outputs(partial_files, output_file):
+    if has_uniform_schema(partial_files):
+        merger = r.TFileMerger(False)
+        merger.OutputFile(output_file, True)
+        for f in partial_files:
+            merger.AddFile(f)
+        if not merger.Merge():
+            raise RuntimeError('failed to merge partial outputs into %s' % output_file)
+        return
+
+    out = r.TFile(output_file, 'recreate')
+    inputs = [r.TFile(f) for f in partial_files]
+    for name in tree_names(inputs[0]):
+        out.cd()
+        merged = PyTree(name, inputs[0].Get(name).GetTitle())
+        for f in inputs:
+            merged.append_tree(f.Get(name))
+        merged.Write()
+    out.Close()
+    for f in inputs:
+        f.Close()
+
+def tree_names(tfile):
+    names = []
+    for k in tfile.GetListOfKeys():
+        # NB: skip any additional cycles of the same tree
+        if k.GetClassName() == 'TTree' and not k.GetName() in names:
+            names.append(k.GetName())
+    return names
+
+''' The type of a branch, e.g. `vector<float>` or `Int_t` '''
+def branch_type(b):
+    # NB: not pytree.btype_from_branch(), which only knows the PyTree types
+    return b.GetClassName() or ','.join(l.GetTypeName() for l in b.GetListOfLeaves())
+
+def has_uniform_schema(partial_files):
+    schemas = []
+    for fname in partial_files:
+        f = r.TFile(fname)
+        # NB: the types may differ too, e.g. when PyTree guessed int in one
+        # shard and float in another
+        schemas.append(dict((name, [(b.GetName(), branch_type(b)) for b in f.Get(name).GetListOfBranches()])
+                            for name in tree_names(f)))
+        f.Close()
+    return all(s == schemas[0] for s in schemas)
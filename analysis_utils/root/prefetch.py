@@ -0,0 +1,198 @@
+'''
+ Read-ahead for the event loops, so that reading (and decompressing)
+ input overlaps with processing it.
+
+ For variation_loop.run_batched(), a Prefetcher reads the branches of the
+ upcoming batches in a background process (or thread) while the current
+ batch is processed, and hands them over through a queue of bounded
+ depth, so at most `depth` + 1 batches are held in memory besides the
+ one being processed. Any branches which are not prefetched are still
+ read on demand. The background reader opens its own TChain on the input
+ files, so it never touches the loop's tree.
+
+ The default 'process' mode costs pickling the arrays across, but the
+ reader runs in parallel with the loop. In 'thread' mode, the reader
+ (PyROOT, or root_numpy) holds the interpreter lock most of the time it
+ is reading, so little of the reading actually overlaps with processing.
+
+ For variation_loop.run(), enable_async_reading() sets up the TTreeCache
+ to prefetch baskets asynchronously and to unzip them in parallel
+ (TTreeCacheUnzip), which is the closest ROOT gets to read-ahead when
+ entries are read one at a time.
+
+ Either way, IOStats keeps track of how long the loop had to wait for
+ input. For a Prefetcher, it also estimates how much reading was hidden
+ behind the processing, by comparing the wait with a baseline: the time
+ it took to read the first batch without prefetching.
+'''
+
+import time
+import Queue
+import threading
+import traceback
+import multiprocessing
+
+from analysis_utils._lazy import lazy_import
+from analysis_utils.root.batch import read_branch
+
+r = lazy_import('ROOT')
+
+''' Accounting of input reading time vs. time the loop spent waiting for input '''
+class IOStats(object):
+
+    def __init__(self):
+        # time spent reading by the background reader (None without one).
+        # NB: in thread mode, this includes time the reader was stalled by
+        # the loop holding the interpreter lock, and vice versa
+        self.read_time = None
+        # time the loop spent waiting for input
+        self.wait_time = 0.
+        self.n_reads = 0
+        # entries handed over by the background reader
+        self.n_prefetched = 0
+        # time per entry to read without prefetching (None if not measured)
+        self.baseline_rate = None
+
+    ''' Record how long it took to read n_entries without prefetching '''
+    def set_baseline(self, dt, n_entries):
+        if n_entries > 0:
+            self.baseline_rate = dt / n_entries
+
+    def add_read(self, dt):
+        if self.read_time is None:
+            self.read_time = 0.
+        self.read_time += dt
+
+    def add_wait(self, dt, n_entries=0):
+        self.wait_time += dt
+        self.n_reads += 1
+        self.n_prefetched += n_entries
+
+    ''' Estimated time to read the prefetched entries without prefetching '''
+    def baseline_time(self):
+        if self.baseline_rate is None:
+            return None
+        return self.baseline_rate * self.n_prefetched
+
+    ''' Read time which overlapped with processing, i.e. the baseline time
+        minus the wait; None without a baseline '''
+    def hidden_time(self):
+        baseline = self.baseline_time()
+        if baseline is None:
+            return None
+        return max(0., baseline - self.wait_time)
+
+    def print_report(self):
+        print "I/O wait: %.2f s over %d reads" % (self.wait_time, self.n_reads)
+        hidden = self.hidden_time()
+        if hidden is not None:
+            baseline = self.baseline_time()
+            print "Reading would have taken ~%.2f s without prefetching, of which %.2f s (%.0f%%) was hidden" % \
+                (baseline, hidden, 100. * hidden / (baseline + 1e-9))
+        if self.read_time is not None:
+            print "Background reader busy for %.2f s" % self.read_time
+
+'''
+ Enable asynchronous prefetching of baskets and parallel unzipping for
+ the TTreeCache of `tree`. NB: asynchronous prefetching only applies to
+ files opened after this is called, e.g. the files of a TChain which
+ hasn't been read from yet.
+'''
+def enable_async_reading(tree, cache_size=30*1024*1024, unzip=True):
+    r.gEnv.SetValue('TFile.AsyncPrefetching', 1)
+    if unzip:
+        try:
+            r.TTreeCacheUnzip.SetParallelUnzip(r.TTreeCacheUnzip.kEnable)
+        except AttributeError:
+            # this ROOT version has no TTreeCacheUnzip
+            pass
+    # NB: keep the cache (and its branches) if already set up, e.g. by
+    # branch.prune_branches()
+    if tree.GetCacheSize() < cache_size:
+        tree.SetCacheSize(cache_size)
+
+def open_chain(tree_name, file_names):
+    chain = r.TChain(tree_name)
+    for f in file_names:
+        chain.Add(f)
+    return chain
+
+def read_ranges(tree_name, file_names, ranges, branches, put, stop_flag=None):
+    try:
+        chain = open_chain(tree_name, file_names)
+        for start, stop in ranges:
+            if stop_flag is not None and stop_flag.is_set():
+                return
+            t0 = time.time()
+            columns = dict((b, read_branch(chain, b, start, stop)) for b in branches)
+            put((start, stop, columns, time.time() - t0))
+        put(None)
+    except Exception:
+        put(('error', traceback.format_exc()))
+
+'''
+ Iterate over batches of entries, read in the background: yields
+ (start, stop, columns) for each (start, stop) in `ranges`, where
+ columns is a dict of {branch name: array} (see batch.read_branch).
+'''
+class Prefetcher(object):
+
+    def __init__(self, input_tree, ranges, branches, depth=2, mode='process'):
+        from analysis_utils.root.parallel_loop import get_input_files
+        tree_name, file_names = get_input_files(input_tree)
+
+        self.stats = IOStats()
+        self._branches = list(branches)
+        self._mode = mode
+        if mode == 'thread':
+            r.ROOT.EnableThreadSafety()
+            self._queue = Queue.Queue(depth)
+            self._stop = threading.Event()
+            self._worker = threading.Thread(target=read_ranges,
+                                            args=(tree_name, file_names, ranges, self._branches,
+                                                  self._queue.put, self._stop))
+            self._worker.daemon = True
+        elif mode == 'process':
+            self._queue = multiprocessing.Queue(depth)
+            self._stop = None
+            self._worker = multiprocessing.Process(target=read_ranges,
+                                                   args=(tree_name, file_names, ranges, self._branches,
+                                                         self._queue.put))
+            self._worker.daemon = True
+        else:
+            raise ValueError("unknown prefetch mode `%s`" % mode)
+        self._worker.start()
+
+    def branches(self):
+        return self._branches
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t0 = time.time()
+        item = self._queue.get()
+        dt = time.time() - t0
+        if item is None:
+            raise StopIteration
+        if item[0] == 'error':
+            raise RuntimeError("prefetching failed:\n%s" % item[1])
+        start, stop, columns, read_time = item
+        self.stats.add_wait(dt, stop - start)
+        self.stats.add_read(read_time)
+        return start, stop, columns
+
+    ''' Stop the background reader (e.g. when the loop ends early) '''
+    def close(self):
+        if self._mode == 'thread':
+            self._stop.set()
+            # unblock the reader, if it's waiting for space in the queue
+            while self._worker.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+        else:
+            if self._worker.is_alive():
+                self._worker.terminate()
+            self._worker.join()
@@ -10,7 +10,6 @@
  Usage is very simple: simply replace the TChain constructor.
 
  So this:
-   import ROOT as r
    t = r.TChain('mytree')
    t.Add('somefile.root')
 
@@ -23,7 +22,10 @@
    t.set_behavior(prof.activate | prof.record)
  
  If you have specified prof.record behavior, you can print a
- summary of branch access records with `print_report()`.
+ summary of branch access records with `print_report()`, or save
+ them with `save_report(filename)`. Together with the storage cost of
+ each branch, the saved records show which branches are worth cutting:
+   python list_branches.py somefile.root --sizes --access access.json
 
  The three supported profiling modes (which may be bitwise
  OR'd together) are:
@@ -35,11 +37,40 @@
 
 '''
 
+import json
 import ROOT as r
 
 fail = 1
 record = 2
 activate = 4
+
+def print_access_report(alist, limit=None, reverse=False):
+    if len(alist) == 0:
+        print "(no records)"
+        return
+
+
+    name_width = max(map(len, alist.keys()))
+    alist_sorted = sorted(alist.items(), key=lambda x: x[1], reverse=reverse)
+    if limit:
+        alist_sorted = alist_sorted[:limit]
+    for bname, ct in alist_sorted:
+        padding = name_width-len(bname)+2
+        print "%s:%s%d" % (bname, " "*padding, ct)
+
+''' Save an access list (branch name -> number of reads) as JSON, e.g.
+    for branch.rank_by_cost() or list_branches.py --access '''
+def save_access_list(filename, alist):
+    f = open(filename, 'w')
+    json.dump(alist, f, indent=1, sort_keys=True)
+    f.close()
+
+def load_access_list(filename):
+    f = open(filename)
+    alist = json.load(f)
+    f.close()
+    return dict((str(k), v) for k, v in alist.items())
+
 class ProfileBase(object):
     def __init__(self, behavior=fail):
         self._branch_list = set()
@@ -56,19 +87,10 @@ class ProfileBase(object):
         self._behavior = behavior
 
     def print_report(self, limit=None, reverse=False):
-        alist = self._access_list
-        if len(alist) == 0:
-            print "(no records)"
-            return
-
+        print_access_report(self._access_list, limit, reverse)
 
-        name_width = max(map(len, alist.keys()))
-        alist_sorted = sorted(alist.items(), key=lambda x: x[1], reverse=reverse)
-        if limit:
-            alist_sorted = alist_sorted[:limit]
-        for bname, ct in alist_sorted:
-            padding = name_width-len(bname)+2
-            print "%s:%s%d" % (bname, " "*padding, ct)
+    def save_report(self, filename):
+        save_access_list(filename, self._access_list)
 
     def __getattr__(self, attr):
         if attr in self._branch_list:
@@ -104,3 +126,78 @@ class ProfileChain(ProfileBase, r.TChain):
         r.TChain.Branch(self, *args, **kwargs)
         self._update_branchlist()
 
+
+'''
+ A lightweight proxy for any TTree/TChain, which records the number of
+ times each attribute (i.e. branch) is accessed through it. Unlike
+ ProfileChain, the underlying tree is left untouched, so the recorder
+ can be swapped in and out (e.g. for a short warm-up of the event loop):
+   recorder = AccessRecorder(tree)
+   # ... read branches through recorder ...
+   print recorder.read_set()
+'''
+class AccessRecorder(object):
+    def __init__(self, tree):
+        self._tree = tree
+        self._access_list = {}
+
+    def get_tree(self):
+        return self._tree
+
+    ''' Return the sorted names of the branches which were accessed '''
+    def read_set(self):
+        branches = set(b.GetName() for b in self._tree.GetListOfBranches())
+        return sorted(b for b in self._access_list if b in branches)
+
+    def print_report(self, limit=None, reverse=False):
+        print_access_report(self._access_list, limit, reverse)
+
+    def save_report(self, filename):
+        save_access_list(filename, self._access_list)
+
+    def __getattr__(self, attr):
+        try:
+            self._access_list[attr] += 1
+        except KeyError:
+            self._access_list[attr] = 1
+        return getattr(self._tree, attr)
+
+'''
+ A lightweight proxy for a tree which was pruned to a read-set (see
+ branch.prune_branches). Branches outside the read-set are activated the
+ first time they are accessed, like ProfileChain's `activate` behavior,
+ and the current entry is reloaded so their values are not stale:
+   prune_branches(tree, branches)
+   guard = BranchGuard(tree, branches)
+   # ... read branches through guard ...
+   print guard.activated
+'''
+class BranchGuard(object):
+    def __init__(self, tree, branches, cache=True):
+        self._tree = tree
+        self._cache = cache
+        self._branches = list(branches)
+        # names which are known to be safe to forward (read-set branches,
+        # activated branches and anything that isn't a branch)
+        self._checked = set(self._branches)
+        self.activated = []
+
+    def get_tree(self):
+        return self._tree
+
+    ''' Return the sorted names of the read-set and activated branches '''
+    def read_set(self):
+        return sorted(set(self._branches) | set(self.activated))
+
+    def __getattr__(self, attr):
+        if attr not in self._checked:
+            self._checked.add(attr)
+            if self._tree.GetBranch(attr) and not self._tree.GetBranchStatus(attr):
+                print "Warning: activating branch '%s', which is not in the read-set!" % attr
+                self._tree.SetBranchStatus(attr, True)
+                if self._cache:
+                    self._tree.AddBranchToCache(attr, True)
+                # still need to force a reload, or else the branch data will be empty
+                self._tree.GetEntry(self._tree.GetReadEntry())
+                self.activated.append(attr)
+        return getattr(self._tree, attr)
@@ -1,6 +1,25 @@
 import ROOT as r
 import numpy as np
 
+'''
+ PyTree is a TTree which creates its branches on the fly, as values are
+ written to them with write_branch()/write_object(), and call Fill().
+
+ In buffered mode (buffered=True), rows are accumulated in numpy column
+ buffers instead, and written to the TTree in blocks; either when
+ `buffer_rows` rows are buffered, when the buffers exceed roughly
+ `max_buffer_bytes`, or when flush() is called. Where the interpreter
+ allows declaring it, a compiled helper (see get_bulk_filler) copies each
+ block from the buffers into the branches and fills the tree, without a
+ round trip through python per row. Each row starts out blank, i.e.
+ values are not carried over to the next row if reset() is not called.
+
+ NB: buffered rows are only in the TTree once flushed. PyTree.Write()
+ and PyTree.AutoSave() flush first, but TFile.Write() (or anything else
+ which writes the tree from C++) does not, and misses the unflushed rows.
+ Call flush() (or the tree's Write()) before writing the output file;
+ AnalysisVariationNTuple does this in post_run().
+'''
 class PyTree(r.TTree):
 
     def __init__(self, *args, **kwargs):
@@ -10,7 +29,27 @@ class PyTree(r.TTree):
 
         self.verbose = kwargs.get('verbose', False)
 
+        self.__buffered = kwargs.get('buffered', False)
+        self.__buffer_rows = kwargs.get('buffer_rows', 10000)
+        self.__max_buffer_bytes = kwargs.get('max_buffer_bytes', 64 * 1024 * 1024)
+        # branch name -> column buffer
+        self.__columns = {}
+        # columns which have been written to in the current row
+        self.__dirty = []
+        # index of the current row in the buffers
+        self.__row = 0
+        # memory used per row by scalar columns, and in total by vector columns
+        self.__row_bytes = 0
+        self.__vector_bytes = 0
+
     def reset(self):
+        if self.__buffered:
+            # NB: discarding the row also releases its vector values
+            for col in self.__dirty:
+                self.__vector_bytes -= col.clear(self.__row)
+            del self.__dirty[:]
+            return
+
         for v, btype in self.__branch_cache.values():
             # set the values to an appropriate
             # state depending on thier type
@@ -40,6 +79,14 @@ class PyTree(r.TTree):
             # oops, haven't made this branch yet. let's do that now:
             v = bind_and_backfill(self, bname, btype)
             self.__branch_cache[bname] = (v, btype)
+            if self.__buffered:
+                self.__add_column(bname, btype)
+
+        if self.__buffered:
+            col = self.__columns[bname]
+            self.__vector_bytes += col.write(self.__row, value)
+            self.__dirty.append(col)
+            return
 
         # now we have a pointer to the branch memory.
         # write the value depending on the type
@@ -62,15 +109,16 @@ class PyTree(r.TTree):
             obj_list = obj
             for attr in attrs:
                 try:
-                    # doing this the lazy way for now... however
-                    # it is a bit inefficient to construct these
-                    # lists in memory
-                    values = []
-                    for o in obj_list:
-                        try:
-                            values.append(getattr(o, attr))
-                        except AttributeError:
-                            values.append(o[attr])
+                    try:
+                        values = [getattr(o, attr) for o in obj_list]
+                    except AttributeError:
+                        # (some of) the objects are dict-like
+                        values = []
+                        for o in obj_list:
+                            try:
+                                values.append(getattr(o, attr))
+                            except AttributeError:
+                                values.append(o[attr])
                     self.write_branch(values, '%s_%s'%(prefix, attr))
                 except KeyError:
                     print "Warning! No attribute `%s_%s`"%(prefix,attr)
@@ -82,9 +130,295 @@ class PyTree(r.TTree):
                 self.write_branch(getattr(obj, attr), '%s_%s'%(prefix, attr))
 
 
+    def Fill(self):
+        if not self.__buffered:
+            return r.TTree.Fill(self)
+
+        del self.__dirty[:]
+        self.__row += 1
+        if (self.__row >= self.__buffer_rows or
+                self.__row * self.__row_bytes + self.__vector_bytes > self.__max_buffer_bytes):
+            self.flush()
+        return 1
+
+    '''
+     Write all buffered rows to the TTree. Does nothing if not in buffered mode.
+    '''
+    def flush(self):
+        n = self.__row
+        if n == 0:
+            return
+
+        bulk_filler = get_bulk_filler()
+        if bulk_filler is not None and all(col.bulk_supported() for col in self.__columns.values()):
+            filler = bulk_filler()
+            # NB: keep the offset arrays alive until the rows are filled
+            keep = [self.__columns[bname].add_to_bulk(filler, v, n)
+                    for bname, (v, btype) in self.__branch_cache.items()]
+            filler.fill(self, n)
+            del keep
+        else:
+            fillers = [self.__columns[bname].filler(v, n)
+                       for bname, (v, btype) in self.__branch_cache.items()]
+            for i in xrange(n):
+                for fill_value in fillers:
+                    fill_value(i)
+                r.TTree.Fill(self)
+
+        for col in self.__columns.values():
+            col.clear_block(n)
+        self.__row = 0
+        self.__vector_bytes = 0
+
+    def Write(self, *args):
+        self.flush()
+        return r.TTree.Write(self, *args)
+
+    def AutoSave(self, *args):
+        self.flush()
+        return r.TTree.AutoSave(self, *args)
+
+    def __add_column(self, bname, btype):
+        if type(btype) == list:
+            col = VectorColumn(btype[0])
+        else:
+            col = ScalarColumn(btype, self.__buffer_rows)
+            self.__row_bytes += col.data.itemsize
+        self.__columns[bname] = col
+
+    '''
+     Append the entries of another tree (e.g. one written by a PyTree in
+     a different job) to this one. Any branches which don't exist yet are
+     created up front, in the order of the input tree, so the usual
+     backfill semantics apply.
+    '''
+    def append_tree(self, tree, n_entries=None):
+        branches = [(b.GetName(), btype_from_branch(b)) for b in tree.GetListOfBranches()]
+        for bname, btype in branches:
+            if not bname in self.__branch_cache:
+                v = bind_and_backfill(self, bname, btype)
+                self.__branch_cache[bname] = (v, btype)
+                if self.__buffered:
+                    self.__add_column(bname, btype)
+
+        if n_entries is None:
+            n_entries = tree.GetEntries()
+        for i in xrange(n_entries):
+            tree.GetEntry(i)
+            self.reset()
+            for bname, btype in branches:
+                value = getattr(tree, bname)
+                if type(btype) == list:
+                    value = list(value)
+                self.write_branch(value, bname, btype)
+            self.Fill()
+
+
+''' Column buffer for scalar branches in buffered mode. '''
+class ScalarColumn(object):
+
+    def __init__(self, btype, capacity):
+        self.data = np.zeros(capacity, dtype=numpy_types[btype])
+
+    def write(self, row, value):
+        self.data[row] = value
+        return 0
+
+    ''' Blank the given row; returns the number of bytes released (none) '''
+    def clear(self, row):
+        self.data[row] = 0
+        return 0
+
+    def clear_block(self, n):
+        self.data[:n] = 0
+
+    def bulk_supported(self):
+        return True
+
+    ''' Register this column with a BulkFiller (see get_bulk_filler) '''
+    def add_to_bulk(self, filler, v, n):
+        filler.add_scalar(v.ctypes.data, self.data.ctypes.data, self.data.itemsize)
+
+    ''' Return a function which copies row i to the branch memory v '''
+    def filler(self, v, n):
+        data = self.data
+        def fill_value(i):
+            v[0] = data[i]
+        return fill_value
+
+''' Column buffer for vector branches in buffered mode. The values of all
+    rows are stored back-to-back, along with the row each value belongs to. '''
+class VectorColumn(object):
+
+    def __init__(self, btype, capacity=1024):
+        self.values = np.zeros(capacity, dtype=numpy_types[btype])
+        self.rows = np.zeros(capacity, dtype='int64')
+        self.size = 0
+        # where the values of the current row start
+        self.row_start = 0
+        self.last_row = -1
+
+    def write(self, row, value):
+        value = np.asarray(value, dtype=self.values.dtype)
+        if row != self.last_row:
+            self.row_start = self.size
+            self.last_row = row
+
+        end = self.size + len(value)
+        if end > len(self.values):
+            capacity = max(end, 2 * len(self.values))
+            self.values = np.resize(self.values, capacity)
+            self.rows = np.resize(self.rows, capacity)
+        self.values[self.size:end] = value
+        self.rows[self.size:end] = row
+        self.size = end
+        return value.nbytes
+
+    ''' Drop the values of the given row, if it is the last one written;
+        returns the number of bytes released '''
+    def clear(self, row):
+        if row != self.last_row:
+            return 0
+        released = (self.size - self.row_start) * self.values.itemsize
+        self.size = self.row_start
+        return released
+
+    def clear_block(self, n):
+        self.size = 0
+        self.row_start = 0
+        self.last_row = -1
+
+    ''' Offsets of each of the first n rows into self.values '''
+    def offsets(self, n):
+        counts = np.bincount(self.rows[:self.size], minlength=n)
+        return np.concatenate([[0], np.cumsum(counts)])
+
+    def bulk_supported(self):
+        return self.values.dtype.name in ('float64', 'int32')
+
+    ''' Register this column with a BulkFiller (see get_bulk_filler).
+        Returns the offsets, which must be kept alive until it's filled. '''
+    def add_to_bulk(self, filler, v, n):
+        offsets = self.offsets(n).astype('int64')
+        if self.values.dtype.name == 'float64':
+            filler.add_vector_double(v, self.values.ctypes.data, offsets.ctypes.data)
+        else:
+            filler.add_vector_int(v, self.values.ctypes.data, offsets.ctypes.data)
+        return offsets
+
+    ''' Return a function which copies row i to the std::vector v '''
+    def filler(self, v, n):
+        values = self.values
+        offsets = self.offsets(n)
+        assign = get_assign_helper() if values.dtype.name in ('float64', 'int32') else None
+        if assign is not None:
+            def fill_value(i):
+                begin, end = offsets[i], offsets[i + 1]
+                assign(v, values[begin:end], int(end - begin))
+        else:
+            def fill_value(i):
+                v.clear()
+                map(v.push_back, values[offsets[i]:offsets[i + 1]].tolist())
+        return fill_value
+
+# C++ helper to copy a whole buffer into a std::vector in one call
+ASSIGN_HELPER_CODE = '''
+#include <vector>
+namespace pytree_helpers {
+    void assign(std::vector<double>& v, const double* data, int n) { v.assign(data, data + n); }
+    void assign(std::vector<int>& v, const int* data, int n) { v.assign(data, data + n); }
+}
+'''
+_assign_helper = []
+
+''' Compile (once) and return the vector assign() helper, or None if
+    the interpreter doesn't support declaring it. '''
+def get_assign_helper():
+    if not _assign_helper:
+        try:
+            r.gInterpreter.Declare(ASSIGN_HELPER_CODE)
+            _assign_helper.append(r.pytree_helpers.assign)
+        except Exception:
+            _assign_helper.append(None)
+    return _assign_helper[0]
+
+
+# C++ helper to copy blocks of rows from the column buffers to the branch
+# memory and fill the tree, all in one call. Buffers are passed as addresses.
+BULK_FILLER_CODE = '''
+#include <cstring>
+#include <vector>
+#include "TTree.h"
+namespace pytree_helpers {
+    class BulkFiller {
+    public:
+        void add_scalar(ULong64_t dst, ULong64_t src, int itemsize) {
+            fScalarDst.push_back(reinterpret_cast<char*>(dst));
+            fScalarSrc.push_back(reinterpret_cast<const char*>(src));
+            fScalarSize.push_back(itemsize);
+        }
+        void add_vector_double(std::vector<double>& dst, ULong64_t values, ULong64_t offsets) {
+            fDoubleDst.push_back(&dst);
+            fDoubleValues.push_back(reinterpret_cast<const double*>(values));
+            fDoubleOffsets.push_back(reinterpret_cast<const Long64_t*>(offsets));
+        }
+        void add_vector_int(std::vector<int>& dst, ULong64_t values, ULong64_t offsets) {
+            fIntDst.push_back(&dst);
+            fIntValues.push_back(reinterpret_cast<const int*>(values));
+            fIntOffsets.push_back(reinterpret_cast<const Long64_t*>(offsets));
+        }
+        void fill(TTree* tree, Long64_t n) {
+            for (Long64_t i = 0; i < n; ++i) {
+                for (size_t k = 0; k < fScalarDst.size(); ++k)
+                    std::memcpy(fScalarDst[k], fScalarSrc[k] + i * fScalarSize[k], fScalarSize[k]);
+                for (size_t k = 0; k < fDoubleDst.size(); ++k)
+                    fDoubleDst[k]->assign(fDoubleValues[k] + fDoubleOffsets[k][i],
+                                          fDoubleValues[k] + fDoubleOffsets[k][i + 1]);
+                for (size_t k = 0; k < fIntDst.size(); ++k)
+                    fIntDst[k]->assign(fIntValues[k] + fIntOffsets[k][i],
+                                       fIntValues[k] + fIntOffsets[k][i + 1]);
+                // NB: not the (python) PyTree.Fill, which would buffer the row again
+                tree->TTree::Fill();
+            }
+        }
+    private:
+        std::vector<char*> fScalarDst;
+        std::vector<const char*> fScalarSrc;
+        std::vector<int> fScalarSize;
+        std::vector<std::vector<double>*> fDoubleDst;
+        std::vector<const double*> fDoubleValues;
+        std::vector<const Long64_t*> fDoubleOffsets;
+        std::vector<std::vector<int>*> fIntDst;
+        std::vector<const int*> fIntValues;
+        std::vector<const Long64_t*> fIntOffsets;
+    };
+}
+'''
+_bulk_filler = []
+
+''' Compile (once) and return the BulkFiller class, or None if the
+    interpreter doesn't support declaring it. '''
+def get_bulk_filler():
+    if not _bulk_filler:
+        try:
+            r.gInterpreter.Declare(BULK_FILLER_CODE)
+            _bulk_filler.append(r.pytree_helpers.BulkFiller)
+        except Exception:
+            _bulk_filler.append(None)
+    return _bulk_filler[0]
+
+
 typenames_long = {float: 'double', int: 'int', bool: 'bool', long: 'long'}
 # NB: force unsigned for longs.
 typenames_short = {float: 'D', int: 'I', bool: 'O', long: 'l'}
+# element types of the column buffers in buffered mode
+numpy_types = {float: 'float64', int: 'int32', bool: 'bool', long: 'uint64'}
+
+# map ROOT leaf/vector element type names back to branch types
+leaf_btypes = {'Double_t': float, 'Float_t': float, 'Int_t': int,
+               'Bool_t': bool, 'Long64_t': long, 'ULong64_t': long}
+element_btypes = {'double': float, 'float': float, 'int': int,
+                  'bool': bool, 'long': long, 'unsigned long': long}
 
 ''' Exception to represent type inference failure due to
     an empty iterable. '''
@@ -118,6 +452,24 @@ def infer_btype(val):
     else:
         raise TypeError('pytree: unsupported type.')
 
+''' Recover the branch type of an existing TBranch, e.g. one that
+    was written out by a PyTree. '''
+def btype_from_branch(branch):
+    cname = branch.GetClassName()
+    if cname:
+        # vector branch; the class name looks like `vector<double>`
+        element = cname[cname.index('<') + 1:cname.rindex('>')].strip()
+        try:
+            return [element_btypes[element]]
+        except KeyError:
+            raise TypeError('pytree: unsupported type `%s`' % cname)
+
+    leaf = branch.GetListOfLeaves()[0]
+    try:
+        return leaf_btypes[leaf.GetTypeName()]
+    except KeyError:
+        raise TypeError('pytree: unsupported type `%s`' % leaf.GetTypeName())
+
 def get_typeclass(btype):
     if btype in (int, float, bool, long):
         return typenames_long[btype]
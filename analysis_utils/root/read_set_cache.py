@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+'''
+ An on-disk cache of branch read-sets (see profile_tree.AccessRecorder and
+ branch.prune_branches), so that the branches an analysis needs only have
+ to be learned once.
+
+ Entries are keyed by a hash of the analysis code (the source of the
+ AnalysisVariation classes and process functions being run) together
+ with a hash of the input tree's schema (branch names and types). If
+ either changes, the key changes, and the read-set is learned again. When
+ only the code changed, the superseded entry for the same classes and
+ schema is then dropped; entries for other input schemas are kept.
+
+ NB: code called from the calculables which lives outside of those
+ classes (e.g. helper functions in other modules) is not part of the hash.
+
+ Usage with the event loop driver:
+   run(input_tree, nominal, variations, read_set_cache=True)
+
+ To inspect the cache from the command line:
+   python -m analysis_utils.root.read_set_cache list
+   python -m analysis_utils.root.read_set_cache show <key>
+   python -m analysis_utils.root.read_set_cache clear [<key>]
+'''
+
+import os
+import time
+import json
+import hashlib
+import inspect
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                 'analysis_utils', 'read_sets')
+
+def source_of(obj):
+    try:
+        return inspect.getsource(obj)
+    except (IOError, TypeError):
+        # e.g. defined interactively; fall back to the bytecode
+        if inspect.isclass(obj):
+            return ''.join(source_of(m) for n, m in sorted(obj.__dict__.items())
+                           if inspect.isfunction(m))
+        code = getattr(obj, 'func_code', None)
+        return code.co_code if code else repr(obj)
+
+''' Hash of the source of the variations' classes (including their base
+    classes) and process functions. '''
+def code_hash(variations):
+    sources = set()
+    for v in variations:
+        for cls in inspect.getmro(v.__class__):
+            if cls is not object:
+                sources.add(source_of(cls))
+        if v._process_fn is not None:
+            sources.add(source_of(v._process_fn))
+
+    h = hashlib.sha1()
+    for src in sorted(sources):
+        h.update(src)
+    return h.hexdigest()
+
+''' Hash of the names and types of the branches of a tree '''
+def schema_hash(tree):
+    h = hashlib.sha1()
+    for b in tree.GetListOfBranches():
+        btype = b.GetClassName() or b.GetListOfLeaves()[0].GetTypeName()
+        h.update('%s:%s\n' % (b.GetName(), btype))
+    return h.hexdigest()
+
+def class_names(variations):
+    return sorted(set('%s.%s' % (v.__class__.__module__, v.__class__.__name__) for v in variations))
+
+
+class ReadSetCache(object):
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+
+    def key(self, variations, tree):
+        return '%s-%s' % (code_hash(variations)[:16], schema_hash(tree)[:16])
+
+    ''' Split a key into its (code hash, schema hash) parts '''
+    def split_key(self, key):
+        code, schema = key.split('-')
+        return code, schema
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def load(self, key):
+        try:
+            f = open(self.path(key))
+        except IOError:
+            return None
+        try:
+            return json.load(f)
+        except ValueError:
+            # e.g. a partially written file
+            return None
+        finally:
+            f.close()
+
+    ''' Return the cached list of branches for the key, or None '''
+    def lookup(self, key):
+        entry = self.load(key)
+        if entry is None:
+            return None
+        return [str(b) for b in entry['branches']]
+
+    def store(self, key, branches, variations=[], tree=None):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        entry = {'key': key,
+                 'branches': list(branches),
+                 'classes': class_names(variations),
+                 'tree': tree.GetName() if tree is not None else None,
+                 'created': time.time()}
+
+        # drop entries superseded by a change to the code of the same
+        # analysis classes, run over the same input schema
+        code, schema = self.split_key(key)
+        for other in self.entries():
+            other_code, other_schema = self.split_key(other['key'])
+            if other['classes'] == entry['classes'] and other_schema == schema and other_code != code:
+                self.clear(other['key'])
+
+        # write atomically, since many jobs may share the cache
+        tmp_path = '%s.%d.tmp' % (self.path(key), os.getpid())
+        f = open(tmp_path, 'w')
+        json.dump(entry, f)
+        f.close()
+        os.rename(tmp_path, self.path(key))
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for fname in sorted(os.listdir(self.directory)):
+            if fname.endswith('.json'):
+                entry = self.load(fname[:-len('.json')])
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    ''' Remove the given entry, or all entries if key is None '''
+    def clear(self, key=None):
+        keys = [key] if key else [e['key'] for e in self.entries()]
+        for k in keys:
+            try:
+                os.remove(self.path(k))
+            except OSError:
+                pass
+
+    def print_report(self):
+        entries = self.entries()
+        if len(entries) == 0:
+            print "(no entries in %s)" % self.directory
+            return
+        for e in entries:
+            print "%s  %4d branches  %s  tree=%s  [%s]" % (e['key'], len(e['branches']),
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(e['created'])),
+                e['tree'], ', '.join(e['classes']))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect the cache of branch read-sets.")
+    parser.add_argument('command', choices=['list', 'show', 'clear'])
+    parser.add_argument('key', nargs='?', default=None,
+                        help='The entry to show (required), or to clear (default: all)')
+    parser.add_argument('--dir', default=DEFAULT_CACHE_DIR,
+                        help='The cache directory')
+    args = parser.parse_args()
+    if args.command == 'show' and args.key is None:
+        parser.error("the `show` command requires a key")
+
+    cache = ReadSetCache(args.dir)
+    if args.command == 'list':
+        cache.print_report()
+    elif args.command == 'show':
+        branches = cache.lookup(args.key)
+        if branches is None:
+            print "No entry `%s`" % args.key
+        else:
+            for b in branches:
+                print b
+    elif args.command == 'clear':
+        cache.clear(args.key)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+'''
+ An index of the tree schemas (branch names and types) of many files, so
+ that schema queries over a large dataset don't have to reopen every file.
+
+ For each file, the index records the tree name, number of entries, total
+ compressed/uncompressed size and which schema the tree has. Identical
+ schemas are stored only once, together with the per-branch sizes summed
+ over all the files sharing that schema. The index is a gzipped JSON file.
+
+ So that the sums stay exact when a file is rescanned (or becomes
+ unreadable), the per-branch sizes of each file are kept in a separate
+ sidecar file next to the index (see sizes_filename), which is only read
+ when the index is updated. Without it, e.g. for an index copied without
+ its sidecar, the old sizes can only be subtracted proportionally.
+
+ Changed files are detected by their size and modification time. That is
+ only possible for local files: remote files (e.g. root:// URLs) are never
+ considered stale once indexed, so rescan them with update(force=True).
+
+     index = SchemaIndex('dataset.idx.gz')
+     index.update(files, 'physics', n_jobs=16)   # only scans new/changed files
+     index.save()
+
+     index.files_lacking('jet_AntiKt4LCTopo_pt')
+     index.diff(file_a, file_b)
+
+ See also list_branches.py, which provides these queries on the command line.
+'''
+
+import os
+import gzip
+import json
+import multiprocessing
+import traceback
+
+def branch_type(b):
+    return b.GetClassName() or b.GetListOfLeaves()[0].GetTypeName()
+
+''' Read the schema and sizes of the tree in a single file '''
+def scan_file(filename, tree_name):
+    import ROOT as r
+    try:
+        f = r.TFile.Open(filename)
+        if not f or f.IsZombie():
+            raise IOError('could not open %s' % filename)
+        t = f.Get(tree_name)
+        if not t:
+            raise KeyError('no tree `%s` in %s' % (tree_name, filename))
+
+        branches = [(b.GetName(), branch_type(b)) for b in t.GetListOfBranches()]
+        zip_bytes = [b.GetZipBytes('*') for b in t.GetListOfBranches()]
+        tot_bytes = [b.GetTotBytes('*') for b in t.GetListOfBranches()]
+        entry = {'tree': tree_name,
+                 'entries': t.GetEntries(),
+                 'branches': branches,
+                 'zip_bytes': zip_bytes,
+                 'tot_bytes': tot_bytes}
+        f.Close()
+    except Exception:
+        return filename, {'error': traceback.format_exc()}
+
+    entry.update(file_stamp(filename))
+    return filename, entry
+
+''' The sidecar file with the per-file, per-branch sizes of an index '''
+def sizes_filename(filename):
+    return filename + '.sizes'
+
+def _scan_worker(args):
+    return scan_file(*args)
+
+''' Size and modification time of a local file, used to detect changes '''
+def file_stamp(filename):
+    if not os.path.exists(filename):
+        return {}
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+class SchemaIndex(object):
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # list of {'branches': [[name, type], ...], 'zip_bytes': [...], 'tot_bytes': [...]}
+        self.schemas = []
+        # file name -> {'tree', 'entries', 'schema', 'zip_bytes', 'tot_bytes', 'size', 'mtime'}
+        self.files = {}
+        # file name -> [per-branch zip bytes, per-branch tot bytes], read
+        # from the sidecar on first use (see _sizes)
+        self._file_sizes = None
+        self._sizes_path = None
+        # file name -> error message, for files which could not be scanned
+        self.errors = {}
+        # schema key -> index into self.schemas
+        self._schema_ids = None
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    def load(self, filename):
+        f = gzip.open(filename)
+        data = json.load(f)
+        f.close()
+        self.schemas = data['schemas']
+        self.files = data['files']
+        self.errors = data.get('errors', {})
+        self._schema_ids = None
+        self._file_sizes = None
+        self._sizes_path = sizes_filename(filename)
+        # indexes written by an earlier version kept the sizes in the records
+        for fname, record in self.files.items():
+            if 'branch_zip_bytes' in record:
+                self._sizes()[fname] = [record.pop('branch_zip_bytes'), record.pop('branch_tot_bytes')]
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        tmp_name = filename + '.tmp'
+        f = gzip.open(tmp_name, 'wb')
+        json.dump({'schemas': self.schemas, 'files': self.files, 'errors': self.errors},
+                  f, separators=(',', ':'))
+        f.close()
+
+        # NB: the sidecar only needs rewriting if it was changed, or moves
+        if self._file_sizes is not None or sizes_filename(filename) != self._sizes_path:
+            sizes = self._sizes()
+            sizes_name = sizes_filename(filename)
+            f = gzip.open(sizes_name + '.tmp', 'wb')
+            json.dump(sizes, f, separators=(',', ':'))
+            f.close()
+            os.rename(sizes_name + '.tmp', sizes_name)
+            self._sizes_path = sizes_name
+        os.rename(tmp_name, filename)
+
+    ''' The per-file, per-branch sizes, read from the sidecar if need be '''
+    def _sizes(self):
+        if self._file_sizes is None:
+            self._file_sizes = {}
+            if self._sizes_path and os.path.exists(self._sizes_path):
+                f = gzip.open(self._sizes_path)
+                self._file_sizes = json.load(f)
+                f.close()
+        return self._file_sizes
+
+    '''
+     True if the file is not in the index, or has changed since it was
+     scanned. Only local files can be checked for changes; remote ones are
+     never stale once indexed.
+    '''
+    def is_stale(self, filename):
+        entry = self.files.get(filename)
+        if entry is None:
+            return True
+        stamp = file_stamp(filename)
+        if not stamp:
+            # e.g. a root:// URL; use update(force=True) to rescan it
+            return False
+        return stamp['size'] != entry.get('size') or stamp['mtime'] != entry.get('mtime')
+
+    ''' Scan the given files (in parallel) and add them to the index.
+        Unless force=True, files which are already indexed and unchanged
+        (or remote; see is_stale) are skipped. Returns the number of files
+        scanned. '''
+    def update(self, filenames, tree_name='physics', n_jobs=None, force=False, silent=False):
+        todo = [fname for fname in filenames if force or self.is_stale(fname)]
+        if len(todo) == 0:
+            return 0
+
+        n_jobs = min(n_jobs or multiprocessing.cpu_count(), len(todo))
+        args = [(fname, tree_name) for fname in todo]
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            results = pool.imap_unordered(_scan_worker, args, chunksize=8)
+        else:
+            pool = None
+            results = (_scan_worker(a) for a in args)
+
+        for i, (fname, entry) in enumerate(results):
+            if not silent and i % 100 == 0:
+                print "Scanned %d/%d files" % (i, len(todo))
+            self.add(fname, entry)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return len(todo)
+
+    ''' Add the result of scan_file() to the index '''
+    def add(self, filename, entry):
+        if 'error' in entry:
+            self.errors[filename] = entry['error']
+            old = self.files.pop(filename, None)
+            if old is not None:
+                self._subtract_sizes(filename, old)
+            return
+        self.errors.pop(filename, None)
+
+        old = self.files.get(filename)
+        if old is not None:
+            self._subtract_sizes(filename, old)
+
+        sid = self._schema_id(entry['branches'])
+        schema = self.schemas[sid]
+        schema['zip_bytes'] = [a + b for a, b in zip(schema['zip_bytes'], entry['zip_bytes'])]
+        schema['tot_bytes'] = [a + b for a, b in zip(schema['tot_bytes'], entry['tot_bytes'])]
+
+        record = {'tree': entry['tree'],
+                  'entries': entry['entries'],
+                  'schema': sid,
+                  'zip_bytes': sum(entry['zip_bytes']),
+                  'tot_bytes': sum(entry['tot_bytes'])}
+        for k in ('size', 'mtime'):
+            if k in entry:
+                record[k] = entry[k]
+        self.files[filename] = record
+        self._sizes()[filename] = [list(entry['zip_bytes']), list(entry['tot_bytes'])]
+
+    def _subtract_sizes(self, filename, record):
+        schema = self.schemas[record['schema']]
+        sizes = self._sizes().pop(filename, None)
+        if sizes is not None:
+            schema['zip_bytes'] = [a - b for a, b in zip(schema['zip_bytes'], sizes[0])]
+            schema['tot_bytes'] = [a - b for a, b in zip(schema['tot_bytes'], sizes[1])]
+            return
+        # NB: without the sidecar, only the file's total is known, so the
+        # sums can only be scaled down proportionally; rescan all the files
+        # with force=True to make them exact
+        total = float(sum(schema['zip_bytes'])) or 1.
+        frac = 1. - record['zip_bytes'] / total
+        schema['zip_bytes'] = [int(x * frac) for x in schema['zip_bytes']]
+        schema['tot_bytes'] = [int(x * frac) for x in schema['tot_bytes']]
+
+    def _schema_id(self, branches):
+        if self._schema_ids is None:
+            self._schema_ids = dict((self._schema_key(s['branches']), i) for i, s in enumerate(self.schemas))
+        key = self._schema_key(branches)
+        try:
+            return self._schema_ids[key]
+        except KeyError:
+            self.schemas.append({'branches': [list(b) for b in branches],
+                                 'zip_bytes': [0] * len(branches),
+                                 'tot_bytes': [0] * len(branches)})
+            self._schema_ids[key] = len(self.schemas) - 1
+            return len(self.schemas) - 1
+
+    @staticmethod
+    def _schema_key(branches):
+        return tuple((str(n), str(t)) for n, t in branches)
+
+    #############
+    ## Queries ##
+    #############
+
+    ''' List of (branch name, type) of the file's tree '''
+    def schema(self, filename):
+        return [tuple(b) for b in self.schemas[self.files[filename]['schema']]['branches']]
+
+    ''' Branch names of the given file, or of all the files '''
+    def branches(self, filename=None):
+        if filename is not None:
+            return [n for n, t in self.schema(filename)]
+        names = set()
+        for s in self.schemas:
+            names.update(n for n, t in s['branches'])
+        return sorted(names)
+
+    ''' Files grouped by schema, as a list of (schema id, [files]) '''
+    def schema_groups(self):
+        groups = {}
+        for fname, record in self.files.items():
+            groups.setdefault(record['schema'], []).append(fname)
+        return sorted((sid, sorted(fnames)) for sid, fnames in groups.items())
+
+    ''' Indexed files whose tree does not have the given branch '''
+    def files_lacking(self, branch):
+        lacking = set(i for i, s in enumerate(self.schemas)
+                      if not any(n == branch for n, t in s['branches']))
+        return sorted(fname for fname, record in self.files.items() if record['schema'] in lacking)
+
+    '''
+     Compare the schemas of two indexed files. Returns three lists:
+     the branches only in a, the branches only in b, and the branches
+     whose type differs as (name, type in a, type in b).
+    '''
+    def diff(self, a, b):
+        schema_a = dict(self.schema(a))
+        schema_b = dict(self.schema(b))
+        only_a = sorted(set(schema_a) - set(schema_b))
+        only_b = sorted(set(schema_b) - set(schema_a))
+        changed = sorted((n, schema_a[n], schema_b[n]) for n in set(schema_a) & set(schema_b)
+                         if schema_a[n] != schema_b[n])
+        return only_a, only_b, changed
+
+    ''' {branch name: (compressed bytes, uncompressed bytes)} summed over the indexed files '''
+    def branch_sizes(self):
+        sizes = {}
+        for s in self.schemas:
+            for (n, t), z, u in zip(s['branches'], s['zip_bytes'], s['tot_bytes']):
+                old = sizes.get(n, (0, 0))
+                sizes[n] = (old[0] + z, old[1] + u)
+        return sizes
+
+    def print_summary(self):
+        n_entries = sum(rec['entries'] for rec in self.files.values())
+        zip_bytes = sum(rec['zip_bytes'] for rec in self.files.values())
+        print "%d files, %d entries, %.1f MB compressed, %d distinct schema(s), %d unreadable" % (
+            len(self.files), n_entries, zip_bytes / 1024.**2, len(self.schema_groups()), len(self.errors))
+        for sid, fnames in self.schema_groups():
+            print "  schema %d: %d branches, %d files (e.g. %s)" % (
+                sid, len(self.schemas[sid]['branches']), len(fnames), fnames[0])
@@ -16,18 +16,24 @@ class AnalysisVariationNTuple(variation.AnalysisVariation):
         # use the descriptive name, replacing spaces w/ underscores.
         output_name = kwargs.get('output_name', '_'.join(self._name.split()))
 
-        self._output_tree = PyTree(output_name, self._name)
+        # pass buffered=True to buffer the ntuple output (see PyTree)
+        self._output_tree = PyTree(output_name, self._name,
+                                   buffered=kwargs.get('buffered', False))
 
     def pre_run(self):
         # "prime" the ntuple:
         self._output_tree.write_branch(False, '_valid')
         self.populate_ntuple(self._output_tree)
     def post_run(self):
-        pass
+        # write out any rows still buffered (see PyTree)
+        self._output_tree.flush()
 
     def get_ntuple(self):
         return self._output_tree
 
+    def get_output_trees(self):
+        return [self._output_tree]
+
     def reset(self):
         variation.AnalysisVariation.reset(self)
 
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 
 import os
-import ROOT as r
+import glob
+import fcntl
+import shutil
+import hashlib
+from analysis_utils._lazy import lazy_import
+
+# NB: only imported on first use, so that importing this module is cheap
+np = lazy_import('numpy')
+r = lazy_import('ROOT')
 
 '''
 This utility sets up a ROOT-accessible (cint) function to look up
@@ -23,58 +31,321 @@ The expected format for the counts file is:
 
 Note that the lumi_scale passed to init_lumi_weights() should have the (inverse) same units as
 cross-sections in the xs file.
+
+Both files are parsed only once: the parsed tables are cached as (memory-mappable) .npy files
+next to the text files (or in TABLE_CACHE_DIR, if that directory is read-only), and the cache
+is rebuilt when a text file changes. See load_xs_table() and load_counts_table().
+
+To weight whole arrays of events (e.g. for batched histogramming) use a LumiWeightTable,
+which is also returned by init_lumi_weights():
+    table = LumiWeightTable.from_files('crosssections.txt', 'counts.txt', lumi_scale=20.3e3)
+    w = table.lookup(mc_dataset_id)  # raises KeyError for DSIDs not in the table
+    w = table.lookup(mc_dataset_id, default=0.)  # or weight them with 0
+
+The ROOT functions are compiled (with ACLiC) when init_lumi_weights() is first called. The
+library is cached in a per-user directory (LIB_CACHE_DIR), keyed by the hash of weights.C and
+the ROOT version, so it is only built once, even when many jobs start at the same time.
 '''
 
 THIS_PATH = os.path.dirname(os.path.abspath(__file__))
-r.gROOT.ProcessLine('.L %s' % os.path.join(THIS_PATH, 'weights.C+'))
+SOURCE_FILE = os.path.join(THIS_PATH, 'weights.C')
 
+LIB_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                             'analysis_utils', 'lib')
 
-def parse_xs_file(xs_file):
+# written to the build directory once the library has been built
+BUILD_DONE = '.built'
+
+_library_loaded = False
+
+''' Build directory for the current weights.C and ROOT version '''
+def library_dir():
+    h = hashlib.sha1()
+    h.update(open(SOURCE_FILE).read())
+    h.update(r.gROOT.GetVersion())
+    h.update(r.gSystem.GetBuildArch())
+    return os.path.join(LIB_CACHE_DIR, 'weights-%s' % h.hexdigest()[:16])
+
+'''
+ Load the compiled weights.C library, building it in the cache first if
+ necessary. A file lock makes sure that only one process builds it: the
+ others take the lock shared, so they wait while it is being built, and
+ then load the result. The library only counts as built once the build
+ has finished (see BUILD_DONE), so a build which was interrupted halfway
+ is simply redone.
+'''
+def load_weights_library():
+    global _library_loaded
+    if _library_loaded:
+        return
+
+    build_dir = library_dir()
+    lib = os.path.join(build_dir, 'weights_C.so')
+    done = os.path.join(build_dir, BUILD_DONE)
+    if not os.path.isdir(build_dir):
+        try:
+            os.makedirs(build_dir)
+        except OSError:
+            # created by another job in the meantime
+            if not os.path.isdir(build_dir):
+                raise
+
+    lock = open(os.path.join(build_dir, '.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if not os.path.exists(done):
+            # NB: there's no atomic upgrade to an exclusive lock, so check
+            # again once we have it
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(done):
+                # NB: build from a copy, so the checkout may be read-only
+                source = os.path.join(build_dir, 'weights.C')
+                shutil.copy(SOURCE_FILE, source)
+                # (this also loads the library.) Force the build, in case
+                # an earlier one was interrupted
+                if not r.gSystem.CompileMacro(source, 'kf'):
+                    raise RuntimeError('failed to compile %s' % source)
+                open(done, 'w').close()
+                _library_loaded = True
+
+        if not _library_loaded and r.gSystem.Load(lib) < 0:
+            raise RuntimeError('failed to load %s' % lib)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    _library_loaded = True
+
+
+# (numpy dtype specifications of the tables)
+XS_DTYPE = [('dsid', '<i8'), ('xs', '<f8'), ('kfac', '<f8'), ('filter', '<f8')]
+COUNTS_DTYPE = [('dsid', '<i8'), ('nevt', '<i8'), ('nevt_wt', '<f8')]
+
+TABLE_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                               'analysis_utils', 'tables')
+
+def read_xs_rows(xs_file):
     # xs file should be formatted as:
     # dsid	physname	xs(pb)	kfactor	filt.eff
-    xs_info = {}
     for l in open(xs_file).readlines():
         l = l.strip()
         if l == '' or l.startswith('#'):
             continue
         fields = l.split()
-        dsid = int(fields[0])
-        xs = float(fields[2])
-        kfac = float(fields[3])
-        filt = float(fields[4])
-        xs_info[dsid] = {'xs': xs, 'kfac': kfac, 'filter': filt}
-    return xs_info
-
+        yield int(fields[0]), float(fields[2]), float(fields[3]), float(fields[4])
 
-def parse_counts_file(counts_file):
+def read_counts_rows(counts_file):
     # counts file should be formatted as:
     # dsid	nevt	nevt_wt
-    counts_info = {}
     for l in open(counts_file).readlines():
         l = l.strip()
         if l == '' or l.startswith('#'):
             continue
         fields = l.split()
-        dsid = int(fields[0])
-        nevt = int(fields[1])
-        nevt_wt = float(fields[2])
+        yield int(fields[0]), int(fields[1]), float(fields[2])
+
+''' Build a structured array sorted by DSID. If a DSID appears more than
+    once, the last line wins (as for the dicts of parse_xs_file etc.) '''
+def make_table(rows, dtype):
+    table = np.array(list(rows), dtype=dtype)
+    order = np.argsort(table['dsid'], kind='mergesort')
+    table = table[order]
+    last = np.ones(len(table), dtype=bool)
+    last[:-1] = table['dsid'][1:] != table['dsid'][:-1]
+    return table[last]
+
+''' The binary cache files for a text table: next to the source if that
+    directory is writable, and in TABLE_CACHE_DIR otherwise '''
+def table_cache_paths(filename):
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    dirname, basename = os.path.split(filename)
+    if not os.access(dirname, os.W_OK):
+        dirname = TABLE_CACHE_DIR
+        basename = '%s-%s' % (hashlib.sha1(filename).hexdigest()[:16], basename)
+    # the size and mtime of the source are part of the name, so
+    # editing the table invalidates the cache
+    prefix = os.path.join(dirname, '.%s.' % basename)
+    return prefix, '%s%d-%d.npy' % (prefix, st.st_size, int(st.st_mtime))
+
+'''
+ Load a text table as a structured numpy array (sorted by DSID), using a
+ memory-mapped binary cache. The cache is created on the first call, and
+ rebuilt whenever the size or modification time of the text file changes.
+'''
+def load_table(filename, read_rows, dtype):
+    prefix, cache = table_cache_paths(filename)
+    try:
+        table = np.load(cache, mmap_mode='r')
+        if table.dtype == np.dtype(dtype):
+            return table
+    except (IOError, ValueError):
+        pass
+
+    table = make_table(read_rows(filename), dtype)
+    try:
+        cache_dir = os.path.dirname(cache)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # drop caches of older versions of the table
+        for old in glob.glob(prefix + '*.npy'):
+            os.remove(old)
+        # write atomically, since many jobs may share the cache
+        tmp_name = '%s.%d.tmp' % (cache, os.getpid())
+        f = open(tmp_name, 'wb')
+        np.save(f, table)
+        f.close()
+        os.rename(tmp_name, cache)
+    except (IOError, OSError):
+        # e.g. no space or permissions; just don't cache
+        pass
+    return table
+
+def load_xs_table(xs_file):
+    return load_table(xs_file, read_xs_rows, XS_DTYPE)
+
+def load_counts_table(counts_file):
+    return load_table(counts_file, read_counts_rows, COUNTS_DTYPE)
+
+''' Find the rows of a table for an array of DSIDs (by binary search).
+    Returns (row indices, mask of the DSIDs which were found) '''
+def find_rows(table, dsids):
+    dsids = np.asarray(dsids, dtype=np.int64)
+    if len(table) == 0:
+        return np.zeros(dsids.shape, dtype=int), np.zeros(dsids.shape, dtype=bool)
+    idx = np.minimum(np.searchsorted(table['dsid'], dsids), len(table) - 1)
+    return idx, table['dsid'][idx] == dsids
+
+
+def parse_xs_file(xs_file):
+    xs_info = {}
+    for row in load_xs_table(xs_file).tolist():
+        dsid, xs, kfac, filt = row
+        xs_info[dsid] = {'xs': xs, 'kfac': kfac, 'filter': filt}
+    return xs_info
+
+
+def parse_counts_file(counts_file):
+    counts_info = {}
+    for row in load_counts_table(counts_file).tolist():
+        dsid, nevt, nevt_wt = row
         counts_info[dsid] = {'nevt': nevt, 'nevt_wt': nevt_wt}
     return counts_info
 
 
+''' Return (dsids, weights) arrays (without the lumi scale) for all DSIDs defined in both files '''
+def compute_lumi_weight_arrays(xs_file, counts_file):
+    xs = load_xs_table(xs_file)
+    counts = load_counts_table(counts_file)
+
+    # the DSID's which are defined in both files.
+    dsids, ix, ic = np.intersect1d(xs['dsid'], counts['dsid'], assume_unique=True, return_indices=True)
+    x = xs[ix]
+    weights = x['xs'] * x['kfac'] * x['filter'] / counts['nevt_wt'][ic]
+    return dsids, weights
+
+''' Return {dsid: weight} (without the lumi scale) for all DSIDs defined in both files '''
+def compute_lumi_weights(xs_file, counts_file):
+    dsids, weights = compute_lumi_weight_arrays(xs_file, counts_file)
+    return dict(zip(dsids.tolist(), weights.tolist()))
+
+
 def init_lumi_weights(xs_file, counts_file, lumi_scale=1.0):
+    load_weights_library()
     r.clear_lumi_weights()
     r.set_lumi_scale(lumi_scale)
 
-    xs_info = parse_xs_file(xs_file)
-    counts_info = parse_counts_file(counts_file)
+    dsids, weights = compute_lumi_weight_arrays(xs_file, counts_file)
+    for dsid, lumi_weight in zip(dsids.tolist(), weights.tolist()):
+        r.set_lumi_weight(dsid, lumi_weight)
 
-    # get a list of DSID's which are defined in both files.
-    dsid_defined = set(xs_info.keys()).intersection(counts_info.keys())
+    return LumiWeightTable(dsids, weights, lumi_scale)
 
-    for dsid in dsid_defined:
-        c = counts_info[dsid]
-        x = xs_info[dsid]
-        lumi_weight = x['xs'] * x['kfac'] * x['filter'] / c['nevt_wt']
 
-        r.set_lumi_weight(dsid, lumi_weight)
+'''
+ A numpy DSID -> lumi weight table, for weighting whole arrays of
+ mc_dataset_id at once. The DSIDs are kept in a sorted array and looked up
+ with a binary search; if the DSIDs are dense enough, a direct-indexed
+ array is used instead. Unlike get_lumi_weight(), DSIDs which are not in
+ the table are never silently given a weight.
+'''
+class LumiWeightTable(object):
+
+    # use a direct-indexed array if it is at most this many times
+    # larger than the number of DSIDs
+    DENSE_FACTOR = 4
+
+    def __init__(self, dsids, weights, lumi_scale=1.0):
+        dsids = np.asarray(dsids, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        order = np.argsort(dsids)
+        self.dsids = dsids[order]
+        self.weights = weights[order]
+        self.lumi_scale = lumi_scale
+
+        self._dense = None
+        if len(self.dsids) > 0:
+            self._offset = self.dsids[0]
+            span = self.dsids[-1] - self._offset + 1
+            if span <= self.DENSE_FACTOR * len(self.dsids):
+                self._dense = np.full(span, np.nan)
+                self._dense[self.dsids - self._offset] = self.weights
+
+    @staticmethod
+    def from_files(xs_file, counts_file, lumi_scale=1.0):
+        dsids, weights = compute_lumi_weight_arrays(xs_file, counts_file)
+        return LumiWeightTable(dsids, weights, lumi_scale)
+
+    def __len__(self):
+        return len(self.dsids)
+
+    def __contains__(self, dsid):
+        return bool(self.known(dsid))
+
+    ''' Return (weights without lumi scale, mask of known DSIDs) '''
+    def _lookup(self, dsids):
+        dsids = np.asarray(dsids, dtype=np.int64)
+        if len(self.dsids) == 0:
+            return np.zeros(dsids.shape), np.zeros(dsids.shape, dtype=bool)
+
+        if self._dense is not None:
+            idx = dsids - self._offset
+            in_range = (idx >= 0) & (idx < len(self._dense))
+            w = self._dense[np.where(in_range, idx, 0)]
+            known = in_range & ~np.isnan(w)
+        else:
+            idx = np.searchsorted(self.dsids, dsids)
+            idx = np.minimum(idx, len(self.dsids) - 1)
+            known = self.dsids[idx] == dsids
+            w = self.weights[idx]
+        return np.where(known, w, 0.), known
+
+    ''' Boolean mask of the DSIDs which are in the table '''
+    def known(self, dsids):
+        return self._lookup(dsids)[1]
+
+    ''' The distinct DSIDs which are not in the table '''
+    def unknown(self, dsids):
+        dsids = np.asarray(dsids, dtype=np.int64)
+        return np.unique(dsids[~self.known(dsids)])
+
+    '''
+     The lumi weights (including the lumi scale) for an array of DSIDs.
+     If any DSID is not in the table, a KeyError is raised, unless a
+     default weight is given.
+    '''
+    def lookup(self, dsids, default=None):
+        w, known = self._lookup(dsids)
+        w = self.lumi_scale * w
+        if not known.all():
+            if default is None:
+                unknown = np.unique(np.asarray(dsids)[~known])
+                raise KeyError("no lumi weight for DSID(s) %s" % ', '.join(map(str, unknown)))
+            # NB: not item assignment, since a scalar DSID gives a scalar weight
+            w = np.where(known, w, default)
+            if w.ndim == 0:
+                w = w[()]
+        return w
+
+    __call__ = lookup
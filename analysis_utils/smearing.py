@@ -0,0 +1,166 @@
+'''
+ Vectorized smearing for systematic variations, with reproducible
+ random numbers.
+
+ Rather than drawing from the global numpy.random state (which depends on
+ the order in which variations, entries and workers happen to run), each
+ random number is a hash of (seed, stream, entry number, object index,
+ draw): a counter-based generator. A given variation therefore sees the
+ same random numbers for a given entry no matter the batch size, the
+ number of workers, or where a job was restarted, and there is no
+ generator to reseed per entry.
+
+     rng = RandomStream(1234, 'smeared muons', 'mu_pt')
+     entry = entry_numbers(self._source)
+     # event-at-a-time: one value per muon of the current entry
+     pt = smear_pt(pts, 0.2, rng, entry, np.arange(len(pts)))
+     # batched: per-entry arrays, with entry = BatchSource.entry_numbers()
+     met_et, met_phi = smear_met(self.met_et, self.met_phi, 20., rng, entry)
+
+ Widths may be arrays over the members of a parametric family (see
+ parametric.ParametricVariation.param), and a stream may be given one
+ name per member, so that every member draws from its own stream. The
+ results then have a leading member axis, along which 1-d (per-member)
+ widths are applied.
+
+ The hash is the splitmix64 finalizer, computed on uint64 arrays.
+'''
+
+import struct
+import hashlib
+from _lazy import lazy_import
+
+np = lazy_import('numpy')
+
+_GAMMA = 0x9e3779b97f4a7c15
+_MIX1 = 0xbf58476d1ce4e5b9
+_MIX2 = 0x94d049bb133111eb
+
+''' splitmix64: hash an array of uint64 (in place) '''
+def _mix(z):
+    z += np.uint64(_GAMMA)
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(_MIX1)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(_MIX2)
+    z ^= z >> np.uint64(31)
+    return z
+
+''' A 64-bit key for the given seed and names '''
+def stream_key(seed, *names):
+    digest = hashlib.md5('\0'.join([str(seed)] + [str(n) for n in names])).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+'''
+ The entry number(s) of a variation's source: the array of entry numbers
+ of a BatchSource, or the current entry of a TTree/TChain (which, for a
+ TChain, counts over all its files).
+'''
+def entry_numbers(source):
+    try:
+        return source.entry_numbers()
+    except AttributeError:
+        return source.GetReadEntry()
+
+class RandomStream(object):
+
+    '''
+     `names` identify the stream, e.g. the variation and the quantity it
+     smears; a list (as the first name) gives one stream per member of a
+     family, along a new leading axis.
+    '''
+    def __init__(self, seed, *names):
+        if names and isinstance(names[0], (list, tuple)):
+            self._keys = np.array([stream_key(seed, member, *names[1:]) for member in names[0]],
+                                  dtype=np.uint64)
+        else:
+            self._keys = np.uint64(stream_key(seed, *names))
+
+    ''' Raw 64-bit hashes for the given entries, object indices and draw '''
+    def bits(self, entries, index=0, draw=0):
+        entries = np.asarray(entries)
+        shape = np.broadcast(entries, np.asarray(index)).shape
+        keys = self._keys
+        if keys.ndim:
+            # one stream per member, along the leading axis
+            keys = keys.reshape(keys.shape + (1,) * len(shape))
+            shape = keys.shape[:1] + shape
+
+        z = np.empty(shape, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            z[...] = keys
+            z ^= entries.astype(np.uint64)
+            _mix(z)
+            z ^= np.asarray(index).astype(np.uint64)
+            _mix(z)
+            z ^= np.uint64(draw)
+            _mix(z)
+        return z
+
+    ''' Uniform random numbers in [0, 1) '''
+    def uniform(self, entries, index=0, draw=0):
+        return (self.bits(entries, index, draw) >> np.uint64(11)) * (1. / (1 << 53))
+
+    ''' Standard normal random numbers (Box-Muller, two draws each) '''
+    def normal(self, entries, index=0, draw=0):
+        u1 = self.uniform(entries, index, 2 * draw)
+        u2 = self.uniform(entries, index, 2 * draw + 1)
+        return np.sqrt(-2. * np.log1p(-u1)) * np.cos(2. * np.pi * u2)
+
+''' Shape per-member values, shape (N,), to broadcast along the leading
+    (member) axis of an array with ndim dimensions '''
+def per_member(x, ndim):
+    x = np.asarray(x)
+    if x.ndim == 1 and ndim > 1:
+        return x.reshape(x.shape + (1,) * (ndim - 1))
+    return x
+
+'''
+ Smear the (x, y) components of the MET by a gaussian of the given width;
+ return the smeared (et, phi).
+'''
+def smear_met(et, phi, width, stream, entries):
+    dx = stream.normal(entries, 0, 0)
+    dy = stream.normal(entries, 0, 1)
+    width = per_member(width, dx.ndim)
+    x = et * np.cos(phi) + width * dx
+    y = et * np.sin(phi) + width * dy
+    return np.hypot(x, y), np.arctan2(y, x)
+
+'''
+ Smear object momenta by a relative gaussian resolution, independently
+ for each object; `index` is the index of each object within its entry
+ (see object_indices).
+'''
+def smear_pt(pt, width, stream, entries, index):
+    noise = stream.normal(entries, index)
+    return pt * (1. + per_member(width, noise.ndim) * noise)
+
+'''
+ Energy-scale variation: scale all objects of an entry by the same
+ factor, 1 + shift + width * (a gaussian drawn once per entry), i.e. a
+ fixed shift and/or a random scale uncertainty correlated across the
+ objects of an entry.
+'''
+def smear_scale(values, stream, entries, shift=0., width=0.):
+    # the shape of a per-member scale, i.e. with a leading member axis
+    member_ndim = np.ndim(entries) + 1
+    scale = 1. + per_member(shift, member_ndim)
+    if np.any(width):
+        noise = stream.normal(entries, 0)
+        scale = scale + per_member(width, noise.ndim) * noise
+    if np.ndim(scale) == member_ndim:
+        # in event-at-a-time mode, there is one scale per entry, but the
+        # values are per object
+        scale = scale.reshape(scale.shape + (1,) * (np.ndim(values) - np.ndim(entries)))
+    return values * scale
+
+'''
+ For a flat array of objects, with counts[i] objects in entry i of a
+ batch: return the (entry number, index within the entry) of each object.
+'''
+def object_indices(entries, counts):
+    counts = np.asarray(counts, dtype=int)
+    starts = np.cumsum(counts) - counts
+    index = np.arange(counts.sum()) - np.repeat(starts, counts)
+    return np.repeat(entries, counts), index
@@ -0,0 +1,254 @@
+'''
+ Progress and throughput metrics for the event loops, for monitoring
+ batch jobs:
+
+     from analysis_utils.telemetry import Telemetry, JSONLinesSink, HTTPSink
+     telemetry = Telemetry([JSONLinesSink('job.metrics.jsonl'), HTTPSink(9100)],
+                           interval=10000)
+     run(input_tree, nominal, variations, telemetry=telemetry)
+
+ Every `interval` entries (and/or `seconds` seconds), and once more at
+ the end, the driver's counters are turned into a snapshot, which is a
+ dict like:
+
+     {'time': 1700000000.0, 'elapsed': 12.3, 'final': False,
+      'entries': 50000, 'total': 200000, 'progress': 0.25,
+      'rate': {'instant': 4100., 'average': 4065.},         # entries/s
+      'bytes_read': 123456789,
+      'bytes_rate': {'instant': 1.0e7, 'average': 1.0e7},  # bytes/s
+      'pass_rate': {'nominal': 0.12, ...},                  # per variation
+      'time_split': {'io': 2.1, 'process': 8.4, 'output': 1.2, 'other': 0.6},
+      'max_rss': 512000000}                                 # bytes
+
+ which is handed to each sink: a plain callable, a JSONLinesSink (one
+ JSON object per line), or an HTTPSink, which serves the latest snapshot
+ on a local port, as JSON on / and in the Prometheus text format on
+ /metrics. The bytes read are only known if ROOT is in use.
+'''
+
+import sys
+import time
+import json
+import resource
+import threading
+import BaseHTTPServer
+
+''' Peak resident memory of this process, in bytes '''
+def max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NB: reported in bytes on OS X, but in kB elsewhere
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+''' Total bytes read from ROOT files so far, or None without ROOT '''
+def bytes_read():
+    ROOT = sys.modules.get('ROOT')
+    if ROOT is None:
+        return None
+    try:
+        return int(ROOT.TFile.GetFileBytesRead())
+    except AttributeError:
+        return None
+
+class Telemetry(object):
+
+    def __init__(self, sinks=(), interval=10000, seconds=None):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.seconds = seconds
+        self.reset()
+
+    def reset(self):
+        self.entries = 0
+        self.total = 0
+        self.passed = {}
+        # time spent reading input, in the process functions, and writing output
+        self.io_time = 0.
+        self.process_time = 0.
+        self.output_time = 0.
+        self.last_snapshot = None
+
+        self._tstart = None
+        self._tlast = None
+        self._last_entries = 0
+        self._bytes_start = None
+        self._last_bytes = None
+        self._next_entries = self.interval
+
+    ''' Called by the driver before the loop '''
+    def start(self, total, variations):
+        self.reset()
+        self.total = total
+        self.passed = dict((v._name, 0) for v in variations)
+        self._tstart = self._tlast = time.time()
+        self._bytes_start = self._last_bytes = bytes_read()
+
+    ''' Count the variations which accepted the current entry '''
+    def count_passed(self, variations):
+        passed = self.passed
+        for v in variations:
+            if v._valid:
+                passed[v._name] += 1
+
+    ''' Add counts for a batch, given {variation name: number of entries passed} '''
+    def add_passed(self, counts):
+        for name, n in counts.items():
+            self.passed[name] += n
+
+    ''' Called by the driver after each entry (or batch); emits a snapshot when due '''
+    def update(self, entries):
+        self.entries = entries
+        if self.interval and entries >= self._next_entries:
+            self._next_entries = (entries // self.interval + 1) * self.interval
+            self.emit()
+        elif self.seconds and time.time() - self._tlast >= self.seconds:
+            self.emit()
+
+    ''' Called by the driver after the loop '''
+    def finish(self, entries=None):
+        if entries is not None:
+            self.entries = entries
+        self.emit(final=True)
+
+    def snapshot(self, final=False):
+        tnow = time.time()
+        elapsed = tnow - self._tstart
+        dt = tnow - self._tlast
+        n = self.entries
+        nbytes = bytes_read()
+
+        snap = {'time': tnow,
+                'elapsed': elapsed,
+                'final': final,
+                'entries': n,
+                'total': self.total,
+                'progress': float(n) / self.total if self.total else 1.,
+                'rate': {'instant': (n - self._last_entries) / dt if dt > 0 else 0.,
+                         'average': n / elapsed if elapsed > 0 else 0.},
+                'pass_rate': dict((name, float(k) / n if n else 0.) for name, k in self.passed.items()),
+                'time_split': {'io': self.io_time,
+                               'process': self.process_time,
+                               'output': self.output_time,
+                               'other': max(0., elapsed - self.io_time - self.process_time - self.output_time)},
+                'max_rss': max_rss()}
+        if nbytes is not None and self._bytes_start is not None:
+            snap['bytes_read'] = nbytes - self._bytes_start
+            snap['bytes_rate'] = {'instant': (nbytes - self._last_bytes) / dt if dt > 0 else 0.,
+                                  'average': (nbytes - self._bytes_start) / elapsed if elapsed > 0 else 0.}
+        else:
+            snap['bytes_read'] = None
+            snap['bytes_rate'] = None
+
+        self._tlast = tnow
+        self._last_entries = n
+        self._last_bytes = nbytes
+        return snap
+
+    def emit(self, final=False):
+        snap = self.snapshot(final)
+        self.last_snapshot = snap
+        for sink in self.sinks:
+            sink(snap)
+        return snap
+
+    ''' Close the sinks which need it (files, servers) '''
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+''' Append each snapshot to a file, as one JSON object per line '''
+class JSONLinesSink(object):
+
+    def __init__(self, filename, mode='a'):
+        self.filename = filename
+        self._file = open(filename, mode)
+
+    def __call__(self, snapshot):
+        self._file.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+''' Render a snapshot in the Prometheus text exposition format '''
+def prometheus_text(snapshot, prefix='analysis'):
+    lines = []
+    def metric(name, value, labels=None, kind='gauge'):
+        if value is None:
+            return
+        full = '%s_%s' % (prefix, name)
+        if not any(l.startswith('# TYPE %s ' % full) for l in lines):
+            lines.append('# TYPE %s %s' % (full, kind))
+        if labels:
+            label_str = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+            lines.append('%s{%s} %s' % (full, label_str, repr(float(value))))
+        else:
+            lines.append('%s %s' % (full, repr(float(value))))
+
+    metric('entries_processed', snapshot['entries'], kind='counter')
+    metric('entries_total', snapshot['total'])
+    metric('progress', snapshot['progress'])
+    for kind in ('instant', 'average'):
+        metric('entries_per_second', snapshot['rate'][kind], {'kind': kind})
+    metric('bytes_read', snapshot['bytes_read'], kind='counter')
+    if snapshot['bytes_rate'] is not None:
+        for kind in ('instant', 'average'):
+            metric('bytes_per_second', snapshot['bytes_rate'][kind], {'kind': kind})
+    for name, rate in sorted(snapshot['pass_rate'].items()):
+        metric('pass_rate', rate, {'variation': name})
+    for part, t in sorted(snapshot['time_split'].items()):
+        metric('time_seconds', t, {'part': part}, kind='counter')
+    metric('max_rss_bytes', snapshot['max_rss'])
+    metric('finished', 1 if snapshot['final'] else 0)
+    return '\n'.join(lines) + '\n'
+
+
+class _SnapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        snapshot = self.server.snapshot
+        if snapshot is None:
+            self.send_error(503, 'no metrics yet')
+            return
+        if self.path.startswith('/metrics'):
+            body = prometheus_text(snapshot)
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(snapshot, sort_keys=True)
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # keep the job's output clean
+        pass
+
+'''
+ Serve the latest snapshot over HTTP on a background thread: JSON on /,
+ and the Prometheus text format on /metrics. port=0 picks a free port
+ (see .port). Only listens on localhost unless told otherwise.
+'''
+class HTTPSink(object):
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        self._server = BaseHTTPServer.HTTPServer((host, port), _SnapshotHandler)
+        self._server.snapshot = None
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, snapshot):
+        self._server.snapshot = snapshot
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
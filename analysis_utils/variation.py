@@ -2,7 +2,7 @@
 
 import inspect
 
-from cutflow import Cutflow, SkipEvent
+from cutflow import Cutflow, SkipEvent, SKIP_EVENT
 
 '''
  Exception to be thrown if a calculation fails.
@@ -31,17 +31,44 @@ class CalculationFallback(Exception):
 '''
 class AnalysisVariation:
 
+    # calculables whose value doesn't depend on the configuration, which
+    # may be shared by variations with different settings (see
+    # CalculableGraph.share)
+    _config_independent = ()
+
     def __init__(self, source=None, process_fn=None, name='Variation', fallback=None, **kwargs):
         self._calculables = {}
         self._source = source
         self._fallback = fallback
 
+        # names of the calculables computed (and cached) for the current entry
+        self._computed = []
+
+        # optional observer, which is notified of every calculable and source
+        # access (see calc_graph.CalculableGraph). While it is set, cached
+        # values are kept in self._cache rather than as instance attributes.
+        self._observer = None
+        self._cache = {}
+
+        # calculable name -> variation from which to take its value,
+        # instead of computing it (see share_calculables)
+        self._shared = {}
+
+        # the remaining keyword arguments are considered to be this
+        # variation's configuration (e.g. systematic shifts).
+        self._config = sorted((k, v) for k, v in kwargs.items() if k != 'output_name')
+
         self._process_fn = process_fn
         self._name = name
         self._warn_once = False
 
         self.set_valid(False)
 
+        # in batched mode (see variation_loop.run_batched), this holds
+        # a boolean array flagging which entries of the current batch
+        # have survived all cuts so far. None in event-at-a-time mode.
+        self._mask = None
+
         self._cutflow = Cutflow()
 
         # set up a list of calculable items by sniffing out methods
@@ -68,7 +95,7 @@ class AnalysisVariation:
         # NB this is slow... maybe we should optimize.
         # but we'll put it here as a convenience method.
         try:
-            self._process_fn(self)
+            return self._process_fn(self)
         except TypeError as e:
             if e.message == "'NoneType' object is not callable":
                 if not self._warn_once:
@@ -94,6 +121,24 @@ class AnalysisVariation:
             print "WARNING! Base class accept_entry() invoked for variation `%s`!" % self._name
             self._warn_once = True
 
+    '''
+     Batched-mode equivalent of accept_entry()/reject_entry(). `keep` flags
+     the entries of the current batch which were accepted for *some*
+     variation; self._mask flags those which this instance passed.
+     By default, each kept entry is handed in order to accept_entry() or
+     reject_entry(), with self.batch_entry set to its index in the batch.
+     Override this to write out the whole batch at once.
+    '''
+    def accept_batch(self, keep):
+        for i in keep.nonzero()[0]:
+            self.batch_entry = i
+            if self._mask[i]:
+                self.set_valid(True)
+                self.accept_entry()
+            else:
+                self.set_valid(False)
+                self.reject_entry()
+
     '''
      This method is called if the input entry was accepted for *some* variation,
      but this instance did not pass (i.e. this entry is not valid). It may be used,
@@ -102,34 +147,87 @@ class AnalysisVariation:
     def reject_entry(self):
         pass
 
+    '''
+     Return a list of the TTrees this instance writes its output to, if any.
+     Drivers use this e.g. to redirect the output of a worker process.
+    '''
+    def get_output_trees(self):
+        return []
+
+    '''
+     Return a dict of {name: cutflow} for this instance, e.g. for saving
+     (see variation_loop.save_variation_cutflows).
+    '''
+    def get_cutflows(self):
+        return {self._name: self._cutflow}
+
     '''
      Reset the state of all managed calculables. Also set the current entry status
      to invalid for this object.
     '''
     def reset(self):
-        # delete any cached calcuable results
-        for c in self._calculables:
-            try:
-                delattr(self, c)
-            except AttributeError:
-                # fine, nothing to delete. it was never set.
-                pass
+        # delete any cached calcuable results. only the ones which
+        # were actually computed for this entry need to be touched.
+        d = self.__dict__
+        for c in self._computed:
+            d.pop(c, None)
+        del self._computed[:]
+        if self._cache:
+            self._cache.clear()
 
         # and set state to invalid
         self.set_valid(False)
 
+    def set_mask(self, mask):
+        self._mask = mask
+
+    def get_mask(self):
+        return self._mask
+
+    '''
+     In event-at-a-time mode, raise SkipEvent if `expr` is true.
+     In batched mode, `expr` is a boolean array over the batch; the
+     entries for which it is true are masked out, and SkipEvent is only
+     raised once no entries of the batch remain.
+    '''
     def cut_if(self, expr, cutname):
-        self._cutflow.cut_if(expr, cutname)
+        if not self.passes_cut(expr, cutname):
+            raise SKIP_EVENT
+
+    '''
+     Like cut_if(), but return False instead of raising SkipEvent, and
+     True otherwise. The drivers treat a process function returning False
+     like one raising SkipEvent, so a cutflow can be written as:
+         if not v.passes_cut(len(v.muons) < 2, '2muons'):
+             return False
+     which avoids the cost of the exception for every rejected entry.
+    '''
+    def passes_cut(self, expr, cutname):
+        if self._mask is None:
+            return self._cutflow.passes_cut(expr, cutname)
+
+        from numpy import logical_and, logical_not
+        if self._cutflow.cut_times is not None:
+            self._cutflow.record_time(cutname)
+        self._mask = logical_and(self._mask, logical_not(expr))
+        self._cutflow.add_batch(cutname, self._mask)
+        return bool(self._mask.any())
 
     def defer(self):
+        if self._observer is not None:
+            self._observer.defer_point(self)
         if self._fallback:
             raise CalculationFallback
 
     def defer_if(self, expr):
+        if self._observer is not None:
+            self._observer.defer_point(self)
         if self._fallback and expr:
             raise CalculationFallback
 
     def defer_unless(self, expr):
+        if self._observer is not None:
+            self._observer.defer_point(self)
         if self._fallback and not expr:
             raise CalculationFallback
 
@@ -139,23 +237,90 @@ class AnalysisVariation:
     def set_valid(self, valid):
         self._valid = valid
 
+    '''
+     Attach an observer (or None to detach). This should only be done
+     between entries, i.e. right before reset().
+    '''
+    def set_observer(self, observer):
+        self._observer = observer
+
+    '''
+     Take the values of the named calculables from `other` (which must
+     compute the same thing!) rather than computing them again. May be
+     called several times, to share different calculables with different
+     variations.
+    '''
+    def share_calculables(self, other, names):
+        if other is self:
+            return
+        for name in names:
+            self._shared[name] = other
+
     def __getattr__(self, attr):
         # here's the magic. if the requested attribute is calculable,
         # go calculate it and then cache the result.
+        if self._observer is not None:
+            return self._observed_getattr(attr)
+
         try:
-            # user tried to access a calculable item, but it's not cached.
-            # calculate and save the result, then return it.
-            v = self._calculables[attr]()
-            setattr(self, attr, v)
-            return v
+            calculate = self._calculables[attr]
         except KeyError:
             # we're not managing this attribute, so escalate to the
             # "source" object (which by default is the underlying
             # TTree):
             return getattr(self._source, attr)
+
+        # user tried to access a calculable item, but it's not cached.
+        # calculate and save the result, then return it.
+        try:
+            if attr in self._shared:
+                v = getattr(self._shared[attr], attr)
+            else:
+                v = calculate()
         except CalculationFallback:
             # defer the calculation to the fallback object
-            return getattr(self._fallback, attr)
+            v = getattr(self._fallback, attr)
+        setattr(self, attr, v)
+        self._computed.append(attr)
+        return v
+
+    '''
+     Same as __getattr__, but reports every access to the observer.
+    '''
+    def _observed_getattr(self, attr):
+        observer = self._observer
+        try:
+            calculate = self._calculables[attr]
+        except KeyError:
+            if not attr.startswith('__'):
+                observer.read_source(self, attr)
+            return getattr(self._source, attr)
+
+        try:
+            v = self._cache[attr]
+            observer.cache_hit(self, attr)
+            return v
+        except KeyError:
+            pass
+
+        status = 'failed'
+        observer.begin(self, attr)
+        try:
+            try:
+                if attr in self._shared:
+                    v = getattr(self._shared[attr], attr)
+                    status = 'shared'
+                else:
+                    v = calculate()
+                    status = 'computed'
+            except CalculationFallback:
+                status = 'deferred'
+                v = getattr(self._fallback, attr)
+        finally:
+            observer.end(self, attr, status)
+
+        self._cache[attr] = v
+        return v
 
     def __str__(self):
         return "<Varation object `%s`>" % self._name
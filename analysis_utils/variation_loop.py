@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 
+import os
 import variation
 import time
+from calc_graph import CalculableGraph
+from profiler import CalculableProfiler, ObserverGroup
+from cutflow import ArrayCutflow, save_cutflows
+from checkpoint import Checkpointer, check_unique_names
 
 ''' The number of events between status printouts '''
 STATUS_INTERVAL = 5000
 
-def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
+''' The default number of entries per batch for run_batched() '''
+BATCH_SIZE = 10000
+
+''' Set the source and fallback references for all the variations,
+    and return the full list of variations to run (including nominal) '''
+def prepare_variations(input_tree, nominal=None, variations=[]):
     variations = variations[:]
     # set the fallback reference for all the variations.
     for v in variations:
@@ -18,6 +28,26 @@ def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
         nominal.set_source(input_tree)
         variations.append(nominal)
 
+    return variations
+
+''' Switch the variations to weighted cutflows (see cutflow.ArrayCutflow),
+    keeping any counts they already have '''
+def use_weighted_cutflows(variations):
+    for v in variations:
+        if not isinstance(v._cutflow, ArrayCutflow):
+            v._cutflow = ArrayCutflow.from_cutflow(v._cutflow)
+
+''' Save the cutflows of all variations to a single file (see cutflow.save_cutflows);
+    families of variations (see parametric.ParametricVariation) save one per member '''
+def save_variation_cutflows(filename, variations):
+    cutflows = {}
+    for v in variations:
+        cutflows.update(v.get_cutflows())
+    save_cutflows(filename, cutflows)
+
+def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
+    variations = prepare_variations(input_tree, nominal, variations)
+
     variations_and_functions = [(v, v._process_fn) for v in variations]
 
     if len(variations) == 0:
@@ -29,19 +59,167 @@ def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
     if entry_limit < 1:
         entry_limit = total_entries +1
 
-    input_tree.GetEntry(0)
+    # optionally, only process the entry range [first_entry, last_entry)
+    first_entry = kwargs.get('first_entry', 0)
+    last_entry = kwargs.get('last_entry', None)
+    if last_entry is None or last_entry > total_entries:
+        last_entry = total_entries
+
+    # optionally, checkpoint the output periodically, and resume from the
+    # last checkpoint if there is one (see checkpoint.Checkpointer)
+    checkpointer = None
+    checkpoint = None
+    start = 0
+    if kwargs.get('checkpoint_file', None):
+        check_unique_names(variations)
+        checkpointer = Checkpointer(kwargs['checkpoint_file'],
+                                    kwargs.get('checkpoint_every', None),
+                                    kwargs.get('checkpoint_seconds', None))
+        checkpoint = checkpointer.load()
+        if checkpoint is not None:
+            if checkpoint['first_entry'] != first_entry or checkpoint['last_entry'] != last_entry:
+                raise RuntimeError("checkpoint %s is for a different entry range" % checkpointer.filename)
+            if not silent:
+                print "Resuming from checkpoint %s at entry %d" % (checkpointer.filename, checkpoint['entry'])
+            # NB: the loop index keeps counting from first_entry, so that
+            # entry_limit and the checkpoint intervals are unchanged
+            start = checkpoint['entry'] - first_entry
+    n_entries = last_entry - first_entry
+
+    # optionally, fill weighted cutflows. event_weight is a function of the
+    # input tree, returning the weight of the current entry, e.g.
+    #   event_weight=lambda t: lumi_table.lookup(t.mc_dataset_id)
+    event_weight = kwargs.get('event_weight', None)
+    if event_weight is not None:
+        use_weighted_cutflows(variations)
+    cutflow_file = kwargs.get('cutflow_file', None)
+
+    # optionally, record the calculable dependency graph for the first
+    # `warmup` entries (see calc_graph.CalculableGraph). The graph can
+    # then be used to share calculables between equivalent variations.
+    graph = kwargs.get('calculable_graph', None)
+    share = kwargs.get('share_calculables', False)
+    if share and graph is None:
+        graph = CalculableGraph()
+    warmup = kwargs.get('warmup', 1000) if graph is not None else 0
+
+    # optionally, profile the calculables and cuts of all variations
+    # for the whole run (see profiler.CalculableProfiler).
+    profiler = kwargs.get('profiler', None)
+    if profiler is None and kwargs.get('profile', False):
+        profiler = CalculableProfiler()
+    if profiler is not None:
+        for v in variations:
+            v._cutflow.enable_timing()
+        variations_and_functions = [(v, timed_process_fn(v, p)) for v, p in variations_and_functions]
+
+    if graph is not None and profiler is not None:
+        observer = ObserverGroup([graph, profiler])
+    else:
+        observer = graph or profiler
+    for v in variations:
+        v.set_observer(observer)
+
+    # optionally, only read the branches which the analysis actually uses.
+    # the read-set is either loaded from `read_set_file` or from the
+    # `read_set_cache` (see root.read_set_cache), or learned during the first
+    # `learn_branches` entries (and then saved to the file and/or cache).
+    # A known `read_set` (a list of branch names) is used as is.
+    read_set = kwargs.get('read_set', None)
+    read_set_file = kwargs.get('read_set_file', None)
+    learn_branches = kwargs.get('learn_branches', 0)
+    cache_size = kwargs.get('branch_cache_size', 30*1024*1024)
+    read_set_cache = kwargs.get('read_set_cache', None)
+    cache_key = None
+    cached_branches = None
+    if read_set_cache:
+        from root.read_set_cache import ReadSetCache
+        if read_set_cache is True:
+            read_set_cache = ReadSetCache()
+        cache_key = read_set_cache.key(variations, input_tree)
+        cached_branches = read_set_cache.lookup(cache_key)
+        if learn_branches < 1:
+            learn_branches = 1000
+
+    # once pruned, the branches are read through a guard (see
+    # root.profile_tree.BranchGuard), which re-enables any branch that
+    # is missing from the read-set, e.g. on a rare path of the analysis
+    recorder = None
+    guard = None
+    learned_file = None
+    if read_set is not None:
+        if not silent:
+            print "Using read-set of %d branches" % len(read_set)
+        guard = guard_pruned_tree(input_tree, read_set, variations, cache_size)
+    elif cached_branches is not None:
+        if not silent:
+            print "Using cached read-set %s (%d branches)" % (cache_key, len(cached_branches))
+        guard = guard_pruned_tree(input_tree, cached_branches, variations, cache_size)
+    elif read_set_file and os.path.exists(read_set_file):
+        from root.branch import load_read_set
+        branches = load_read_set(read_set_file, input_tree)
+        if not silent:
+            print "Loaded read-set of %d branches from %s" % (len(branches), read_set_file)
+        guard = guard_pruned_tree(input_tree, branches, variations, cache_size)
+    elif learn_branches > 0:
+        from root.profile_tree import AccessRecorder
+        recorder = AccessRecorder(input_tree)
+        learned_file = read_set_file
+        for v in variations:
+            v.set_source(recorder)
+
+    # optionally, prefetch and unzip baskets in the background, and keep
+    # track of the time spent waiting for input (see root.prefetch)
+    io_stats = None
+    if kwargs.get('prefetch', False):
+        from root.prefetch import enable_async_reading, IOStats
+        enable_async_reading(input_tree, cache_size)
+        io_stats = IOStats()
+
+    # optionally, report progress and throughput metrics (see telemetry.Telemetry)
+    telemetry = kwargs.get('telemetry', None)
+    timed = io_stats is not None or telemetry is not None
+
+    # NB: entry_limit counts from first_entry, like the loop index
+    stop = min(n_entries, entry_limit)
+
+    input_tree.GetEntry(first_entry)
     for v in variations:
         v.pre_run()
 
+    if checkpoint is not None:
+        checkpointer.restore(checkpoint, variations)
+
+    if telemetry is not None:
+        telemetry.start(max(0, stop - start), variations)
+
     tstart = t0 = time.time()
-    for i, evt in enumerate(input_tree):
+    for i in xrange(start, stop):
+        if checkpointer is not None and i > start and checkpointer.due(i):
+            checkpointer.save(first_entry + i, first_entry, last_entry, variations)
+        if i - start == learn_branches and recorder is not None:
+            guard = finish_learning(input_tree, recorder, variations, cache_size, silent,
+                                    read_set_file, read_set_cache, cache_key)
+            recorder = None
+        if i - start == warmup:
+            for v in variations:
+                v.set_observer(profiler)
+            if share:
+                graph.share(variations)
+
         if not silent and (i % STATUS_INTERVAL == 0):
             tnow = time.time()
-            print "Processed %d/%d ~ %.2f%% [%g Hz]" % (i, total_entries, 100. * i / (total_entries), STATUS_INTERVAL/(tnow-t0+0.0001))
+            print "Processed %d/%d ~ %.2f%% [%g Hz]" % (i, stop, 100. * i / (stop), STATUS_INTERVAL/(tnow-t0+0.0001))
             t0 = time.time()
-            if i>=entry_limit:
-                print "Entry limit reached (%d); quitting early." % (entry_limit)
-                break
+
+        if timed:
+            t_read = time.time()
+            input_tree.GetEntry(first_entry + i)
+            t_process = time.time()
+            if io_stats is not None:
+                io_stats.add_wait(t_process - t_read)
+        else:
+            input_tree.GetEntry(first_entry + i)
 
         for v in variations:
             # NB: all variations have to be reset before
@@ -49,16 +227,29 @@ def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
             # each other's cache (i.e. FallbackCalculation)
             v.reset()
 
+        if event_weight is not None:
+            # NB: read through the recorder or guard (if any), so the
+            # branches used for the weight end up in the read-set
+            w = event_weight(recorder or guard or input_tree)
+            for v in variations:
+                v._cutflow.weight = w
+
         keep = False
         for v, p in variations_and_functions:
             try:
-                p(v)
-                v.set_valid(True)
-                keep = True
+                # NB: returning False is equivalent to raising SkipEvent
+                if p(v) is not False:
+                    v.set_valid(True)
+                    keep = True
             except variation.SkipEvent:
                 # just move on to the next one!
                 pass
 
+        if telemetry is not None:
+            t_output = time.time()
+            telemetry.io_time += t_process - t_read
+            telemetry.process_time += t_output - t_process
+
         if keep:
             # if any of the variations managed to pass, write out everything.
             for v in variations:
@@ -66,9 +257,272 @@ def run(input_tree, nominal=None, variations=[], silent=False, **kwargs):
                     v.accept_entry()
                 else:
                     v.reject_entry()
+            if telemetry is not None:
+                telemetry.count_passed(variations)
 
+        if telemetry is not None:
+            telemetry.output_time += time.time() - t_output
+            telemetry.update(i - start + 1)
+
+    if stop < n_entries and not silent:
+        print "Entry limit reached (%d); quitting early." % (entry_limit)
+
+    if recorder is not None:
+        # ran out of entries before the end of the warm-up
+        guard = finish_learning(input_tree, recorder, variations, cache_size, silent,
+                                read_set_file, read_set_cache, cache_key)
+
+    if guard is not None:
+        finish_guard(input_tree, guard, variations, learned_file, read_set_cache, cache_key)
+
+    t_output = time.time()
     for v in variations:
+        v.set_observer(None)
         v.post_run()
+    if telemetry is not None:
+        telemetry.output_time += time.time() - t_output
+        telemetry.finish()
+
+    if checkpointer is not None:
+        checkpointer.finish()
+
+    if io_stats is not None and not silent:
+        io_stats.print_report()
+
+    if cutflow_file:
+        save_variation_cutflows(cutflow_file, variations)
+
+    if profiler is not None:
+        print ">>>> Profile: <<<<"
+        profiler.print_report(variations)
+
+''' Prune the input tree to `branches`, and let the variations read it
+    through a BranchGuard, which is returned. '''
+def guard_pruned_tree(input_tree, branches, variations, cache_size):
+    from root.branch import prune_branches
+    from root.profile_tree import BranchGuard
+
+    prune_branches(input_tree, branches, cache_size)
+    guard = BranchGuard(input_tree, branches, cache_size > 0)
+    for v in variations:
+        v.set_source(guard)
+    return guard
+
+''' Prune the input tree to the branches recorded during the warm-up,
+    and return the BranchGuard the variations now read through. '''
+def finish_learning(input_tree, recorder, variations, cache_size, silent,
+                    read_set_file=None, read_set_cache=None, cache_key=None):
+    from root.branch import save_read_set
+
+    branches = recorder.read_set()
+    if not silent:
+        print "Learned read-set of %d branches; disabling the others." % len(branches)
+    guard = guard_pruned_tree(input_tree, branches, variations, cache_size)
+    if read_set_file:
+        save_read_set(read_set_file, branches, 'branch read-set recorded by variation_loop.run()')
+    if read_set_cache:
+        read_set_cache.store(cache_key, branches, variations, input_tree)
+    return guard
+
+''' Restore the variations' source, and report any branches which had to be
+    activated after pruning. They are added to the learned read-set file
+    and/or the read-set cache, so the next run doesn't miss them. '''
+def finish_guard(input_tree, guard, variations, read_set_file=None,
+                 read_set_cache=None, cache_key=None):
+    from root.branch import save_read_set
+
+    for v in variations:
+        v.set_source(input_tree)
+    if not guard.activated:
+        return
+
+    print "Warning: %d branches were read after pruning: %s" % (
+        len(guard.activated), ', '.join(guard.activated))
+    branches = guard.read_set()
+    if read_set_file:
+        save_read_set(read_set_file, branches, 'branch read-set recorded by variation_loop.run()')
+    if read_set_cache:
+        read_set_cache.store(cache_key, branches, variations, input_tree)
+
+''' Wrap a process function such that the cut timers of the variation's
+    cutflow are started right before it is invoked. '''
+def timed_process_fn(v, process_fn):
+    def process(v):
+        # NB: look the cutflow up on each call, since it may be replaced
+        # after wrapping (e.g. when restored from a checkpoint)
+        v._cutflow.start_timer()
+        return process_fn(v)
+    return process
+
+'''
+ Columnar version of run(). Entries are read from the input tree in
+ batches of `batch_size`, and each variation's source is replaced by
+ a BatchSource, whose branches are numpy arrays over the batch.
+ Calculables should therefore operate on whole arrays, and cut_if()
+ expects a boolean array (see AnalysisVariation.cut_if).
+
+ The per-variation cutflows and the accept/reject semantics are the
+ same as for run(); output is written via AnalysisVariation.accept_batch().
+
+ With prefetch=N, branches are read ahead up to N batches in advance, in
+ a background process (or with prefetch_mode='thread', a thread); see
+ root.prefetch.Prefetcher. If the branches to read are known up front,
+ from `prefetch_branches` or else a read-set (`read_set_cache` or
+ `read_set_file`, as for run()), the first batch is read right away, and
+ the reader starts on the next ones while it is processed. Otherwise,
+ the branches read on demand by the first batch are read ahead for the
+ following batches.
+'''
+def run_batched(input_tree, nominal=None, variations=[], batch_size=BATCH_SIZE, silent=False, **kwargs):
+    import numpy as np
+    from root.batch import BatchSource, read_branch
+
+    variations = prepare_variations(input_tree, nominal, variations)
+
+    variations_and_functions = [(v, v._process_fn) for v in variations]
+
+    if len(variations) == 0:
+        print "Warning! No variations to process. Aborting..."
+        return
+
+    total_entries = input_tree.GetEntries()
+    entry_limit = kwargs.get('entry_limit', 0)
+    if entry_limit < 1 or entry_limit > total_entries:
+        entry_limit = total_entries
+
+    # see run()
+    event_weight = kwargs.get('event_weight', None)
+    if event_weight is not None:
+        use_weighted_cutflows(variations)
+
+    prefetch = kwargs.get('prefetch', 0)
+    prefetch_mode = kwargs.get('prefetch_mode', 'process')
+    prefetcher = None
+    ranges = [(start, min(start + batch_size, entry_limit))
+              for start in xrange(0, entry_limit, batch_size)]
+    if prefetch and len(ranges) > 1:
+        from root.prefetch import Prefetcher
+        prefetch_branches = prefetch_read_set(input_tree, variations, kwargs)
+    else:
+        prefetch = 0
+
+    # see run(). NB: here, reading branches on demand counts as processing;
+    # only the wait for prefetched batches counts as I/O.
+    telemetry = kwargs.get('telemetry', None)
+
+    input_tree.GetEntry(0)
+    for v in variations:
+        v.pre_run()
+
+    if telemetry is not None:
+        telemetry.start(entry_limit, variations)
+
+    t0 = time.time()
+    for k, (start, stop) in enumerate(ranges):
+        n = stop - start
+
+        if not silent:
+            tnow = time.time()
+            print "Processed %d/%d ~ %.2f%% [%g Hz]" % (start, total_entries, 100. * start / (total_entries), n/(tnow-t0+0.0001))
+            t0 = tnow
+
+        if telemetry is not None:
+            t_read = time.time()
+        columns = None
+        if prefetcher is not None:
+            columns = prefetcher.next()[2]
+        elif prefetch and prefetch_branches is not None:
+            # read the first batch here, which also gives the baseline for
+            # the time hidden by prefetching, and read ahead the next ones
+            # while it is processed
+            t_baseline = time.time()
+            columns = dict((b, read_branch(input_tree, b, start, stop)) for b in prefetch_branches)
+            t_baseline = time.time() - t_baseline
+            prefetcher = Prefetcher(input_tree, ranges[1:], prefetch_branches, prefetch, prefetch_mode)
+            prefetcher.stats.set_baseline(t_baseline, n)
+        if telemetry is not None:
+            t_process = time.time()
+        source = BatchSource(input_tree, start, stop, columns)
+        for v in variations:
+            # as in run(), reset everything before running anything.
+            v.reset()
+            v.set_source(source)
+            v.set_mask(np.ones(n, dtype=bool))
+
+        if event_weight is not None:
+            # as a function of the BatchSource, event_weight returns an array
+            w = np.broadcast_to(np.asarray(event_weight(source), dtype=float), (n,))
+            for v in variations:
+                v._cutflow.batch_weights = w
+
+        keep = np.zeros(n, dtype=bool)
+        for v, p in variations_and_functions:
+            try:
+                if p(v) is False:
+                    v.set_mask(np.zeros(n, dtype=bool))
+            except variation.SkipEvent:
+                v.set_mask(np.zeros(n, dtype=bool))
+            keep |= v.get_mask()
+
+        if prefetch and prefetcher is None:
+            # from now on, read ahead whatever the first batch needed
+            prefetcher = Prefetcher(input_tree, ranges[1:], source.branches_read(), prefetch, prefetch_mode)
+            prefetcher.stats.set_baseline(source.read_time, n)
+
+        if telemetry is not None:
+            t_output = time.time()
+            telemetry.io_time += t_process - t_read
+            telemetry.process_time += t_output - t_process
+            telemetry.add_passed(dict((v._name, int(v.get_mask().sum())) for v in variations))
+
+        if keep.any():
+            for v in variations:
+                v.accept_batch(keep)
+
+        if telemetry is not None:
+            telemetry.output_time += time.time() - t_output
+            telemetry.update(stop)
+
+    if prefetcher is not None:
+        prefetcher.close()
+        if not silent:
+            prefetcher.stats.print_report()
+
+    t_output = time.time()
+    for v in variations:
+        v.reset()
+        v.set_source(input_tree)
+        v.set_mask(None)
+        v.post_run()
+    if telemetry is not None:
+        telemetry.output_time += time.time() - t_output
+        telemetry.finish()
+
+    if kwargs.get('cutflow_file', None):
+        save_variation_cutflows(kwargs['cutflow_file'], variations)
+
+''' The branches for run_batched() to prefetch: `prefetch_branches`, or
+    else the read-set from `read_set_cache` or `read_set_file` (see run()).
+    None if they aren't known. '''
+def prefetch_read_set(input_tree, variations, kwargs):
+    branches = kwargs.get('prefetch_branches', None)
+    if branches is not None:
+        return list(branches)
+
+    read_set_cache = kwargs.get('read_set_cache', None)
+    if read_set_cache:
+        from root.read_set_cache import ReadSetCache
+        if read_set_cache is True:
+            read_set_cache = ReadSetCache()
+        branches = read_set_cache.lookup(read_set_cache.key(variations, input_tree))
+        if branches is not None:
+            return branches
+
+    read_set_file = kwargs.get('read_set_file', None)
+    if read_set_file and os.path.exists(read_set_file):
+        from root.branch import load_read_set
+        return load_read_set(read_set_file, input_tree)
+    return None
 
 if __name__ == "__main__":
     pass
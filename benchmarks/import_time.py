@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+'''
+ Measures the time to import the analysis_utils modules (and to run the
+ scripts with --help), each in a fresh interpreter, and checks that the
+ pure-python modules don't pull in ROOT or numpy.
+
+ Exits with a non-zero status if any module imports something it
+ shouldn't, or (with --max-ms) if any import takes longer than allowed:
+     python benchmarks/import_time.py --max-ms 200
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+''' Module name -> heavy modules which it must not import '''
+MODULES = [
+    ('analysis_utils.cutflow', ['ROOT', 'numpy']),
+    ('analysis_utils.variation', ['ROOT', 'numpy']),
+    ('analysis_utils.variation_loop', ['ROOT', 'numpy']),
+    ('analysis_utils.calc_graph', ['ROOT', 'numpy']),
+    ('analysis_utils.parametric', ['ROOT', 'numpy']),
+    ('analysis_utils.smearing', ['ROOT', 'numpy']),
+    ('analysis_utils.telemetry', ['ROOT', 'numpy']),
+    ('analysis_utils.profiler', ['ROOT', 'numpy']),
+    ('analysis_utils.root.branch', ['ROOT', 'numpy']),
+    ('analysis_utils.root.dpd_object', ['ROOT']),
+    ('analysis_utils.root.read_set_cache', ['ROOT', 'numpy']),
+    ('analysis_utils.root.schema_index', ['ROOT', 'numpy']),
+    ('analysis_utils.root.weights', ['ROOT', 'numpy']),
+]
+
+SCRIPTS = ['list_branches.py', 'filter_branches.py']
+
+CHECK_CODE = '''
+import sys, time
+t0 = time.time()
+import %s
+dt = time.time() - t0
+print dt, ' '.join(m for m in %r if m in sys.modules)
+'''
+
+def time_import(module, forbidden):
+    out = subprocess.check_output([sys.executable, '-c', CHECK_CODE % (module, forbidden)],
+                                  cwd=TOP_DIR)
+    fields = out.split()
+    return float(fields[0]), fields[1:]
+
+def time_script(script):
+    t0 = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(TOP_DIR, script), '--help'],
+                              stdout=devnull, cwd=TOP_DIR)
+    return time.time() - t0
+
+def best_of(n, fn, *args):
+    results = [fn(*args) for _ in xrange(n)]
+    return min(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import time of analysis_utils.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Take the best of this many runs')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if any module takes longer than this to import')
+    args = parser.parse_args()
+
+    failed = False
+    print "%-40s %10s  %s" % ('module', 'import [ms]', 'heavy imports')
+    for module, forbidden in MODULES:
+        dt, loaded = best_of(args.repeat, time_import, module, forbidden)
+        status = ''
+        if loaded:
+            status = 'FAIL: imports %s' % ', '.join(loaded)
+            failed = True
+        elif args.max_ms is not None and dt * 1e3 > args.max_ms:
+            status = 'FAIL: slower than %g ms' % args.max_ms
+            failed = True
+        print "%-40s %10.1f  %s" % (module, dt * 1e3, status)
+
+    print
+    print "%-40s %10s" % ('script', '--help [ms]')
+    for script in SCRIPTS:
+        dt = best_of(args.repeat, time_script, script)
+        print "%-40s %10.1f" % (script, dt * 1e3)
+
+    if failed:
+        sys.exit(1)
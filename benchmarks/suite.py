@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+'''
+ Throughput benchmarks for the hot paths of analysis_utils, on synthetic
+ D3PD-like input (see synthetic.py):
+
+   dpd.fetch_objects        build DPDObjects and read their attributes
+   dpd.getattr_cached       DPDObject attribute lookups from the shared cache
+   variation.calculables    reset() + resolving a chain of calculables
+   variation.reset          reset() alone
+   branch.match_branches    compile and match a branch selection
+   pytree.write[_buffered]  write_branch / write_object / Fill (needs ROOT)
+   run.variations_N         variation_loop.run() with N = 1, 10, 100 variations
+
+ Results are written as JSON, and can be compared with an earlier run to
+ catch regressions between commits:
+
+     python benchmarks/suite.py --out before.json
+     (change things)
+     python benchmarks/suite.py --out after.json --compare before.json
+
+ The comparison exits with a non-zero status if any benchmark got slower
+ than --threshold (by default 10%). With --root-file, the input is read
+ from a real TTree (written first if the file doesn't exist) instead of
+ the in-memory SyntheticTree.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+
+from analysis_utils.variation import AnalysisVariation
+from analysis_utils.variation_loop import run
+from analysis_utils.root.dpd_object import DPDObject, fetch_objects, get_objects
+from analysis_utils.root import branch
+from synthetic import SyntheticTree, SyntheticBranch, OBJECT_ATTRS, parse_multiplicities, write_root_file
+
+''' A benchmark is skipped (rather than failed) by raising this '''
+class Skip(Exception):
+    pass
+
+''' Registered benchmarks, in order: (name, function). A function takes
+    the context, and returns the number of operations it performed and
+    their unit; the harness times it. '''
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+class BenchVariation(AnalysisVariation):
+
+    def __init__(self, *args, **kwargs):
+        AnalysisVariation.__init__(self, *args, **kwargs)
+        self._pt_shift = kwargs.get('pt_shift', 0.)
+
+    def _get_muons(self):
+        self.defer_unless(self._pt_shift != 0)
+        return get_objects(self._source, 'mu')
+
+    def _get_hard_muons(self):
+        self.defer_unless(self._pt_shift != 0)
+        shift = 1 + self._pt_shift
+        return [mu for mu in self.muons if mu.pt * shift > 20e3]
+
+    def _get_jets(self):
+        self.defer()
+        return get_objects(self._source, 'jet')
+
+    def _get_ht(self):
+        return sum(j.pt for j in self.jets) + sum(mu.pt for mu in self.hard_muons)
+
+    def accept_entry(self):
+        pass
+
+def bench_cutflow(v):
+    if not v.passes_cut(len(v.hard_muons) < 1, '1mu'):
+        return False
+    if not v.passes_cut(v.ht < 100e3, 'ht100'):
+        return False
+    if not v.passes_cut(v.met_et < 30e3, 'met30'):
+        return False
+
+@benchmark('dpd.fetch_objects')
+def bench_fetch_objects(ctx):
+    tree = ctx['tree']
+    n_objects = 0
+    for i in xrange(ctx['entries']):
+        tree.GetEntry(i)
+        for prefix in ctx['prefixes']:
+            for obj in fetch_objects(tree, prefix, False):
+                obj.pt
+                obj.eta
+                n_objects += 1
+    return n_objects, 'objects'
+
+@benchmark('dpd.getattr_cached')
+def bench_getattr_cached(ctx):
+    tree = ctx['tree']
+    for i in xrange(ctx['entries']):
+        tree.GetEntry(i)
+        if tree.jet_n > 0:
+            break
+    else:
+        raise Skip('no jets in the input')
+    obj = DPDObject(tree, 'jet', 0)
+    n = 200000
+    for attr in OBJECT_ATTRS:
+        getattr(obj, attr)
+    for i in xrange(n // 4):
+        obj.pt
+        obj.eta
+        obj.phi
+        obj.E
+    return n, 'lookups'
+
+@benchmark('variation.calculables')
+def bench_calculables(ctx):
+    tree = ctx['tree']
+    v = BenchVariation(source=tree, name='bench')
+    for i in xrange(ctx['entries']):
+        tree.GetEntry(i)
+        v.reset()
+        v.muons
+        v.hard_muons
+        v.jets
+        v.ht
+    return ctx['entries'], 'entries'
+
+@benchmark('variation.reset')
+def bench_reset(ctx):
+    v = BenchVariation(source=ctx['tree'], name='bench')
+    n = 200000
+    for i in xrange(n):
+        v.reset()
+    return n, 'resets'
+
+@benchmark('branch.match_branches')
+def bench_match_branches(ctx):
+    tree = ctx['branch_tree']
+    selections = ['el_(pt|eta|phi)', 'mu_.*', 'jet_pt', 'jet_eta', 'ph_.*', '!.*_charge',
+                  'met_.*', 'trig_EF_.*', '!trig_EF_.*_prescale']
+    n = 50
+    n_branches = len(tree.GetListOfBranches())
+    for i in xrange(n):
+        # NB: don't time the memoized path
+        branch._compiled.clear()
+        branch.match_branches(selections, tree)
+    return n * n_branches, 'branches'
+
+def write_pytree(ctx, buffered):
+    if ctx['ROOT'] is None:
+        raise Skip('ROOT is not available')
+    from analysis_utils.root.pytree import PyTree
+    tree = ctx['tree']
+    out = PyTree('bench', 'bench', buffered=buffered)
+    out.SetDirectory(0)
+    for i in xrange(ctx['entries']):
+        tree.GetEntry(i)
+        out.reset()
+        out.write_branch(float(tree.met_et), 'met_et', float)
+        out.write_branch(int(tree.EventNumber), 'EventNumber', int)
+        for prefix in ctx['prefixes']:
+            out.write_object(get_objects(tree, prefix, False), prefix, ['pt', 'eta', 'phi'])
+        out.Fill()
+    if buffered:
+        out.flush()
+    return ctx['entries'], 'entries'
+
+@benchmark('pytree.write')
+def bench_pytree(ctx):
+    return write_pytree(ctx, False)
+
+@benchmark('pytree.write_buffered')
+def bench_pytree_buffered(ctx):
+    return write_pytree(ctx, True)
+
+def run_variations(ctx, n_variations):
+    tree = ctx['tree']
+    nominal = BenchVariation(process_fn=bench_cutflow, name='nominal')
+    variations = [BenchVariation(process_fn=bench_cutflow, name='v%d' % k, pt_shift=0.001 * k)
+                  for k in xrange(1, n_variations)]
+    # NB: keep the total work roughly constant
+    n_entries = max(1, ctx['entries'] * 10 // max(n_variations, 10))
+    run(tree, nominal, variations, silent=True, last_entry=n_entries)
+    return n_entries * n_variations, 'entry-variations'
+
+for _n in (1, 10, 100):
+    benchmark('run.variations_%d' % _n)(lambda ctx, n=_n: run_variations(ctx, n))
+
+''' Tree-like object with just a (large) list of branches, for match_branches '''
+class BranchListTree(object):
+
+    def __init__(self, names):
+        self._branches = [SyntheticBranch(b) for b in names]
+
+    def GetListOfBranches(self):
+        return self._branches
+
+def many_branch_names(prefixes, n_triggers=1000):
+    names = ['met_et', 'met_phi', 'RunNumber', 'EventNumber']
+    for prefix in prefixes:
+        names.append('%s_n' % prefix)
+        names.extend('%s_%s' % (prefix, attr) for attr in OBJECT_ATTRS + ['isolation', 'quality', 'author'])
+    for k in xrange(n_triggers):
+        names.append('trig_EF_chain%d' % k)
+        names.append('trig_EF_chain%d_prescale' % k)
+    return names
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=TOP_DIR, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_benchmark(fn, ctx, repeat):
+    best = None
+    for i in xrange(repeat):
+        t0 = time.time()
+        ops, unit = fn(ctx)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return {'time': best, 'ops': ops, 'unit': unit, 'rate': ops / best if best > 0 else None}
+
+def run_suite(ctx, pattern, repeat):
+    results = {}
+    for name, fn in BENCHMARKS:
+        if pattern and not re.search(pattern, name):
+            continue
+        try:
+            results[name] = time_benchmark(fn, ctx, repeat)
+        except Skip as e:
+            results[name] = {'skipped': str(e)}
+        print_result(name, results[name])
+    return results
+
+def print_result(name, result):
+    if 'skipped' in result:
+        print "%-28s %14s  (skipped: %s)" % (name, '', result['skipped'])
+    else:
+        print "%-28s %14.0f %s/s  [%.3f s]" % (name, result['rate'], result['unit'], result['time'])
+
+''' Compare two sets of results; return the names of the benchmarks
+    whose rate dropped by more than `threshold` (a fraction) '''
+def compare(old, new, threshold):
+    regressions = []
+    print
+    print "%-28s %14s %14s %8s" % ('benchmark', 'before [/s]', 'after [/s]', 'change')
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name, {}), new.get(name, {})
+        if not a.get('rate') or not b.get('rate'):
+            print "%-28s %14s %14s %8s" % (name, a.get('rate') and '%.0f' % a['rate'] or '-',
+                                            b.get('rate') and '%.0f' % b['rate'] or '-', '')
+            continue
+        change = b['rate'] / a['rate'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print "%-28s %14.0f %14.0f %+7.1f%%%s" % (name, a['rate'], b['rate'], 100 * change, flag)
+    return regressions
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for analysis_utils.")
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='The number of synthetic entries')
+    parser.add_argument('--multiplicity', type=str, default=None,
+                        help='Mean object multiplicities, e.g. "el=2,mu=2,jet=5,ph=1"')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Take the best of this many runs')
+    parser.add_argument('--only', type=str, default=None,
+                        help='Only run the benchmarks whose names match this regex')
+    parser.add_argument('--root-file', type=str, default=None,
+                        help='Read the input from this ROOT file (written first if missing)')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare with the results in this JSON file')
+    parser.add_argument('--against', type=str, default=None,
+                        help='With --compare: compare these results (JSON) instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Fractional slowdown which counts as a regression')
+    args = parser.parse_args()
+
+    if args.against:
+        if not args.compare:
+            parser.error('--against requires --compare')
+        regressions = compare(load_results(args.compare), load_results(args.against), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    multiplicities = parse_multiplicities(args.multiplicity)
+    try:
+        import ROOT
+        ROOT.PyConfig.IgnoreCommandLineOptions = True
+        root_version = ROOT.gROOT.GetVersion()
+    except ImportError:
+        ROOT = None
+        root_version = None
+
+    if args.root_file:
+        if ROOT is None:
+            parser.error('--root-file requires ROOT')
+        if not os.path.exists(args.root_file):
+            write_root_file(args.root_file, args.entries, multiplicities, args.seed)
+        tree = ROOT.TChain('physics')
+        tree.Add(args.root_file)
+    else:
+        tree = SyntheticTree(args.entries, multiplicities, args.seed)
+
+    ctx = {'tree': tree,
+           'entries': min(args.entries, tree.GetEntries()),
+           'prefixes': sorted(multiplicities),
+           'branch_tree': BranchListTree(many_branch_names(sorted(multiplicities))),
+           'ROOT': ROOT}
+
+    import numpy
+    meta = {'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'root': root_version,
+            'entries': ctx['entries'],
+            'multiplicities': multiplicities,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'input': args.root_file or 'synthetic'}
+
+    results = run_suite(ctx, args.only, args.repeat)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        regressions = compare(load_results(args.compare), results, args.threshold)
+        if regressions:
+            print "%d regression(s): %s" % (len(regressions), ', '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,122 @@
+'''
+ Synthetic D3PD-like input for the benchmarks: per entry, a Poisson
+ number of electrons, muons, jets and photons, stored as <prefix>_n plus
+ <prefix>_<attr> vector branches, and a few scalar branches (MET, run
+ and event numbers). The contents depend only on the seed.
+
+ SyntheticTree is an in-memory stand-in for a TTree, which needs neither
+ ROOT nor any files; write_root_file() writes the same entries to a real
+ TTree (with PyTree), when ROOT is available.
+'''
+
+import random
+
+''' Default mean object multiplicities '''
+MULTIPLICITIES = {'el': 2., 'mu': 2., 'jet': 5., 'ph': 1.}
+
+''' Vector attributes of every object type '''
+OBJECT_ATTRS = ['pt', 'eta', 'phi', 'E', 'charge']
+
+''' Parse e.g. "el=2,mu=2,jet=5" into {'el': 2., 'mu': 2., 'jet': 5.} '''
+def parse_multiplicities(text):
+    mult = dict(MULTIPLICITIES)
+    if text:
+        for item in text.split(','):
+            prefix, mean = item.split('=')
+            mult[prefix.strip()] = float(mean)
+    return mult
+
+def poisson(rng, mean):
+    # (Knuth) fine for the small means used here
+    limit = 2.718281828459045 ** -mean
+    k, p = 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+def generate_entries(n_entries, multiplicities=None, seed=1):
+    if multiplicities is None:
+        multiplicities = MULTIPLICITIES
+    rng = random.Random(seed)
+    entries = []
+    for i in xrange(n_entries):
+        entry = {'met_et': rng.expovariate(1 / 40e3),
+                 'met_phi': rng.uniform(-3.14159, 3.14159),
+                 'RunNumber': 200000 + i // 10000,
+                 'EventNumber': i}
+        for prefix, mean in sorted(multiplicities.items()):
+            n = poisson(rng, mean)
+            pt = sorted((rng.expovariate(1 / 30e3) for k in xrange(n)), reverse=True)
+            eta = [rng.uniform(-2.5, 2.5) for k in xrange(n)]
+            entry['%s_n' % prefix] = n
+            entry['%s_pt' % prefix] = pt
+            entry['%s_eta' % prefix] = eta
+            entry['%s_phi' % prefix] = [rng.uniform(-3.14159, 3.14159) for k in xrange(n)]
+            entry['%s_E' % prefix] = [p * (1 + abs(e)) for p, e in zip(pt, eta)]
+            entry['%s_charge' % prefix] = [rng.choice((-1, 1)) for k in xrange(n)]
+        entries.append(entry)
+    return entries
+
+class SyntheticBranch(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def GetName(self):
+        return self._name
+
+''' In-memory tree over generate_entries(); GetEntry() sets the branch values as attributes '''
+class SyntheticTree(object):
+
+    def __init__(self, n_entries, multiplicities=None, seed=1, name='physics'):
+        self._entries = generate_entries(n_entries, multiplicities, seed)
+        self._name = name
+        self._branches = [SyntheticBranch(b) for b in sorted(self._entries[0])] if self._entries else []
+        self._read_entry = -1
+
+    def GetName(self):
+        return self._name
+
+    def GetEntries(self):
+        return len(self._entries)
+
+    def GetEntry(self, i):
+        self.__dict__.update(self._entries[i])
+        self._read_entry = i
+        return 1
+
+    def GetReadEntry(self):
+        return self._read_entry
+
+    def GetListOfBranches(self):
+        return self._branches
+
+    def GetBranch(self, name):
+        for b in self._branches:
+            if b.GetName() == name:
+                return b
+        return None
+
+    def entries(self):
+        return self._entries
+
+''' Write the synthetic entries to a TTree in a new ROOT file (requires ROOT) '''
+def write_root_file(filename, n_entries, multiplicities=None, seed=1, name='physics'):
+    import ROOT as r
+    from analysis_utils.root.pytree import PyTree
+
+    f = r.TFile(filename, 'recreate')
+    t = PyTree(name, name)
+    for entry in generate_entries(n_entries, multiplicities, seed):
+        t.reset()
+        for bname in sorted(entry):
+            value = entry[bname]
+            if isinstance(value, list):
+                # NB: give the type, since the list may be empty
+                t.write_branch(value, bname, [int] if bname.endswith('_charge') else [float])
+            else:
+                t.write_branch(value, bname, type(value))
+        t.Fill()
+    t.Write()
+    f.Close()
@@ -8,6 +8,7 @@ from analysis_utils.variation_loop import run
 from analysis_utils.variation import AnalysisVariation
 from analysis_utils.root.dpd_object import fetch_objects, build_tlv, tlv_particle, met_object
 from analysis_utils.root.pytree import PyTree
+from analysis_utils.fourvector import remove_overlaps
 
 class ExampleAnalysis(AnalysisVariation):
     def __init__(self, *args, **kwargs):
@@ -30,10 +31,10 @@ class ExampleAnalysis(AnalysisVariation):
     def _get_all_electrons(self):
         return [build_tlv(el, mass=0) for el in fetch_objects(self._source, 'el')]
 
+    ''' Remove electrons within dR < 0.2 of a photon. remove_overlaps()
+        computes all the electron-photon dR's at once with numpy. '''
     def _get_nonoverlap_electrons(self):
-        return filter( lambda el: not any(
-            (el.tlv.DeltaR(ph.tlv) < 0.2 for ph in self.all_photons) ),
-            self.all_electrons )
+        return remove_overlaps(self.all_electrons, self.all_photons, 0.2)
 
     def _get_hard_electrons(self):
         return filter(lambda el: el.pt > 45, self.nonoverlap_electrons)
@@ -45,9 +46,7 @@ class ExampleAnalysis(AnalysisVariation):
         return map(build_tlv, fetch_objects(self._source, 'jet'))
 
     def _get_nonoverlap_jets(self):
-        return filter( lambda j: not any(
-            (j.tlv.DeltaR(el.tlv) < 0.1 for el in self.hard_electrons) ),
-            self.all_jets)
+        return remove_overlaps(self.all_jets, self.hard_electrons, 0.1)
     
     def _get_z_boson(self):
         electrons = self.hard_electrons
@@ -69,6 +68,9 @@ class ExampleAnalysis(AnalysisVariation):
     ## Output ntuple ##
     ###################
 
+    def get_output_trees(self):
+        return [self._output_tree]
+
     ''' override reset() so we can also clear the output ntuple
         on each new entry '''
     def reset(self):
@@ -7,38 +7,12 @@ r.PyConfig.IgnoreCommandLineOptions = True
 import analysis_utils.variation as variation
 from analysis_utils.variation_loop import run
 from analysis_utils.root.pytree import PyTree
-from analysis_utils.root.dpd_object import get_objects, tlv_particle, met_object
-
-
-##########################
-## Misc utility methods ##
-##########################
-
-''' simple function to implement crude MET (2d vector) smearing '''
-def smear_met(et, phi, width):
-    from numpy import cos, sin, arctan, pi
-    from numpy.random import normal
-    from numpy.linalg import norm
-    x = et * cos(phi) + normal(0, width)
-    y = et * sin(phi) + normal(0, width)
-    phi = arctan(y / x) + (x<0) * pi * (-1 if y<0 else 1)
-    return norm([x, y]), phi
-
-
-''' here are some ugly globals to keep track of
-    the calculation statistics; this is for illustration
-    purposes only, and wouldn't be necessary for a typical
-    analysis. '''
-calc_stats = {}
-def report_calculation(name):
-    try:
-        calc_stats[name] += 1
-    except KeyError:
-        calc_stats[name] = 1
-def print_stats():
-    for n, c in calc_stats.items():
-        print "%s:\t%d" % (n, c)
+from analysis_utils.root.dpd_object import get_objects, get_shared_objects, tlv_particle, met_object
+from analysis_utils.smearing import RandomStream, entry_numbers, smear_met, smear_pt
 
+''' seed for the systematic smearing; each variation draws from its own
+    random streams (see analysis_utils.smearing) '''
+SEED = 1234
 
 ##############################################################
 ## AnalysisVariation class (defines calculables and output) ##
@@ -60,6 +34,14 @@ class ExampleVariation(variation.AnalysisVariation):
         self._mu_width = kwargs.get('mu_width', 0)
         self._met_width = kwargs.get('met_width', 0)
 
+        # reproducible random numbers for the smearing, independent of the
+        # order in which variations and entries are processed
+        self._mu_rng = RandomStream(SEED, self._name, 'mu_pt')
+        self._met_rng = RandomStream(SEED, self._name, 'met')
+
+    def get_output_trees(self):
+        return [self._output_tree]
+
     def reset(self):
         variation.AnalysisVariation.reset(self)
         # make sure to reset the output tree
@@ -71,16 +53,17 @@ class ExampleVariation(variation.AnalysisVariation):
 
     ''' Get muon objects from the D3PD '''
     def _get_all_muons(self):
-        from numpy.random import normal
         self.defer_unless( self._mu_width > 0 )
-        report_calculation('all_muons')
-        muons = get_objects(self._source, 'mu')
+        # NB: the nominal muons are read once per event, and shared by all
+        # the variations; they must not be modified in place.
+        muons = get_shared_objects(self._source, 'mu')
 
-        if self._mu_width > 0:
-            # smear the muon pT randomly
-            from numpy.random import normal
-            for mu in muons:
-                mu.pt += mu.pt * normal(0, self._mu_width)
+        if self._mu_width > 0 and len(muons) > 0:
+            # smear the muon pT randomly (copy-on-write; only pt is replaced)
+            import numpy as np
+            pt = smear_pt(np.array([mu.pt for mu in muons]), self._mu_width, self._mu_rng,
+                          entry_numbers(self._source), np.array([mu.idx for mu in muons]))
+            muons = [mu.override(pt=mu_pt) for mu, mu_pt in zip(muons, pt)]
 
         return muons
     
@@ -90,7 +73,6 @@ class ExampleVariation(variation.AnalysisVariation):
         # defer to the nominal variation, unless were's shifting
         # the muons definition.
         self.defer_unless( self._mu_width > 0 )
-        report_calculation('hard_muons')
         shift = self._mu_width
         return filter( lambda mu:
                 (mu.pt + shift) > 45,
@@ -99,7 +81,6 @@ class ExampleVariation(variation.AnalysisVariation):
     ''' Get jet objects from the D3PD '''
     def _get_all_jets(self):
         self.defer()
-        report_calculation('all_jets')
         return get_objects(self._source, 'jet')
 
     ''' Get the smeared MET (random MET added to D3PD value)
@@ -107,18 +88,16 @@ class ExampleVariation(variation.AnalysisVariation):
     def _get_met_smeared(self):
         if self._met_width == 0:
             self.defer()
-            report_calculation('met_smeared')
             return met_object(self.met_et, self.met_phi)
 
         # calculate MET with some random smearing
-        report_calculation('met_smeared')
-        return met_object(*smear_met(self.met_et, self.met_phi, self._met_width))
+        return met_object(*smear_met(self.met_et, self.met_phi, self._met_width,
+                                     self._met_rng, entry_numbers(self._source)))
     
     ''' Try to build a Z boson by adding the 4-vectors of
         two hard muons. Otherwise return None '''
     def _get_z_boson(self):
         self.defer_unless( self._mu_width > 0 )
-        report_calculation('z_boson')
 
         muons = self.hard_muons
         if len(muons) < 2:
@@ -206,6 +185,8 @@ if __name__ == "__main__":
                         help='the input TTree name')
     parser.add_argument('--out', default='variations.root',
                         help='the output filename')
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint to this file periodically, and resume from it if it exists')
     parser.add_argument('input_file', nargs='+',
                         help='the input file(s) to use')
     args = parser.parse_args()
@@ -214,8 +195,11 @@ if __name__ == "__main__":
     input_tree = r.TChain(args.tree)
     map(input_tree.Add, args.input_file)
 
-    # create the output file
-    outfile = r.TFile(args.out, 'recreate')
+    # create the output file. when resuming from a checkpoint, the
+    # output written so far is read back from the existing file.
+    import os
+    resume = args.checkpoint is not None and os.path.exists(args.checkpoint)
+    outfile = r.TFile(args.out, 'update' if resume else 'recreate')
 
     # set up the variations to be run
     var_nominal = ExampleVariation(process_fn=analysis_cutflow,
@@ -230,8 +214,11 @@ if __name__ == "__main__":
                          name='jets CR'),
     ]
 
-    # run the analysis using the variation_loop driver:
-    run(input_tree, nominal=var_nominal, variations=variations_to_run, entry_limit=50000)
+    # run the analysis using the variation_loop driver. with profile=True,
+    # the driver keeps track of how often (and how long) each calculable
+    # is computed, and prints a report at the end.
+    run(input_tree, nominal=var_nominal, variations=variations_to_run, entry_limit=50000,
+        profile=True, checkpoint_file=args.checkpoint)
 
     outfile.Write()
     outfile.Close()
@@ -243,6 +230,3 @@ if __name__ == "__main__":
         print "==== Cutflow: %s ====" % v._name
         print v._cutflow
         print
-    print ">>>> Calculation stats: <<<<"
-    print_stats()
-    print
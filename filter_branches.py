@@ -1,17 +1,129 @@
 #!/usr/bin/env python
 
+'''
+ Skim ROOT files down to the branches matching a selection file, and
+ optionally to the events passing a selection expression.
+
+ Files are processed by a pool of worker processes (--jobs), sharing
+ the selection compiled once up front. Without an event selection, the
+ kept branches are fast-cloned, i.e. their compressed baskets are copied
+ without being decompressed.
+
+ With --manifest, the status of every file is recorded in a JSON file
+ as it completes. Re-running the same command skips the files which are
+ already done, so a crashed skim only restarts the unfinished files.
+'''
+
 import os
+import sys
+import time
+import json
 import argparse
-import ROOT as r
-r.PyConfig.IgnoreCommandLineOptions = True
+import multiprocessing
+import traceback
 
-from analysis_utils.branch import match_branches_from_file
+from analysis_utils.root.branch import load_selections, compile_selections, match_compiled
+from analysis_utils.root.read_set_cache import ReadSetCache, DEFAULT_CACHE_DIR
 
 TREE_NAME = 'physics'
 
+# compiled before the worker pool is forked, so every worker shares them
+# (along with the per-schema match results, see branch.BranchSelection)
+_selection = None
+_cached_branches = set()
+
+def output_name(in_file, out_dir, ext):
+    if out_dir == "":
+        return "%s.%s" % (in_file, ext)
+    return os.path.join(out_dir, os.path.basename("%s.%s" % (in_file, ext)))
+
+def file_size(name):
+    # NB: e.g. remote (root://) inputs have no local size
+    if os.path.exists(name):
+        return os.path.getsize(name)
+    return 0
+
+''' Skim a single file; returns a dict of statistics for the manifest '''
+def skim_file(in_file, out_file_name, tree_name, remove=False, selection=None):
+    tstart = time.time()
+    t0 = r.TChain(tree_name)
+    t0.Add(in_file)
+
+    matches = match_compiled(_selection, t0)
+    # NB: the cached read-sets are always kept, i.e. with --remove they
+    # are exempt from removal
+    if _cached_branches:
+        if remove:
+            matches = [b for b in matches if not b in _cached_branches]
+        else:
+            available = set(b.GetName() for b in t0.GetListOfBranches())
+            matches = sorted(set(matches) | (_cached_branches & available))
+
+    t0.SetBranchStatus("*", remove)
+
+    print "Matched branches:"
+    for b in matches:
+        print " ", b
+        t0.SetBranchStatus(b, not remove)
+
+    out_file = r.TFile(out_file_name, "RECREATE")
+    if selection:
+        t1 = t0.CopyTree(selection)
+    else:
+        t1 = t0.CloneTree(-1, "fast")
+    n_out = t1.GetEntries()
+    t1.Write()
+    out_file.Close()
+
+    return {'status': 'done',
+            'output': out_file_name,
+            'branches': len(matches),
+            'entries_in': t0.GetEntries(),
+            'entries_out': n_out,
+            'bytes_in': file_size(in_file),
+            'bytes_out': file_size(out_file_name),
+            'seconds': time.time() - tstart}
+
+def skim_worker(job):
+    in_file, out_file_name, tree_name, remove, selection = job
+    try:
+        return in_file, skim_file(in_file, out_file_name, tree_name, remove, selection)
+    except Exception:
+        return in_file, {'status': 'failed', 'output': out_file_name,
+                         'error': traceback.format_exc()}
+
+def load_manifest(filename):
+    if filename and os.path.exists(filename):
+        return json.load(open(filename))
+    return {}
+
+def save_manifest(filename, manifest):
+    if not filename:
+        return
+    # write atomically, so a crash never leaves a truncated manifest
+    tmp_name = filename + '.tmp'
+    f = open(tmp_name, 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp_name, filename)
+
+def is_done(manifest, in_file, out_file_name):
+    entry = manifest.get(in_file)
+    return (entry is not None and entry['status'] == 'done'
+            and entry['output'] == out_file_name and os.path.exists(out_file_name))
+
+def print_throughput(in_file, entry):
+    if entry['status'] != 'done':
+        print "FAILED: %s\n%s" % (in_file, entry['error'])
+        return
+    dt = entry['seconds'] + 1e-9
+    print "%s: %d/%d entries, %d branches, %.1f s [%g Hz, %.2f MB/s]" % (
+        os.path.basename(in_file), entry['entries_out'], entry['entries_in'], entry['branches'],
+        dt, entry['entries_in'] / dt, entry['bytes_in'] / dt / 1024**2)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Keep only branches that match expressions in a file.")
+        description="Keep only branches that match expressions in a file (lines starting with ! exclude branches).")
     parser.add_argument('branch_spec', type=str,
                         help="The file containing expressions to match. Lines beginning with # are comments")
     parser.add_argument('root_file', type=str, nargs="+",
@@ -21,36 +133,76 @@ if __name__ == "__main__":
                         help='Output directory for filtered files. By default, output to the same directory as the original file.')
     parser.add_argument('--ext', type=str, default="trim",
                         help='Extension added to the end of the output file names')
+    parser.add_argument('--tree', type=str, default=TREE_NAME,
+                        help='The name of the TTree within the root files')
+    parser.add_argument('--selection', type=str, default=None,
+                        help='Only keep events passing this TTree::Draw-style selection expression')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of files to skim in parallel')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='JSON file recording the status of each file. Files already done are skipped.')
+    parser.add_argument('--cached-read-set', type=str, action='append', default=[],
+                        help='Also keep the branches of this entry of the read-set cache (see analysis_utils.root.read_set_cache). May be given multiple times.')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help='The read-set cache directory')
 
     args = parser.parse_args()
 
+    # NB: only import ROOT once the arguments are parsed, so that e.g. --help is fast
+    import ROOT as r
+    r.PyConfig.IgnoreCommandLineOptions = True
+
     input_files = args.root_file
     if len(input_files) == 1 and ',' in input_files[0]:
         input_files = input_files[0].split(',')
 
-    outfiles = []
-    for in_file in input_files:
-        t0 = r.TChain(TREE_NAME)
-        t0.Add(in_file)
+    _selection = compile_selections(load_selections(args.branch_spec))
+
+    cache = ReadSetCache(args.cache_dir)
+    for key in args.cached_read_set:
+        branches = cache.lookup(key)
+        if branches is None:
+            parser.error("no entry `%s` in the read-set cache %s" % (key, args.cache_dir))
+        _cached_branches.update(branches)
 
-        matches = match_branches_from_file(args.branch_spec, t0)
+    manifest = load_manifest(args.manifest)
+
+    jobs = []
+    for in_file in input_files:
+        out_file_name = output_name(in_file, args.out, args.ext)
+        if is_done(manifest, in_file, out_file_name):
+            continue
+        jobs.append((in_file, out_file_name, args.tree, args.remove, args.selection))
 
-        t0.SetBranchStatus("*", args.remove)
+    n_skipped = len(input_files) - len(jobs)
+    if n_skipped > 0:
+        print "Skipping %d file(s) already done according to %s" % (n_skipped, args.manifest)
 
-        print "Matched branches:"
-        for b in matches:
-            print " ", b
-            t0.SetBranchStatus(b, not args.remove)
+    tstart = time.time()
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+        results = pool.imap_unordered(skim_worker, jobs)
+    else:
+        pool = None
+        results = (skim_worker(job) for job in jobs)
 
-        if args.out == "":
-            out_file_name = "%s.%s" % (in_file, args.ext)
+    n_failed = 0
+    bytes_in = 0
+    for in_file, entry in results:
+        manifest[in_file] = entry
+        save_manifest(args.manifest, manifest)
+        print_throughput(in_file, entry)
+        if entry['status'] == 'done':
+            bytes_in += entry['bytes_in']
         else:
-            out_file_name = os.path.join(
-                args.out, os.path.basename("%s.%s" % (in_file, args.ext)))
+            n_failed += 1
 
-        outfiles.append(out_file_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        out_file = r.TFile(out_file_name, "RECREATE")
-        t1 = t0.CloneTree()
-        t1.Write()
-        out_file.Close()
+    dt = time.time() - tstart + 1e-9
+    print "Skimmed %d file(s) in %.1f s [%.2f MB/s]; %d failed." % (
+        len(jobs) - n_failed, dt, bytes_in / dt / 1024**2, n_failed)
+    if n_failed > 0:
+        sys.exit(1)
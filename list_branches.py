@@ -1,22 +1,130 @@
 #!/usr/bin/env python
 
+import sys
 import argparse
-import ROOT as r
-r.PyConfig.IgnoreCommandLineOptions = True
+
+from analysis_utils.root.schema_index import SchemaIndex
 
 TREE_NAME = 'physics'
 
+''' Print the storage report requested on the command line '''
+def report_storage(storage, args):
+    from analysis_utils.root.branch import group_storage, rank_by_cost, print_storage_report
+    if args.access:
+        from analysis_utils.root.profile_tree import load_access_list
+        alist = load_access_list(args.access)
+        if args.group:
+            # a group is used as often as its most used branch
+            from analysis_utils.root.branch import dpd_group
+            group_uses = {}
+            for b, n in alist.items():
+                k = dpd_group(b)
+                group_uses[k] = max(group_uses.get(k, 0), n)
+            storage = rank_by_cost(group_storage(storage), group_uses)
+        else:
+            storage = rank_by_cost(storage, alist)
+    else:
+        if args.group:
+            storage = group_storage(storage)
+        storage = sorted(storage, key=lambda s: s['zip_bytes'], reverse=True)
+    print_storage_report(storage, args.limit)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="List branches of a tree in a rootfile")
-    parser.add_argument('root_file', type=str,
-                        help='Input root file')
-    parser.add_argument('--tree', type=str, default="physics",
+        description="List branches of a tree in a rootfile. With --index, query (or build, with --scan) a schema index of many files instead.")
+    parser.add_argument('root_file', type=str, nargs='*',
+                        help='Input root file(s)')
+    parser.add_argument('--tree', type=str, default=TREE_NAME,
                         help='The name of the TTree within the root file')
+    parser.add_argument('--types', action='store_true',
+                        help='Also print the type of each branch')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Schema index file (see analysis_utils.root.schema_index)')
+    parser.add_argument('--scan', action='store_true',
+                        help='Add the given root files to the index (only new or modified files are scanned)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='The number of files to scan in parallel (default: number of CPUs)')
+    parser.add_argument('--summary', action='store_true',
+                        help='Print a summary of the files and schemas in the index')
+    parser.add_argument('--lacking', type=str, default=None, metavar='BRANCH',
+                        help='List the indexed files which do not have BRANCH')
+    parser.add_argument('--diff', type=str, nargs=2, default=None, metavar=('FILE_A', 'FILE_B'),
+                        help='Compare the schemas of two indexed files')
+    parser.add_argument('--sizes', action='store_true',
+                        help='Print the compressed/uncompressed size, compression ratio and number of baskets of each branch')
+    parser.add_argument('--group', action='store_true',
+                        help='With --sizes, sum the sizes by DPD prefix (el_*, jet_*, ...)')
+    parser.add_argument('--access', type=str, default=None, metavar='JSON',
+                        help='With --sizes, rank the branches by bytes per use, using the access records saved by ProfileChain.save_report()')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='With --sizes, only print the first LIMIT lines')
     args = parser.parse_args()
 
-    f = r.TFile(args.root_file)
-    t = f.Get(args.tree)
+    if args.index is None:
+        import ROOT as r
+        r.PyConfig.IgnoreCommandLineOptions = True
+        from analysis_utils.root.schema_index import branch_type
+
+        if args.sizes:
+            from analysis_utils.root.branch import branch_storage
+            chain = r.TChain(args.tree)
+            for fname in args.root_file:
+                chain.Add(fname)
+            report_storage(branch_storage(chain), args)
+            sys.exit(0)
+
+        if len(args.root_file) != 1:
+            parser.error('expected exactly one root file (or use --index)')
+        f = r.TFile(args.root_file[0])
+        t = f.Get(args.tree)
+
+        for b in t.GetListOfBranches():
+            if args.types:
+                print b.GetName(), branch_type(b)
+            else:
+                print b.GetName()
+        sys.exit(0)
+
+    index = SchemaIndex(args.index)
+    if args.scan:
+        n = index.update(args.root_file, args.tree, n_jobs=args.jobs)
+        index.save()
+        print "Scanned %d file(s) into %s" % (n, args.index)
+        for fname in sorted(index.errors):
+            print "Could not scan %s:\n%s" % (fname, index.errors[fname])
 
-    for b in t.GetListOfBranches():
-        print b.GetName()
+    if args.sizes:
+        # NB: the index does not keep basket counts
+        storage = []
+        for name, (zip_bytes, tot_bytes) in sorted(index.branch_sizes().items()):
+            storage.append({'name': name, 'zip_bytes': zip_bytes, 'tot_bytes': tot_bytes, 'baskets': None,
+                            'ratio': float(tot_bytes) / zip_bytes if zip_bytes else 0.})
+        report_storage(storage, args)
+    elif args.summary:
+        index.print_summary()
+    elif args.lacking:
+        for fname in index.files_lacking(args.lacking):
+            print fname
+    elif args.diff:
+        only_a, only_b, changed = index.diff(*args.diff)
+        for b in only_a:
+            print "-", b
+        for b in only_b:
+            print "+", b
+        for b, type_a, type_b in changed:
+            print "~ %s (%s -> %s)" % (b, type_a, type_b)
+    elif not args.scan:
+        # list the branches of the given files, or of all the indexed files
+        if args.root_file:
+            schema = {}
+            for fname in args.root_file:
+                schema.update(index.schema(fname))
+            names = sorted(schema)
+        else:
+            schema = dict((n, t) for s in index.schemas for n, t in s['branches'])
+            names = index.branches()
+        for b in names:
+            if args.types:
+                print b, schema[b]
+            else:
+                print b
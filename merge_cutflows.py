@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+'''
+ Merge the cutflow files written by many jobs (see the `cutflow_file`
+ option of variation_loop.run) into a single file, and/or print the
+ merged (weighted) cutflows.
+'''
+
+import argparse
+
+from analysis_utils.cutflow import load_cutflows, save_cutflows, merge_cutflow_dicts
+
+def iter_cutflows(filenames):
+    for fname in filenames:
+        yield load_cutflows(fname)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge cutflow (.npz) files written by analysis jobs.")
+    parser.add_argument('cutflow_file', type=str, nargs='*',
+                        help='The cutflow files to merge')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write the merged cutflows to this file')
+    parser.add_argument('--list', type=str, default=None,
+                        help='A file containing the names of (more) cutflow files to merge, one per line')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help="Don't print the merged cutflows")
+    args = parser.parse_args()
+
+    filenames = list(args.cutflow_file)
+    if args.list:
+        filenames.extend(l.strip() for l in open(args.list) if l.strip())
+
+    merged = merge_cutflow_dicts(iter_cutflows(filenames))
+
+    if args.out:
+        save_cutflows(args.out, merged)
+
+    if not args.quiet:
+        print "Merged %d file(s)" % len(filenames)
+        for name in sorted(merged):
+            print
+            print "==== %s ====" % name
+            print merged[name]